@@ -54,6 +54,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'querytgdb.middleware.QueryJobMiddleware',
 ]
 
 ROOT_URLCONF = 'connectf.urls'
@@ -164,6 +165,30 @@ CACHES = {
     },
 }
 
+# per request query results, see querytgdb.utils.result_store
+# a directory, or a redis:// URL to share results between hosts
+RESULT_STORE = {
+    'LOCATION': CONFIG.get('RESULT_STORE') or os.path.join(tempfile.gettempdir(), 'connectf_results'),
+    'TIMEOUT': 3600,
+    'MEMORY_LIMIT': 256 * 2 ** 20,  # bytes of loaded results kept in memory by each process
+    'COMPRESSION': {
+        'CODEC': 'zstd',  # "zstd", "lz4" or None
+        'LEVEL': None,  # default level of the codec
+        'THRESHOLD': 64 * 2 ** 10  # bytes, smaller values are stored uncompressed
+    }
+}
+
+# posted queries run as jobs, see querytgdb.utils.jobs
+QUERY_JOBS = {
+    'WORKERS': 2,  # per server process, 0 runs queries in the request
+    'PROCESSES': False,  # run jobs in processes instead of threads, each gunicorn worker's processes load the edges
+    'WAIT': 150,  # seconds posted queries wait for their job before responding, keep under the gunicorn timeout
+    'POLL_WAIT': 10,  # seconds result and rows requests wait for a job, other views respond at once
+    'MAX_CELLS': 50_000_000,  # largest result, bigger queries fail
+    'HEAVY_CELLS': 5_000_000,  # queries with bigger estimated results are heavy
+    'HEAVY_JOBS': 1  # heavy jobs run at a time per server process
+}
+
 # Configure motif annotation file and cluster definitions here
 
 def getPathOrDefault(key, default):
@@ -181,6 +206,12 @@ MOTIF_CLUSTER_INFO = getPathOrDefault('MOTIF_CLUSTER_INFO', os.path.join(BASE_DI
 GENE_LISTS = getPathOrDefault('GENE_LISTS', os.path.join(BASE_DIR, 'commongenelists'))
 TARGET_NETWORKS = getPathOrDefault('TARGET_NETWORKS', os.path.join(BASE_DIR, 'target_networks'))
 
+# evaluator for TF queries, "pandas" or "sparse"
+QUERY_ENGINE = CONFIG.get('QUERY_ENGINE', 'pandas')
+
+# memory mapped snapshot of edges, annotations and motif counts written by the snapshot command
+SNAPSHOT_DIR = getPathOrDefault('SNAPSHOT_DIR', os.path.join(BASE_DIR, 'data', 'snapshot'))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
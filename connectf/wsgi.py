@@ -14,3 +14,6 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "connectf.settings")
 
 application = get_wsgi_application()
+
+# load data and warm up common queries when the worker starts instead of on the first request
+import querytgdb.utils.warmup  # noqa: E402,F401
@@ -7,6 +7,7 @@ for the specified IMPORT directory: arabidopsis, maize or rice:
   python manage.py import_annotation -i <annotation_file>
   python manage.py import_data <data_dir> <metadata_dir>
   python manage.py import_edges <edges_file>
+  python manage.py snapshot
 '
 
 if [ -n "$IMPORT" ]; then
@@ -33,4 +34,7 @@ if [ -n "$IMPORT" ]; then
       python manage.py import_edges $file
     fi
   done
+
+  # Write the memory mapped snapshot shared by the server workers
+  python manage.py snapshot
 fi
\ No newline at end of file
@@ -1,8 +1,23 @@
 import os
 
+import django
 from django.apps import AppConfig
 
 
+def setup_process(databases):
+    """
+    Set up Django in a query job process, with the databases of the process that started it
+
+    Lives here since the apps aren't loaded when it is imported.
+    :param databases: test databases in tests
+    :return:
+    """
+    from django.conf import settings
+
+    settings.DATABASES = databases
+    django.setup()
+
+
 class QuerytgdbConfig(AppConfig):
     name = 'querytgdb'
 
@@ -0,0 +1,109 @@
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from django.core.management.base import BaseCommand, CommandParser
+from django.http import JsonResponse
+
+from querytgdb.utils import PandasJSONEncoder
+from querytgdb.utils.formatter import DATA_COL_LEN, HEADER_ROWS, FormattedResult
+from querytgdb.utils.serializer import result_arrow, result_json
+
+
+def make_result(rows: int, analyses: int, seed: int = 0) -> FormattedResult:
+    """
+    Random formatted result shaped like a real one, with EDGE, Pvalue and Log2FC columns for every analysis
+    """
+    rng = np.random.default_rng(seed)
+
+    data = {
+        'Full Name': np.where(rng.random(rows) < 0.5, 'some protein', None),
+        'Name': [f'GENE{i}' for i in range(rows)],
+        'Gene Family': None,
+        'Type': 'protein_coding',
+        'User List': None,
+        'User List Count': np.nan,
+        'TF Count': rng.integers(1, analyses + 1, rows),
+        'Gene ID': [f'AT1G{i:05d}' for i in range(rows)]
+    }
+
+    for i in range(analyses):
+        name = (f'AT2G{i:05d}', '', f'{i:08d}-0000-0000-0000-000000000000')
+        present = rng.random(rows) < 0.3
+        expression = rng.random(rows) < 0.5
+
+        data[(name, i, 'EDGE')] = np.where(present & ~expression, '+', None)
+        data[(name, i, 'Pvalue')] = np.where(present & expression, rng.random(rows) / 100, np.nan)
+        data[(name, i, 'Log2FC')] = np.where(present & expression, rng.normal(0, 3, rows), np.nan)
+
+    df = pd.DataFrame(data)
+    header = [list(c if isinstance(c, tuple) else (c, None, None)) for c in df.columns]
+    header = [list(h) for h in zip(*header)] + [[None] * df.shape[1] for _ in range(HEADER_ROWS - 3)]
+
+    columns = [{'type': 'text'}] * DATA_COL_LEN + [{'type': 'numeric'}] * (df.shape[1] - DATA_COL_LEN)
+
+    return FormattedResult(columns, [], header, df)
+
+
+class Command(BaseCommand):
+    help = "Compare the query result JSON and Arrow serializers with JsonResponse and PandasJSONEncoder."
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('-r', '--rows', help="number of rows (default: 20000)", type=int, default=20000)
+        parser.add_argument('-a', '--analyses', help="number of analyses, 3 columns each (default: 17)",
+                            type=int, default=17)
+        parser.add_argument('-n', '--repeat', help="number of runs (default: 3)", type=int, default=3)
+
+    def handle(self, *args, **options):
+        formatted = make_result(options['rows'], options['analyses'])
+        res = {
+            'result': {
+                'mergeCells': formatted.merged_cells,
+                'columns': formatted.columns
+            },
+            'request_id': '00000000-0000-0000-0000-000000000000'
+        }
+
+        self.stdout.write(f"{formatted.data.size} cells\n")
+
+        def encoder():
+            # what the query view used to send
+            data = formatted.header + formatted.data.replace({np.nan: None}).values.tolist()
+            return JsonResponse({**res, 'result': {'data': data, **res['result']}},
+                                encoder=PandasJSONEncoder).content
+
+        def serializer():
+            return result_json(res, formatted).encode()
+
+        def arrow():
+            return result_arrow(res, formatted)
+
+        def time_min(func, *args):
+            times = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                value = func(*args)
+                times.append(time.perf_counter() - start)
+            return min(times), value
+
+        timings = {}
+        for name, func, parse in (('JsonResponse', encoder, json.loads),
+                                  ('serializer', serializer, json.loads),
+                                  ('arrow', arrow, lambda c: pa.ipc.open_stream(c).read_all())):
+            t, content = time_min(func)
+            parse_time, parsed = time_min(parse, content)
+            timings[name] = (t, parsed)
+
+            self.stdout.write(f"{name}: {t:.3f}s, {len(content) / 1e6:.1f} MB, parse {parse_time:.4f}s\n")
+
+        self.stdout.write(f"speedup: {timings['JsonResponse'][0] / timings['serializer'][0]:.1f}x\n")
+
+        expected = timings['JsonResponse'][1]
+        if expected != timings['serializer'][1]:
+            self.stderr.write("Outputs differ!")
+
+        table = timings['arrow'][1]
+        if expected['result']['data'][HEADER_ROWS:] != [list(r.values()) for r in table.to_pylist()]:
+            self.stderr.write("Arrow output differs!")
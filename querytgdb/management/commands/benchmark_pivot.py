@@ -0,0 +1,92 @@
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandParser
+
+from querytgdb.utils.parser import LOG2FC, PVALUE, build_target_frame
+
+
+def make_edges(targets: int, tfs: int, analyses: int, density: float, seed: int = 0) -> pd.DataFrame:
+    """
+    Random edges in long format shaped like all TF edges, half of the analyses have regulation data
+    """
+    rng = np.random.default_rng(seed)
+
+    analysis_ids = np.arange(1, analyses + 1)
+    edges = rng.random((analyses, targets)) < density
+    analysis, target = np.nonzero(edges)
+
+    expression = analysis % 2 == 1
+    df = pd.DataFrame({
+        'TARGET': np.char.add('AT1G', np.char.zfill(target.astype(str), 5)).astype(object),
+        'ANALYSIS': analysis_ids[analysis],
+        'TF': np.char.add('AT2G', np.char.zfill((analysis % tfs).astype(str), 5)).astype(object),
+        'EDGE': np.where(expression, None, '+'),
+        PVALUE: np.where(expression, rng.random(len(analysis)) / 100, np.nan),
+        LOG2FC: np.where(expression, rng.normal(0, 3, len(analysis)), np.nan)
+    })
+    df['EDGE'] = df['EDGE'].fillna(np.nan)
+
+    return df
+
+
+def unstack_edges(df: pd.DataFrame) -> pd.DataFrame:
+    # how all TF edges used to be pivoted
+    return (df.set_index(['TF', 'ANALYSIS', 'TARGET'])
+            .unstack(level=[0, 1])
+            .reorder_levels([1, 2, 0], axis=1)
+            .sort_index(axis=1, level=[0, 1], sort_remaining=False)
+            .dropna(how='all', axis=1))
+
+
+class Command(BaseCommand):
+    help = "Compare time and peak memory of building result frames from edges with unstacking them."
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('-t', '--targets', help="number of targets (default: 20000)", type=int, default=20000)
+        parser.add_argument('-f', '--tfs', help="number of TFs (default: 100)", type=int, default=100)
+        parser.add_argument('-a', '--analyses', help="number of analyses (default: 300)", type=int, default=300)
+        parser.add_argument('-d', '--density', help="share of targets of each analysis (default: 0.1)", type=float,
+                            default=0.1)
+        parser.add_argument('-n', '--repeat', help="number of runs (default: 3)", type=int, default=3)
+
+    def handle(self, *args, **options):
+        df = make_edges(options['targets'], options['tfs'], options['analyses'], options['density'])
+
+        self.stdout.write(f"{len(df)} edges\n")
+
+        def measure(func):
+            times = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                func(df)
+                times.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            try:
+                result = func(df)
+                _size, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+            return min(times), peak, result
+
+        timings = {}
+        for name, func in (('unstack', unstack_edges),
+                           ('build', lambda d: build_target_frame(d, d['TF']))):
+            t, peak, result = measure(func)
+            timings[name] = (t, peak, result)
+
+            self.stdout.write(f"{name}: {t:.3f}s, peak {peak / 1e6:.1f} MB, "
+                              f"result {result.memory_usage(index=False).sum() / 1e6:.1f} MB {result.shape}\n")
+
+        self.stdout.write(f"speedup: {timings['unstack'][0] / timings['build'][0]:.1f}x, "
+                          f"peak memory: {timings['build'][1] / timings['unstack'][1]:.0%}\n")
+
+        expected, result = timings['unstack'][2], timings['build'][2]
+        names = [(c[0][0], *c[1:]) for c in result.columns]  # built columns have unique TF names
+        if names != list(expected.columns) or \
+                not result.set_axis(expected.columns, axis=1).astype(expected.dtypes).equals(expected):
+            self.stderr.write("Outputs differ!")
@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand, CommandParser
 from django.db.transaction import atomic
 
 from ...models import Analysis
+from ...utils.data_version import data_version
 
 
 class Command(BaseCommand):
@@ -58,3 +59,6 @@ class Command(BaseCommand):
 
             else:
                 self.stdout.write("Nothing removed.", ending="\n")
+                return
+
+        data_version.bump(f"remove: {command or 'all'}")
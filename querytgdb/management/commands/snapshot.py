@@ -0,0 +1,51 @@
+import os
+
+import pandas as pd
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from querytgdb.utils import read_annotations
+from querytgdb.utils.edge_store import edge_store
+from querytgdb.utils.snapshot import analysis_signature, annotation_signature, file_signature, write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Writes a memory mapped snapshot of edges, annotations and motif counts shared by all server workers."
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('-o', '--output', help=f"snapshot directory (default: {settings.SNAPSHOT_DIR})",
+                            type=str, default=settings.SNAPSHOT_DIR)
+        parser.add_argument('--no-motifs', help="do not include motif counts", action='store_true')
+
+    def handle(self, *args, **options):
+        output = options['output']
+
+        if not output:
+            raise CommandError("Set SNAPSHOT_DIR or pass --output.")
+
+        sources = {
+            'analyses': analysis_signature(),
+            'annotations': annotation_signature()
+        }
+
+        data = edge_store.load_from_database()
+        edges = data._asdict()
+        analyses = edges.pop('analyses')
+
+        annotations = read_annotations()
+
+        motifs = {}
+
+        if not options['no_motifs']:
+            for name, path in (('motifs', settings.MOTIF_ANNOTATION), ('motifs_tf', settings.MOTIF_TF_ANNOTATION)):
+                if os.path.isfile(path):
+                    motifs[name] = pd.read_csv(path, index_col=[0, 1, 2], header=None)
+                    sources[name] = file_signature(path)
+                else:
+                    self.stderr.write(f"Motif file not found: {path}")
+
+        write_snapshot(output, edges, analyses, annotations, motifs, sources)
+
+        self.stdout.write(f"Snapshot written to {output}: {data.analysis.size} interactions, "
+                          f"{data.reg_analysis.size} regulations, {annotations.shape[0]} annotations.\n"
+                          "Remember to restart the server.\n")
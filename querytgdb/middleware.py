@@ -0,0 +1,39 @@
+from django.http import HttpResponseNotFound, JsonResponse
+
+from querytgdb.utils.jobs import query_jobs
+
+
+class QueryJobMiddleware:
+    """
+    Check the query job of a request id before views that read its results
+
+    Views wait for the job for wait_for_job seconds, 0 by default, so a running job doesn't hold server workers.
+    Responds with 404 if the job failed, and 503 with Retry-After if it is still running. Views that report on jobs
+    themselves set wait_for_job to None.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request_id = view_kwargs.get('request_id')
+        timeout = getattr(getattr(view_func, 'view_class', None), 'wait_for_job', 0)
+
+        if request_id is None or timeout is None:
+            return None
+
+        job = query_jobs.wait(request_id, timeout)
+
+        if job is None or job['state'] == 'done':
+            return None
+
+        if job['state'] == 'failed':
+            return HttpResponseNotFound(job['error'], content_type='text/plain')
+
+        response = JsonResponse({'request_id': str(request_id), **job}, status=503)
+        response['Retry-After'] = '5'
+
+        return response
@@ -159,4 +159,17 @@ class ImportHistory(models.Model):
     imported_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"{self.type}: {self.fileName} imported at {self.imported_at}"
\ No newline at end of file
+        return f"{self.type}: {self.fileName} imported at {self.imported_at}"
+
+
+class DataVersion(models.Model):
+    """
+    Version of the data, a row is added every time data is imported or removed
+
+    The current version is the largest id.
+    """
+    reason = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"version {self.pk}: {self.reason} at {self.created_at}"
@@ -3,17 +3,36 @@ import io
 import json
 import os
 import secrets
+import tempfile
 from glob import iglob
+from uuid import uuid4
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
 from django.urls import reverse
 
 from querytgdb.utils.insert_data import import_additional_edges, import_annotations, insert_data, \
     read_annotation_file
-from .models import Analysis, Annotation, EdgeData, EdgeType
+from .models import Analysis, AnalysisData, Annotation, DataVersion, EdgeData, EdgeType, MetaKey
+from .utils.data_version import DataVersionWatcher
+from .utils.edge_store import EdgeArrays, edge_store
+from .utils import EDGE_COLUMNS, get_metadata
 from .utils.file import BadNetwork, get_network
+from .utils.formatter import HEADER_ROWS
+from .utils.jobs import QueryJobs, get_job, update_job
+from .utils.metadata_index import metadata_index
+from .utils.parser import EDGE_DTYPE, TargetFrame, build_target_frame, column_stats, compile_query, get_mod, \
+    get_tf, get_total, induce_repress_count, parse_query, plan_cache_info, reorder_data
+from .utils.progress import Progress, report, set_total, tracking
+from .utils.query_cost import count_tfs, estimate_plan
+from .utils.query_plan import BinOp, Gene, ModNot, Predicate, fold_query, repeated_subplans
+from .utils.redis_store import FakeRedis, RedisBackend
+from .utils.result_store import Compression, ResultStore
+from .utils.snapshot import Snapshot, annotation_signature, write_snapshot
+from .utils.warmup import WarmUp
 
 
 class TestImportData(TestCase):
@@ -111,6 +130,138 @@ class TestQuery(TestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    def test_result_rows(self):
+        """
+        Row windows should match the full result
+        :return:
+        """
+        response = self.client.post(reverse("queryapp:queryapp"), data={
+            "query": "AT5G65210",
+            "limit": 5
+        })
+
+        result = json.loads(response.content)
+        request_id = result['request_id']
+
+        self.assertEqual(len(result['result']['data']), HEADER_ROWS + 5)
+
+        full = json.loads(self.client.get(reverse("queryapp:queryapp") + request_id + "/").content)
+
+        response = self.client.get(reverse("queryapp:queryapp") + f"rows/{request_id}/",
+                                   data={"offset": 5, "limit": 10})
+        rows = json.loads(response.content)
+
+        self.assertEqual(rows['total'], result['result']['total'])
+        self.assertListEqual(rows['data'], full['result']['data'][HEADER_ROWS + 5:HEADER_ROWS + 15])
+
+        response = self.client.get(reverse("queryapp:queryapp") + f"rows/{request_id}.ndjson")
+        lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(len(lines), rows['total'] + 1)
+
+    def test_result_arrow(self):
+        """
+        Arrow response should have the same data as the JSON response
+        :return:
+        """
+        response = self.client.post(reverse("queryapp:queryapp"), data={"query": "AT5G65210"})
+        result = json.loads(response.content)
+        request_id = result['request_id']
+
+        response = self.client.get(reverse("queryapp:queryapp") + request_id + "/",
+                                   HTTP_ACCEPT='application/vnd.apache.arrow.stream')
+
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+
+        table = pa.ipc.open_stream(response.content).read_all()
+        arrow_result = json.loads(table.schema.metadata[b'result'])
+
+        self.assertListEqual(arrow_result['result']['header'], result['result']['data'][:HEADER_ROWS])
+        self.assertListEqual([list(r.values()) for r in table.to_pylist()], result['result']['data'][HEADER_ROWS:])
+        self.assertListEqual(arrow_result['result']['columns'], result['result']['columns'])
+
+    def test_edge_store(self):
+        """
+        Edge store should hold the same edges as the database
+        :return:
+        """
+        analysis = Analysis.objects.get(tf__gene_id="AT5G65210")
+
+        targets, analyses = edge_store.interactions([analysis.pk])
+
+        self.assertEqual(set(targets), set(analysis.interaction_set.values_list('target_id', flat=True)))
+        self.assertTrue((analyses == analysis.pk).all())
+
+        reg_analyses, reg_targets, p_values, fold_changes = edge_store.regulation([analysis.pk])
+
+        self.assertEqual(len(reg_targets), analysis.regulation_set.count())
+
+    def test_sparse_engine(self):
+        """
+        Sparse engine should give the same results as the pandas engine
+        :return:
+        """
+
+        def strip_uuid(df):
+            df = df.copy()
+            df.columns = pd.MultiIndex.from_tuples((c[0][:2], *c[1:]) for c in df.columns)
+            return df
+
+        queries = [
+            "AT5G65210",
+            "AT5G65210[pvalue<0.05]",
+            "AT5G65210 and not AT5G65210[log2fc>0]",
+            "AT5G65210[log2fc>0] or AT5G65210[log2fc<0]",
+            "AT5G65210 or not AT5G65210[log2fc>0]",
+            "all_tfs",
+            "all_tfs[EXPERIMENT_TYPE=Expression] or AT5G65210",
+        ]
+
+        for query in queries:
+            with self.subTest(query=query):
+                with self.settings(QUERY_ENGINE='pandas'):
+                    expected = strip_uuid(parse_query(query))
+                with self.settings(QUERY_ENGINE='sparse'):
+                    result = strip_uuid(parse_query(query))
+
+                pd.testing.assert_frame_equal(result, expected, check_names=False)
+
+    def test_modifier_pushdown(self):
+        """
+        Modifiers applied to the edges should give the same result as on the pivoted frame
+        :return:
+        """
+
+        def strip_names(df):
+            df = df.copy()
+            df.columns = pd.MultiIndex.from_tuples((c[0][0], *c[1:]) for c in df.columns)
+            return df
+
+        queries = [
+            "AT5G65210[pvalue<0.05]",
+            "AT5G65210[not log2fc>0 or EXPERIMENT_TYPE=Expression]",
+            "AT5G65210[log2fc!=0]",
+            "all_tfs[EXPERIMENT_TYPE=Expression and pvalue<0.05]",
+        ]
+
+        for query in queries:
+            with self.subTest(query=query):
+                plan = compile_query(query)
+
+                expected = get_tf(plan.operand)
+                expected = expected[get_mod(expected, plan.modifier)].dropna(how='all').dropna(how='all', axis=1)
+
+                pd.testing.assert_frame_equal(strip_names(get_tf(plan)), strip_names(expected), check_names=False)
+
+    def test_repeated_subquery(self):
+        """
+        Repeated sub-queries are evaluated once but still get their own columns
+        :return:
+        """
+        result = parse_query("AT5G65210[pvalue<0.05] or AT5G65210[pvalue<0.05]")
+
+        self.assertEqual(result.columns.get_level_values(0).nunique(), 2)
+
 
 class TestNetworkParsing(TestCase):
     def test_good_file(self):
@@ -134,3 +285,508 @@ class TestNetworkParsing(TestCase):
 
         with self.assertRaises(BadNetwork):
             get_network(buff)
+
+
+class TestSnapshot(TestCase):
+    def test_annotation_signature(self):
+        annotation = Annotation.objects.create(gene_id='AT1G01010', name='NAC001')
+        signature = annotation_signature()
+
+        annotation.name = 'NAC1'
+        annotation.save()
+        DataVersion.objects.create(reason='annotations: updated in place')
+
+        self.assertNotEqual(annotation_signature(), signature, "updates in place should change the signature")
+
+    def test_frame_round_trip(self):
+        anno = pd.DataFrame({'Full Name': ['a', ''], 'Name': ['A', 'B'], 'id': [1, 2]},
+                            index=pd.Index(['AT1G01010', 'AT1G01020'], name='TARGET'))
+        motifs = pd.DataFrame([[1, 0], [0, 2]],
+                              index=pd.MultiIndex.from_tuples([('AT1G01010', 'promoter', 'M1'),
+                                                               ('AT1G01020', 'cds', 'M2')]))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'snapshot')
+            write_snapshot(path, {'analysis': np.array([1, 1, 2], dtype=np.int32)},
+                           pd.DataFrame({'ANALYSIS': [1, 2], 'tf_id': [1, 2], 'TF': ['AT1G01010', 'AT1G01020']}),
+                           anno, {'motifs': motifs}, {'analyses': [1, 2]})
+
+            snapshot = Snapshot(path)
+
+            self.assertTrue(snapshot.is_current('analyses', [1, 2]))
+            self.assertFalse(snapshot.is_current('analyses', [1, 2, 3]))
+            self.assertTrue(snapshot.annotations().equals(anno), "annotations should survive round trip")
+            self.assertTrue(snapshot.motifs('motifs').equals(motifs), "motif counts should survive round trip")
+            self.assertListEqual(snapshot.edges()['analysis'].tolist(), [1, 1, 2])
+
+
+class TestResultStore(TestCase):
+    def test_round_trip(self):
+        columns = pd.MultiIndex.from_tuples([(('AT1G01010', '', 'uid'), 1, 'EDGE'),
+                                             (('AT1G01010', '', 'uid'), 1, 'Pvalue'),
+                                             (('AT1G01010', '', 'uid'), 1, 'Log2FC')])
+        df = pd.DataFrame([['+', np.nan, 1.5], [np.nan, 0.01, np.nan]], columns=columns,
+                          index=pd.Index(['AT1G01020', 'AT1G01030'], name='TARGET'))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ResultStore(tmp_dir, timeout=60)
+            store.set_many({'uid/tabular_output': df, 'uid/analysis_ids': {'a': 1}})
+
+            self.assertTrue(store.get('uid/tabular_output').equals(df), "data frame should survive round trip")
+            self.assertTrue(store.get('uid/tabular_output', columns=EDGE_COLUMNS).equals(df.loc[:, EDGE_COLUMNS]),
+                            "should read a subset of columns")
+            self.assertDictEqual(store.get_many(['uid/analysis_ids', 'uid/missing']),
+                                 {'uid/analysis_ids': {'a': 1}})
+
+            store.delete_many(['uid/analysis_ids'])
+            self.assertIsNone(store.get('uid/analysis_ids'))
+
+    def test_categorical(self):
+        df = pd.DataFrame({'EDGE': pd.Series(['+', np.nan, '*'], dtype=EDGE_DTYPE),
+                           'ADD_EDGES': pd.Categorical([np.nan, 'DAP', 'DAP,ampDAP']),
+                           'Pvalue': [np.nan, 0.01, 0.5]})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ResultStore(tmp_dir, timeout=60)
+            store.set('uid/tabular_output', df)
+
+            result = store.get('uid/tabular_output')
+            self.assertTrue(result.equals(df), "categorical columns should survive round trip")
+            self.assertListEqual(result['EDGE'].cat.categories.tolist(), ['*', '+'])
+            self.assertTrue(store.get('uid/tabular_output', columns=['ADD_EDGES']).equals(df[['ADD_EDGES']]),
+                            "should read a subset of categorical columns")
+
+    def test_expire(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ResultStore(tmp_dir, timeout=-1)
+            store.set('uid/query', 'AT1G01010')
+
+            self.assertIsNone(store.get('uid/query'), "expired entry should be missing")
+
+            store.cull(force=True)
+            self.assertListEqual(os.listdir(tmp_dir), [])
+
+    def test_memory(self):
+        df = pd.DataFrame({'EDGE': ['+', np.nan], 'Pvalue': [np.nan, 0.01]})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ResultStore(tmp_dir, timeout=60, memory_limit=2 ** 20)
+            other = ResultStore(tmp_dir, timeout=60, memory_limit=2 ** 20)
+
+            store.set('uid/tabular_output', df)
+            cached = store.get('uid/tabular_output')
+            cached.iloc[0, 0] = '-'
+
+            self.assertTrue(store.get('uid/tabular_output').equals(df), "values in memory should not be changed")
+
+            other.set('uid/tabular_output', cached)
+            self.assertTrue(store.get('uid/tabular_output').equals(cached), "should see writes of other processes")
+
+            partial = ResultStore(tmp_dir, timeout=60, memory_limit=2 ** 20)
+            self.assertTrue(partial.get('uid/tabular_output', columns=['Pvalue']).equals(cached[['Pvalue']]))
+            self.assertDictEqual(dict(partial._memory), {}, "partial reads should not be kept in memory")
+
+            store.delete('uid/tabular_output')
+            self.assertIsNone(store.get('uid/tabular_output'))
+
+            store.memory_limit = 100
+            store.set_many({'uid/a': 'a' * 60, 'uid/b': 'b' * 60})
+            self.assertListEqual([os.path.basename(p) for p in store._memory], ['b'],
+                                 "least recently used should be evicted")
+
+    def test_derive(self):
+        calls = []
+
+        def add(uid, a, b=None):
+            calls.append(uid)
+            return a + (b or 0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ResultStore(tmp_dir, timeout=60, memory_limit=2 ** 20)
+            store.derive('sum', add, ('a',), optional=('b',))
+
+            self.assertIsNone(store.get('uid/sum'), "missing without its sources")
+
+            store.set('uid/a', 1)
+            self.assertEqual(store.get('uid/sum'), 1)
+
+            store.set('uid/b', 2)
+            self.assertEqual(store.get('uid/sum'), 3, "should be derived again after a source changes")
+            self.assertEqual(store.get('uid/sum'), 3)
+            self.assertListEqual(calls, ['uid', 'uid'])
+
+            self.assertNotIn('sum', os.listdir(os.path.join(tmp_dir, 'uid')), "derived values are not stored")
+
+    def test_get_parts(self):
+        calls = []
+
+        def square(parts):
+            calls.append(parts)
+            return [p ** 2 for p in parts]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ResultStore(tmp_dir, timeout=60)
+
+            self.assertListEqual(store.get_parts('uid/squares', [1, 2, 3], square), [1, 4, 9])
+            self.assertListEqual(store.get_parts('uid/squares', [3, 1], square), [9, 1])
+            self.assertListEqual(store.get_parts('uid/squares', [2, 4], square), [4, 16])
+            self.assertListEqual(calls, [[1, 2, 3], [4]], "only missing parts should be computed")
+
+    def test_get_parts_concurrent(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for store in (ResultStore(tmp_dir, timeout=60), ResultStore('fake://', timeout=60)):
+                def square(parts):
+                    if parts == [1]:  # another request stores its parts meanwhile
+                        store.get_parts('uid/squares', [2], square)
+                    return [p ** 2 for p in parts]
+
+                store.get_parts('uid/squares', [1], square)
+
+                self.assertDictEqual(store.get('uid/squares'), {1: 1, 2: 4}, "parts stored meanwhile should be kept")
+
+    def test_link(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ResultStore(tmp_dir, timeout=60)
+
+            self.assertFalse(store.link('uid/a', 'shared/a'), "nothing to link to")
+
+            df = pd.DataFrame({'a': [1.0, 2.0]})
+            store.set('shared/a', df)
+
+            self.assertTrue(store.link('uid/a', 'shared/a'))
+            pd.testing.assert_frame_equal(store.get('uid/a'), df)
+
+            store.set('uid/a', df * 2)
+            pd.testing.assert_frame_equal(store.get('shared/a'), df)
+
+    def test_compression(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'EDGE': np.where(rng.random(10000) < 0.5, '+', None),
+                           'Pvalue': np.where(rng.random(10000) < 0.5, rng.random(10000), np.nan),
+                           'Log2FC': np.nan})
+        networks = [('AT1G01010', 'AT1G01020')] * 10000
+
+        for codec in ('zstd', 'lz4'):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                store = ResultStore(tmp_dir, timeout=60, compression=Compression(codec, threshold=1000))
+                store.set_many({'uid/tabular_output': df, 'uid/network': networks, 'uid/query': 'AT1G01010'})
+
+                pd.testing.assert_frame_equal(store.get('uid/tabular_output'), df)
+                pd.testing.assert_frame_equal(store.get('uid/tabular_output', columns=['Log2FC', 'EDGE']),
+                                              df[['Log2FC', 'EDGE']])
+                self.assertListEqual(store.get('uid/network'), networks)
+                self.assertEqual(store.get('uid/query'), 'AT1G01010')
+
+                stats = store.stats()
+                self.assertEqual(stats['written'], 3)
+                self.assertEqual(stats['compressed'], 2, "small values should not be compressed")
+                self.assertEqual(stats['read'], 4)
+                self.assertGreater(stats['saved_bytes'], 0)
+
+                plain = ResultStore(tmp_dir, timeout=60)
+                self.assertListEqual(plain.get('uid/network'), networks, "should read any codec")
+
+
+class TestRedisResultStore(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.client = FakeRedis(clock=lambda: self.now)
+
+    def make_store(self, **kwargs) -> ResultStore:
+        store = ResultStore('fake://', timeout=60, **kwargs)
+        store.backend = RedisBackend(self.client, timeout=60, chunk_size=1000)
+        return store
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'EDGE': np.where(rng.random(1000) < 0.5, '+', None), 'Pvalue': rng.random(1000)})
+
+        store = self.make_store()
+        store.set('uid/tabular_output', df)
+
+        chunks = [k for k in self.client._data if ':chunk:' in k]
+        self.assertGreater(len(chunks), 1, "large values should be split in chunks")
+
+        pd.testing.assert_frame_equal(store.get('uid/tabular_output'), df)
+        pd.testing.assert_frame_equal(store.get('uid/tabular_output', columns=['Pvalue']), df[['Pvalue']])
+
+        other = self.make_store(memory_limit=2 ** 20)
+        other.set('uid/query', 'AT1G01010')
+        self.assertEqual(store.get('uid/query'), 'AT1G01010', "should see writes of other stores")
+
+        store.delete('uid/query')
+        self.assertIsNone(other.get('uid/query'))
+
+    def test_expire(self):
+        store = self.make_store()
+        store.set('shared/a', 'a' * 5000)
+
+        self.now = 50
+        self.assertTrue(store.link('uid/a', 'shared/a'))
+
+        self.now = 100
+        self.assertEqual(store.get('uid/a'), 'a' * 5000, "linking should keep both keys")
+        self.assertTrue(store.touch('shared/a'))
+
+        self.now = 200
+        self.assertIsNone(store.get('uid/a'))
+        self.assertFalse(store.touch('uid/a'))
+        self.assertFalse(any(self.client.mget(list(self.client._data))), "everything should expire")
+
+
+class TestWarmUp(TestCase):
+    def test_run(self):
+        def fail():
+            raise ValueError('no data')
+
+        warm_up = WarmUp([])
+        warm_up.steps = lambda: [('ok', lambda: None), ('fail', fail)]
+        warm_up.run()
+
+        status = warm_up.status()
+
+        self.assertTrue(status['ready'])
+        self.assertEqual(status['done'], 2)
+        self.assertDictEqual(status['errors'], {'fail': 'no data'})
+
+    def test_ready_view(self):
+        response = self.client.get(reverse("queryapp:queryapp") + "ready/")
+        status = json.loads(response.content)
+
+        self.assertEqual(response.status_code, 200 if status['ready'] else 503)
+        self.assertIn(status['state'], ('idle', 'running', 'done'))
+
+
+class TestQueryJobs(TestCase):
+    def test_progress(self):
+        reports = []
+
+        with tracking(Progress(lambda phase, percent: reports.append((phase, percent)), interval=0)):
+            set_total(2)
+            report('parse')
+            report('fetch', step=True)
+            report('fetch', step=True)
+            report('pivot', step=True)
+            report('format')
+
+        report('filter')  # not tracked
+
+        self.assertListEqual(reports, [('parse', 0), ('fetch', 27.5), ('fetch', 50), ('pivot', 60), ('format', 85)])
+
+    def test_run_heavy(self):
+        jobs = QueryJobs(workers=0)
+
+        self.assertEqual(jobs.run_heavy(sum, [1, 2]).result(), 3)
+        with self.assertRaises(TypeError):
+            jobs.run_heavy(sum, None).result()
+
+    def test_failed_job(self):
+        request_id = str(uuid4())
+        jobs = QueryJobs(workers=0)
+
+        future = jobs.submit(request_id, 'AT1G99999', [], {}, ['bad genes'])
+        self.assertIsNone(future.result(), "failed jobs have no result")
+
+        job = get_job(request_id)
+        self.assertEqual(job['state'], 'failed')
+        self.assertEqual(job['status'], 404)
+        self.assertListEqual(job['errors'], ['bad genes'])
+
+        response = self.client.get(reverse("queryapp:queryapp") + f"jobs/{request_id}/")
+        self.assertEqual(json.loads(response.content)['state'], 'failed')
+
+        response = self.client.get(reverse("queryapp:queryapp") + f"{request_id}/")
+        self.assertEqual(response.status_code, 404, "views of failed jobs should be not found")
+
+        response = self.client.get(reverse("queryapp:queryapp") + f"jobs/{uuid4()}/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_bad_query(self):
+        response = self.client.post(reverse("queryapp:queryapp"), data={"query": "AT5G65210 and ("})
+
+        self.assertEqual(response.status_code, 400, "queries that don't parse are bad requests")
+
+    def test_running_job(self):
+        request_id = str(uuid4())
+        update_job(request_id, state='running')
+
+        response = self.client.get(reverse("queryapp:queryapp") + f"stats/{request_id}/")
+        self.assertEqual(response.status_code, 503, "views should not wait for running jobs")
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(json.loads(response.content)['state'], 'running')
+
+    def test_estimate(self):
+        empty = np.array([], dtype=np.int64)
+        data = EdgeArrays(
+            analysis=np.array([1, 1, 1, 2, 2, 3]),
+            target=np.array([10, 11, 12, 12, 13, 10]),
+            reg_analysis=np.array([2, 2]),
+            reg_target=np.array([12, 13]),
+            p_value=empty,
+            log2fc=empty,
+            analyses=pd.DataFrame({'ANALYSIS': [1, 2, 3], 'tf_id': [1, 1, 2], 'TF': ['AT1G01010', 'AT1G01010',
+                                                                                 'AT2G01010']}))
+        tf_counts = count_tfs(data)
+
+        self.assertDictEqual(tf_counts.counts.to_dict('index'), {
+            'AT1G01010': {'columns': 3, 'targets': 4},
+            'AT2G01010': {'columns': 1, 'targets': 1}
+        })
+        self.assertEqual(tf_counts.targets, 4)
+
+        def estimate(query, **kwargs):
+            return tuple(estimate_plan(compile_query(query), tf_counts, **kwargs))
+
+        self.assertTupleEqual(estimate("at1g01010[pvalue<0.05]"), (4, 10))
+        self.assertTupleEqual(estimate("AT1G01010 and AT2G01010"), (1, 11))
+        self.assertTupleEqual(estimate("AT1G01010 or AT2G01010"), (4, 11))
+        self.assertTupleEqual(estimate("all_tfs"), (4, 11))
+        self.assertTupleEqual(estimate("all_tfs", tf_filter_list=pd.Series(['at2g01010'])), (1, 8))
+        self.assertTupleEqual(estimate("AT1G01010", target_filter_list=pd.Series(['AT5G01010'])), (1, 10))
+
+
+class TestQueryPlan(TestCase):
+    def test_plan_cache(self):
+        compile_query("AT5G65210 and  AT4G36540[pvalue<0.05]")
+        hits = plan_cache_info().hits
+
+        plan = compile_query(" AT5G65210 and AT4G36540[pvalue<0.05] ")
+
+        self.assertEqual(plan_cache_info().hits, hits + 1, "whitespace should not matter")
+        self.assertIsInstance(plan, BinOp)
+        self.assertEqual(plan.right.text, "pvalue < 0.05")
+
+        self.assertEqual(compile_query("at5g65210 AND at4g36540[pvalue<0.05]"), plan)
+        self.assertEqual(plan_cache_info().hits, hits + 2, "case of gene names and operators should not matter")
+
+        plan = compile_query("AT5G65210[EXPERIMENT_TYPE=Expression]")
+        self.assertEqual(compile_query("at5g65210[experiment_type=expression]").text, "experiment_type = expression",
+                         "modifiers are kept as written")
+        self.assertEqual(plan.text, "EXPERIMENT_TYPE = Expression")
+
+        self.assertEqual(fold_query("NOT (AT1G01010 OR 'At2g01010'){Name=Abc}"),
+                         "not (at1g01010 or 'At2g01010'){Name=Abc}")
+        self.assertEqual(fold_query("expand('$filter_tf', 'OR')"), "expand('$filter_tf', 'OR')")
+
+    def test_repeated_subplans(self):
+        plan = compile_query("(AT5G65210 and AT4G36540) or (at5g65210 and AT4G36540)[pvalue<0.05]")
+
+        self.assertIn(plan.left, repeated_subplans(plan))
+        self.assertIn(Gene("AT5G65210"), repeated_subplans(plan))
+        self.assertNotIn(plan, repeated_subplans(plan))
+
+
+class TestModifier(TestCase):
+    def test_mod_mask(self):
+        """
+        Masks should apply to whole (TF, analysis) groups
+        :return:
+        """
+        name = ('AT5G65210', '', 'a')
+        df = TargetFrame([[np.nan, 0.01, 1.0, '+'],
+                          ['*', 0.5, np.nan, np.nan]],
+                         index=pd.Index(['AT1G01010', 'AT1G01020'], name='TARGET'),
+                         columns=pd.MultiIndex.from_tuples([(name, 1, 'EDGE'), (name, 1, 'Pvalue'),
+                                                            (name, 1, 'Log2FC'), (name, 2, 'EDGE')]))
+
+        mask = get_mod(df, compile_query("AT5G65210[pvalue<0.05 or id=2]").modifier)
+
+        self.assertListEqual(mask.values.tolist(), [[True, True, True, True],
+                                                    [False, False, False, True]])
+
+        mask = get_mod(df, ModNot(Predicate('log2fc', '>', 0)))
+
+        self.assertListEqual(mask.values.tolist(), [[False, False, False, True],
+                                                    [True, True, True, True]])
+
+
+class TestColumnStats(TestCase):
+    def test_reorder(self):
+        a, b = ('AT4G36540', '', 'a'), ('AT5G65210', '', 'b')
+        columns = pd.MultiIndex.from_tuples([(a, 1, 'EDGE'), (a, 2, 'Pvalue'), (a, 2, 'Log2FC'), (b, 3, 'EDGE')])
+        df = TargetFrame([['+', 0.01, -1.5, '+'], [np.nan, 0.5, 2.0, '+'], [np.nan, np.nan, np.nan, '+']],
+                         columns=columns, index=pd.Index(['AT1G01010', 'AT1G01020', 'AT1G01030'], name='TARGET'))
+
+        stats = column_stats(df)
+
+        self.assertListEqual(stats.row_counts.tolist(), [3, 2, 1])
+        self.assertDictEqual(get_total(df, stats).to_dict(), {(a, 1): 1, (a, 2): 2, (b, 3): 3})
+        self.assertListEqual(induce_repress_count(df, stats).to_numpy().tolist(), [[1], [1]])
+
+        result = reorder_data(df, stats)
+        self.assertListEqual(list(result.columns), [(a, 2, 'Pvalue'), (a, 2, 'Log2FC'), (a, 1, 'EDGE'), (b, 3, 'EDGE')],
+                             "TFs with as many edges keep their order")
+
+
+class TestBuildTargetFrame(TestCase):
+    def test_same_as_pivot(self):
+        df = pd.DataFrame({
+            'TARGET': ['AT1G01020', 'AT1G01010', 'AT1G01010', 'AT1G01030', 'AT1G01020'],
+            'ANALYSIS': [3, 3, 1, 2, 2],
+            'TF': ['AT5G65210', 'AT5G65210', 'AT4G36540', 'AT4G36540', 'AT4G36540'],
+            'EDGE': ['+', '+', np.nan, '*', '*'],
+            'Pvalue': [np.nan, np.nan, 0.01, np.nan, np.nan],
+            'Log2FC': [np.nan, np.nan, -1.5, np.nan, np.nan]
+        })
+
+        expected = (df.set_index(['TF', 'ANALYSIS', 'TARGET'])
+                    .unstack(level=[0, 1])
+                    .reorder_levels([1, 2, 0], axis=1)
+                    .sort_index(axis=1, level=[0, 1], sort_remaining=False)
+                    .dropna(how='all', axis=1))
+
+        result = build_target_frame(df, df['TF'])
+
+        self.assertIsInstance(result, TargetFrame)
+        self.assertListEqual([(c[0][0], *c[1:]) for c in result.columns], list(expected.columns))
+        self.assertEqual(result.index.name, 'TARGET')
+        self.assertTrue(result.set_axis(expected.columns, axis=1).astype(expected.dtypes).equals(expected))
+        self.assertTrue((result.dtypes[result.columns.get_level_values(2) == 'EDGE'] == 'category').all(),
+                        "edges should be categorical")
+
+        result = build_target_frame(df[df['TF'] == 'AT5G65210'], 'AT5G65210')
+
+        self.assertListEqual([c[1:] for c in result.columns], [(3, 'EDGE')])
+        self.assertListEqual(result.index.tolist(), ['AT1G01010', 'AT1G01020'])
+
+
+class TestMetadataIndex(TestCase):
+    def test_metadata_index(self):
+        tf = Annotation.objects.create(gene_id='AT5G65210', name='TGA1')
+        analysis = Analysis.objects.create(tf=tf)
+        AnalysisData.objects.create(analysis=analysis, key=MetaKey.objects.create(name='EXPERIMENT_TYPE'),
+                                    value='Expression')
+
+        metadata_index.invalidate()
+        self.assertIsNotNone(metadata_index.data, "index should load before the lookups")
+
+        with self.assertNumQueries(0):
+            self.assertListEqual(metadata_index.ids('experiment_type', 'EXPRESSION').tolist(), [analysis.pk])
+            self.assertEqual(metadata_index.ids('EXPERIMENT_TYPE', 'Binding').size, 0)
+            self.assertEqual(metadata_index.ids('GENOTYPE', 'Col').size, 0)
+            metadata = metadata_index.metadata([analysis.pk])
+
+        self.assertTrue(metadata.equals(get_metadata([analysis.pk])))
+
+
+class TestDataVersion(TestCase):
+    def test_version_change(self):
+        watcher = DataVersionWatcher(interval=0)
+        version = watcher.version
+
+        generation = edge_store.generation
+        DataVersion.objects.create(reason='import in another process')
+
+        self.assertGreater(watcher.version, version, "version should only go up")
+        self.assertGreater(edge_store.generation, generation, "edge store should be dropped after a version change")
+
+    def test_bump(self):
+        watcher = DataVersionWatcher(interval=3600)
+        version = watcher.version
+
+        new = watcher.bump('test')
+        self.assertGreater(new, version)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(watcher.version, new)
+
@@ -19,7 +19,10 @@ register_converter(FloatConverter, 'float')
 urlpatterns = [
     path('', views.QueryView.as_view(), name="queryapp"),
     path('<uuid:request_id>/', views.QueryView.as_view()),
+    path('rows/<uuid:request_id>/', views.RowsView.as_view()),
+    path('rows/<uuid:request_id>.ndjson', views.RowsStreamView.as_view()),
     path('ids/<uuid:request_id>/', views.EditQueryView.as_view()),
+    path('jobs/<uuid:request_id>/', views.JobView.as_view()),
     path('network/<uuid:request_id>/', views.NetworkJSONView.as_view()),
     path('network/<uuid:request_id>.sif', views.NetworkSifView.as_view()),
     path('stats/<uuid:request_id>/', views.StatsView.as_view()),
@@ -50,5 +53,6 @@ urlpatterns = [
     path('aupr/<uuid:request_id>/', views.NetworkAuprView.as_view()),
     path('aupr/<uuid:request_id>/pruned/<float:cutoff>/', views.NetworkPrunedView.as_view()),
     path('sungear/<uuid:request_id>/', sungear_app.views.SungearView.as_view()),
-    path('list_download/<str:list_name>/', views.ListDownloadView.as_view())
+    path('list_download/<str:list_name>/', views.ListDownloadView.as_view()),
+    path('ready/', views.ReadyView.as_view())
 ]
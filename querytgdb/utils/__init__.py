@@ -21,6 +21,7 @@ from fontTools.ttLib import TTFont
 from lxml import etree
 
 from querytgdb.models import Analysis, AnalysisData, Annotation
+from querytgdb.utils.snapshot import annotation_signature, get_snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -136,6 +137,10 @@ def svg_font_adder(buff: io.BytesIO) -> io.BytesIO:
     return buff
 
 
+# columns of the query result used after the query, see clear_data
+EDGE_COLUMNS = (slice(None), slice(None), ['EDGE', 'Log2FC'])
+
+
 def clear_data(df: pd.DataFrame, drop: bool = True) -> pd.DataFrame:
     """
     Remove unneeded columns when doing later calculations
@@ -143,7 +148,7 @@ def clear_data(df: pd.DataFrame, drop: bool = True) -> pd.DataFrame:
     :param drop:
     :return:
     """
-    df = df.loc[:, (slice(None), slice(None), ['EDGE', 'Log2FC'])]
+    df = df.loc[:, EDGE_COLUMNS]
     if drop:
         df.columns = df.columns.droplevel(2)
 
@@ -156,36 +161,29 @@ def data_to_edges(df: pd.DataFrame) -> pd.DataFrame:
     :param df:
     :return:
     """
-    df = df.loc[:, (slice(None), slice(None), ['EDGE', 'Log2FC'])]
+    df = df.loc[:, EDGE_COLUMNS]
 
     edge_types = dict(AnalysisData.objects.filter(
         key__name='EDGE_TYPE',
         analysis_id__in=df.columns.get_level_values(1)
     ).values_list('analysis_id', 'value'))
 
-    def set_edge_name(s):
-        try:
-            edge_type = edge_types[s.name[1]]
-        except KeyError:
-            edge_type = 'edge'
+    edge_type = np.array([edge_types.get(a, 'edge') for a in df.columns.get_level_values(1)], dtype=object)
+    fold_change = (df.columns.get_level_values(2) == 'Log2FC')
 
-        c = pd.Series(index=s.index, dtype=str)
+    edges = np.empty(df.shape, dtype=object)
+    edges.fill(np.nan)
 
-        if s.name[2] == 'Log2FC':
-            c = c.mask(s >= 0, edge_type + ':INDUCED')
-            c = c.mask(s < 0, edge_type + ':REPRESSED')
+    fc = df.loc[:, fold_change].to_numpy(dtype=np.float64)
+    induced, repressed = fc >= 0, fc < 0
+    edges[:, fold_change] = np.where(induced, edge_type[fold_change] + ':INDUCED',
+                                     np.where(repressed, edge_type[fold_change] + ':REPRESSED', np.nan))
 
-            return c
-        elif (s == "*").any():
-            return s.mask(s.notna(), edge_type + ':EXPRESSION')
-        else:
-            return s.mask(s.notna(), edge_type)
+    edge = df.loc[:, ~fold_change]
+    names = np.where((edge == '*').any(axis=0), edge_type[~fold_change] + ':EXPRESSION', edge_type[~fold_change])
+    edges[:, ~fold_change] = np.where(edge.notna().to_numpy(), names, np.nan)
 
-    df = df.apply(set_edge_name)
-
-    df.columns = df.columns.droplevel(2)
-
-    return df
+    return pd.DataFrame(edges, index=df.index, columns=df.columns.droplevel(2))
 
 
 def get_size(func: Callable[..., Sized]) -> Callable[..., Sized]:
@@ -252,7 +250,7 @@ def skip_for_management(func):
     return f
 
 
-def get_annotations():
+def read_annotations():
     try:
         anno = pd.DataFrame(
             Annotation.objects.values_list(
@@ -266,6 +264,19 @@ def get_annotations():
     return anno
 
 
+def get_annotations():
+    snapshot = get_snapshot()
+
+    if snapshot is not None:
+        try:
+            if snapshot.is_current('annotations', annotation_signature()):
+                return snapshot.annotations()
+        except DatabaseError:
+            pass
+
+    return read_annotations()
+
+
 async_loader = AsyncDataLoader()
 async_loader['annotations'] = get_annotations
 
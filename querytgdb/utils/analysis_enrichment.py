@@ -9,14 +9,14 @@ from typing import Dict, List, Optional, Tuple, Union
 from uuid import UUID
 
 import pandas as pd
-from django.core.cache import cache
 from django.http import HttpResponse
 from scipy.special import comb
 from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 
 from querytgdb.utils import async_loader
-from ..utils import clear_data, get_metadata
+from ..utils import EDGE_COLUMNS, clear_data, get_metadata
+from ..utils.result_store import result_store
 
 
 class AnalysisEnrichmentError(ValueError):
@@ -27,13 +27,17 @@ class AnalysisEnrichmentWarning(AnalysisEnrichmentError, UserWarning):
     pass
 
 
-def split_col_name(col_name: Tuple[Tuple[str, str, str], int]) -> Tuple[str, str, str, int]:
+ColName = Tuple[Tuple[str, str, str], int]
+
+
+def split_col_name(col_name: ColName) -> Tuple[str, str, str, int]:
     return col_name[0] + (col_name[1],)
 
 
 def analysis_enrichment(uid: Union[UUID, str], size_limit: int = 100, raise_warning: bool = False) -> Dict:
     try:
-        cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/analysis_ids'])
+        cached_data = result_store.get_many([f'{uid}/tabular_output', f'{uid}/analysis_ids'],
+                                            columns={f'{uid}/tabular_output': EDGE_COLUMNS})
         df, ids = itemgetter(
             f'{uid}/tabular_output',
             f'{uid}/analysis_ids'
@@ -53,11 +57,9 @@ def analysis_enrichment(uid: Union[UUID, str], size_limit: int = 100, raise_warn
         else:
             warnings.warn(e)
 
-    columns = []
-    data = []
     info = []
 
-    background_genes = cache.get(f'{uid}/background_genes')
+    background_genes = result_store.get(f'{uid}/background_genes')
 
     if background_genes is not None:
         background = background_genes.size
@@ -79,25 +81,33 @@ def analysis_enrichment(uid: Union[UUID, str], size_limit: int = 100, raise_warn
 
         info.append((split_col_name(col_name), d))
 
-    for (name1, col1), (name2, col2) in combinations(((name, col.index[col.notna()])
-                                                      for name, col in df.items()), 2):
-        columns.append((
-            split_col_name(name1),
-            split_col_name(name2)
-        ))
+    targets = OrderedDict((name, col.index[col.notna()]) for name, col in df.items())
+
+    def pair_enrichment(pairs: List[Tuple[ColName, ColName]]) -> List[Dict]:
+        pair_data = []
+
+        for name1, name2 in pairs:
+            col1, col2 = targets[name1], targets[name2]
+            common = col1.intersection(col2).sort_values()
+
+            c = (
+                (len(common), len(col1.difference(col2))),
+                (len(col2.difference(col1)), background - len(col1.union(col2)))
+            )
+
+            pair_data.append({
+                'greater': fisher_exact(c, 'greater')[1],
+                'less': fisher_exact(c, 'less')[1],
+                'genes': common
+            })
 
-        common = col1.intersection(col2).sort_values()
+        return pair_data
 
-        c = (
-            (len(common), len(col1.difference(col2))),
-            (len(col2.difference(col1)), background - len(col1.union(col2)))
-        )
+    pairs = list(combinations(targets.keys(), 2))
 
-        data.append({
-            'greater': fisher_exact(c, 'greater')[1],
-            'less': fisher_exact(c, 'less')[1],
-            'genes': common
-        })
+    # parts are pairs of analyses
+    data = result_store.get_parts(f'{uid}/analysis_enrichment_pairs', pairs, pair_enrichment)
+    columns = [(split_col_name(name1), split_col_name(name2)) for name1, name2 in pairs]
 
     p_values = (pd.DataFrame(data)[['less', 'greater']]
                 .apply(lambda x: multipletests(x, method='bonferroni')[1])
@@ -127,11 +137,11 @@ def analysis_enrichment_csv(uid: Union[str, UUID],
     if buffer is None:
         buffer = StringIO()
 
-    enrichment = cache.get(f'{uid}/analysis_enrichment')
+    enrichment = result_store.get(f'{uid}/analysis_enrichment')
 
     if enrichment is None:
         enrichment = analysis_enrichment(uid, size_limit, raise_warning)
-        cache.set(f'{uid}/analysis_enrichment', enrichment)
+        result_store.set(f'{uid}/analysis_enrichment', enrichment)
 
     info = dict(enrichment['info'])
 
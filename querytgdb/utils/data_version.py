@@ -0,0 +1,108 @@
+"""
+Version of the data in the database.
+
+Importing or removing data adds a :class:`~querytgdb.models.DataVersion` row, so the version only goes up. Caches of
+data from the database have the version in their keys.
+
+Each process checks the version at most every ``DATA_VERSION_CHECK_INTERVAL`` seconds. When another process changed
+it, the edge store, metadata index and annotations are dropped and loaded again in the background, and anything
+connected with :meth:`DataVersionWatcher.connect` is told.
+"""
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+from django.conf import settings
+from django.db.models import Max
+from django.db.utils import DatabaseError
+
+from querytgdb.models import DataVersion
+from querytgdb.utils import async_loader, get_annotations
+from querytgdb.utils.edge_store import edge_store, preload_edges
+from querytgdb.utils.metadata_index import metadata_index, preload_metadata
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = getattr(settings, 'DATA_VERSION_CHECK_INTERVAL', 10)
+
+
+def read_version() -> int:
+    try:
+        return DataVersion.objects.aggregate(version=Max('id'))['version'] or 0
+    except DatabaseError:
+        return 0
+
+
+class DataVersionWatcher:
+    """
+    Thread safe, cached data version of this process
+    """
+
+    def __init__(self, interval: float = CHECK_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._checked = 0.0
+        self._listeners: List[Callable[[], None]] = []
+
+    def connect(self, func: Callable[[], None]):
+        """
+        Call func after data is reloaded, it shouldn't block
+        :param func:
+        :return:
+        """
+        self._listeners.append(func)
+
+    def _stale(self, now: float) -> bool:
+        return self._version is None or now - self._checked >= self.interval
+
+    @property
+    def version(self) -> int:
+        now = time.monotonic()
+
+        if self._stale(now):
+            with self._lock:
+                if self._stale(now):
+                    version = read_version()
+
+                    if self._version is not None and version != self._version:
+                        logger.info(f"data version changed from {self._version} to {version}")
+                        self.reload()
+
+                    self._version = version
+                    self._checked = now
+
+        return self._version
+
+    def reload(self):
+        """
+        Drop data loaded from the database and load it again in the background
+        """
+        edge_store.invalidate()
+        metadata_index.invalidate()
+
+        async_loader['annotations'] = get_annotations
+        async_loader['edges'] = preload_edges
+        async_loader['metadata_index'] = preload_metadata
+
+        for func in self._listeners:
+            func()
+
+    def bump(self, reason: str) -> int:
+        """
+        Make a new version after changing data, and reload the data of this process
+        :param reason:
+        :return: new version
+        """
+        version = DataVersion.objects.create(reason=reason[:100]).pk
+
+        with self._lock:
+            self.reload()
+            self._version = version
+            self._checked = time.monotonic()
+
+        return version
+
+
+data_version = DataVersionWatcher()
@@ -0,0 +1,178 @@
+"""
+Process-wide columnar copy of the Interaction and Regulation tables.
+
+Rows are kept in plain numpy arrays sorted by analysis id, so the edges of any set of analyses are a handful of
+contiguous slices found with ``searchsorted`` instead of a round trip to the database.
+"""
+import logging
+import threading
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from querytgdb.models import Analysis, Interaction, Regulation
+from querytgdb.utils import async_loader, skip_for_management
+from querytgdb.utils.snapshot import analysis_signature, get_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class EdgeArrays(NamedTuple):
+    # Interaction table, sorted by analysis
+    analysis: np.ndarray
+    target: np.ndarray
+
+    # Regulation table, sorted by analysis
+    reg_analysis: np.ndarray
+    reg_target: np.ndarray
+    p_value: np.ndarray
+    log2fc: np.ndarray
+
+    # analysis id, tf annotation id and tf gene id
+    analyses: pd.DataFrame
+
+
+def get_slices(sorted_ids: np.ndarray, ids: Optional[Sequence[int]]) -> Optional[np.ndarray]:
+    """
+    Get the positions of rows belonging to ids in an array sorted by id
+    :param sorted_ids:
+    :param ids:
+    :return: None if all rows are requested
+    """
+    if ids is None:
+        return None
+
+    ids = np.unique(np.asarray(ids, dtype=sorted_ids.dtype))
+    starts = np.searchsorted(sorted_ids, ids, side='left')
+    ends = np.searchsorted(sorted_ids, ids, side='right')
+
+    lengths = ends - starts
+
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def sort_by_analysis(analysis: np.ndarray, *columns: np.ndarray) -> Tuple[np.ndarray, ...]:
+    order = np.argsort(analysis, kind='stable')
+    return (analysis[order], *(c[order] for c in columns))
+
+
+class EdgeStore:
+    """
+    Lazily loaded, thread safe edge store
+
+    Call :meth:`invalidate` after changing Interaction or Regulation rows. The next lookup reloads the data.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Optional[EdgeArrays] = None
+        self.generation = 0
+
+    def load(self) -> EdgeArrays:
+        """
+        Load edges from the snapshot if it is up to date, otherwise from the database
+        :return:
+        """
+        snapshot = get_snapshot()
+
+        if snapshot is not None:
+            if snapshot.is_current('analyses', analysis_signature()):
+                logger.info(f"edge store mapped from {snapshot.path}")
+                return EdgeArrays(**snapshot.edges(), analyses=snapshot.analyses())
+
+            logger.warning(f"snapshot at {snapshot.path} is out of date, loading edges from database")
+
+        return self.load_from_database()
+
+    def load_from_database(self) -> EdgeArrays:
+        interaction = pd.DataFrame.from_records(
+            Interaction.objects.values_list('analysis_id', 'target_id').iterator(chunk_size=10000),
+            columns=['analysis', 'target'])
+        regulation = pd.DataFrame.from_records(
+            Regulation.objects.values_list('analysis_id', 'target_id', 'p_value', 'foldchange').iterator(
+                chunk_size=10000),
+            columns=['analysis', 'target', 'p_value', 'log2fc'])
+        analyses = pd.DataFrame.from_records(
+            Analysis.objects.values_list('id', 'tf_id', 'tf__gene_id').iterator(),
+            columns=['ANALYSIS', 'tf_id', 'TF'])
+
+        analysis, target = sort_by_analysis(
+            interaction['analysis'].to_numpy(dtype=np.int32),
+            interaction['target'].to_numpy(dtype=np.int32))
+
+        # p-values and fold changes stay float64: p-values routinely underflow float32 and infinite fold changes
+        # are stored as the largest double
+        reg_analysis, reg_target, p_value, log2fc = sort_by_analysis(
+            regulation['analysis'].to_numpy(dtype=np.int32),
+            regulation['target'].to_numpy(dtype=np.int32),
+            regulation['p_value'].to_numpy(dtype=np.float64),
+            regulation['log2fc'].to_numpy(dtype=np.float64))
+
+        logger.info(f"edge store loaded {analysis.size} interactions {reg_analysis.size} regulations")
+
+        return EdgeArrays(analysis, target, reg_analysis, reg_target, p_value, log2fc, analyses)
+
+    @property
+    def data(self) -> EdgeArrays:
+        data = self._data
+        if data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = self.load()
+                data = self._data
+
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self.generation += 1
+
+    @property
+    def analyses(self) -> pd.DataFrame:
+        """
+        DataFrame of ANALYSIS, tf_id, TF
+        """
+        return self.data.analyses
+
+    def interactions(self, analyses: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get target ids and analysis ids of edges
+        :param analyses: analysis ids, or None for all edges
+        :return:
+        """
+        data = self.data
+        idx = get_slices(data.analysis, analyses)
+
+        if idx is None:
+            return data.target.astype(np.int64), data.analysis.astype(np.int64)
+
+        return data.target[idx].astype(np.int64), data.analysis[idx].astype(np.int64)
+
+    def regulation(self, analyses: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, ...]:
+        """
+        Get analysis ids, target ids, p-values and fold changes of edges
+        :param analyses: analysis ids, or None for all edges
+        :return:
+        """
+        data = self.data
+        idx = get_slices(data.reg_analysis, analyses)
+
+        if idx is None:
+            return (data.reg_analysis.astype(np.int64), data.reg_target.astype(np.int64),
+                    data.p_value.copy(), data.log2fc.copy())
+
+        return (data.reg_analysis[idx].astype(np.int64), data.reg_target[idx].astype(np.int64),
+                data.p_value[idx], data.log2fc[idx])
+
+
+edge_store = EdgeStore()
+
+
+@skip_for_management
+def preload_edges():
+    return edge_store.data
+
+
+async_loader['edges'] = preload_edges
@@ -9,16 +9,16 @@ from uuid import UUID
 
 import numpy as np
 import pandas as pd
-from django.core.cache import cache
 
 from ..utils import column_string, data_to_edges
 from ..utils.parser import expand_ref_ids
+from ..utils.result_store import result_store
 
 __all__ = ('create_export_zip', 'write_excel', 'export_csv')
 
 
 def create_export_zip(uid: Union[str, UUID], out_dir):
-    cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/query'])
+    cached_data = result_store.get_many([f'{uid}/tabular_output', f'{uid}/query'])
     df = cached_data[f'{uid}/tabular_output']
     create_sifs(df, out_dir)
     create_all_tf_genelists(df, out_dir)
@@ -31,12 +31,12 @@ def create_export_zip(uid: Union[str, UUID], out_dir):
 
 def write_excel(uid: Union[str, UUID], out_file):
     with pd.ExcelWriter(out_file, engine='xlsxwriter') as writer:
-        cached_data = cache.get_many([f'{uid}/formatted_tabular_output', f'{uid}/metadata'])
-        data = cached_data[f'{uid}/formatted_tabular_output']
+        cached_data = result_store.get_many([f'{uid}/formatted_tabular_output', f'{uid}/metadata'])
+        formatted, _metadata = cached_data[f'{uid}/formatted_tabular_output']
         metadata = cached_data[f'{uid}/metadata']
         metadata.index.name = None
 
-        write_data(data[2], writer)
+        write_data(formatted.to_list(), writer)
         write_metadata(metadata, writer)
 
 
@@ -121,6 +121,8 @@ group_opt = {
 # Generate sif output
 def create_sifs(result: pd.DataFrame, output):
     df = data_to_edges(result).stack([0, 1])
+    # edges are written as text, filled with '' below
+    result = result.astype({c: object for c, dtype in result.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)})
     result = result.stack([0, 1])
     result["EDGE"] = df
     if "Log2FC" not in result:
@@ -181,7 +183,7 @@ def create_all_tf_genelists(result: pd.DataFrame, output):
 
 
 def export_csv(uid: Union[UUID, str], buff=None) -> IO:
-    data = cache.get_many([f'{uid}/tabular_output', f'{uid}/metadata'])
+    data = result_store.get_many([f'{uid}/tabular_output', f'{uid}/metadata'])
 
     df = data[f'{uid}/tabular_output']
 
@@ -2,7 +2,7 @@ import logging
 import re
 from itertools import groupby, islice, zip_longest
 from operator import itemgetter
-from typing import Any, Dict, Iterable, List, Tuple, Union
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
@@ -11,6 +11,10 @@ from ..utils.parser import Ids
 
 logger = logging.getLogger(__name__)
 
+HEADER_ROWS = 6  # column header rows at the top of formatted data
+DATA_COL_LEN = 8  # annotation and count columns before the analysis columns
+GENE_ID_COL = 7
+
 
 def is_numeric_column(cols: np.ndarray) -> np.ndarray:
     return np.isin(cols, ['User List Count', 'Edge Count', 'Pvalue', 'Log2FC'])
@@ -32,11 +36,11 @@ def get_merge_cells(columns: List[Iterable]) -> List[Dict[str, Any]]:
     """
     columns = list(zip(*columns))
 
-    merged_cells = [{'row': 0, 'col': i, 'colspan': 1, 'rowspan': 6} for i in range(8)]
+    merged_cells = [{'row': 0, 'col': i, 'colspan': 1, 'rowspan': HEADER_ROWS} for i in range(DATA_COL_LEN)]
 
-    for i in range(1, 6):
-        index = 8
-        for label, group in groupby(columns[8:], key=itemgetter(slice(1, i + 1))):
+    for i in range(1, HEADER_ROWS):
+        index = DATA_COL_LEN
+        for label, group in groupby(columns[DATA_COL_LEN:], key=itemgetter(slice(1, i + 1))):
             size = sum(1 for _ in group)
 
             if size > 1:
@@ -85,9 +89,33 @@ def get_edge(a: pd.Series) -> str:
     return 'Edges: {0} {{}}'.format(a.get('EDGE_TYPE', default=''))
 
 
-def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids) -> Tuple[List, List, List]:
+class FormattedResult(NamedTuple):
+    columns: List[Dict[str, Any]]  # column formats
+    merged_cells: List[Dict[str, Any]]
+    header: List[List]  # HEADER_ROWS column header rows
+    data: pd.DataFrame  # data rows, with missing values as NaN
+
+    def rows(self, df: Optional[pd.DataFrame] = None) -> List[List]:
+        """
+        Data rows as lists, with missing values as None
+        :param df: a window of data, all data if None
+        :return:
+        """
+        if df is None:
+            df = self.data
+
+        return df.astype(object).where(df.notna(), None).values.tolist()
+
+    def to_list(self) -> List[List]:
+        """
+        Header rows followed by data rows
+        """
+        return self.header + self.rows()
+
+
+def format_result(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids) -> FormattedResult:
     df = df.reset_index()
-    df.insert(7, 'Gene ID', df.pop('TARGET'))
+    df.insert(GENE_ID_COL, 'Gene ID', df.pop('TARGET'))
 
     col_types = np.fromiter(map(get_col_type, df.columns), 'U20', df.shape[1])
 
@@ -109,9 +137,8 @@ def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids)
 
     # for JSON response, can't have NaN or Inf
     df.loc[:, num_cols] = num_df.mask(np.isinf(num_df), np.nan)
-    df = df.replace({np.nan: None})
 
-    data_col_len = 8
+    data_col_len = DATA_COL_LEN
 
     columns = list(map(list, zip_longest(*((col,) for col in df.columns[:data_col_len]),
                                          *df.columns[data_col_len:])))
@@ -194,4 +221,37 @@ def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids)
             opt['width'] = 1
 
         column_formats.append(opt)
-    return column_formats, merged_cells, columns + df.values.tolist()
+
+    return FormattedResult(column_formats, merged_cells, columns, df)
+
+
+def get_rows(formatted: FormattedResult,
+             offset: int = 0,
+             limit: Optional[int] = None,
+             sort: Optional[int] = None,
+             ascending: bool = True,
+             search: Optional[str] = None) -> Tuple[int, pd.DataFrame]:
+    """
+    Get a window of the data rows of formatted data
+    :param formatted:
+    :param offset:
+    :param limit: number of rows, all rows if None
+    :param sort: column to sort by, empty cells last
+    :param ascending:
+    :param search: only keep rows with a Gene ID containing this, ignoring case
+    :return: number of matching rows, rows in window
+    """
+    df = formatted.data
+
+    if search:
+        df = df[df.iloc[:, GENE_ID_COL].astype(str).str.upper().str.contains(search.upper(), regex=False)]
+
+    if sort is not None:
+        order = df.iloc[:, sort].reset_index(drop=True).sort_values(ascending=ascending, kind='mergesort',
+                                                                    na_position='last')
+        df = df.iloc[order.index, :]
+
+    if limit is None:
+        return df.shape[0], df.iloc[offset:, :]
+
+    return df.shape[0], df.iloc[offset:offset + limit, :]
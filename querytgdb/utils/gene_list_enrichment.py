@@ -2,7 +2,7 @@ import io
 import math
 import sys
 from collections import OrderedDict
-from itertools import count, product
+from itertools import count
 from operator import itemgetter
 from typing import List, Optional, Union
 from uuid import UUID
@@ -12,12 +12,12 @@ import numpy as np
 import pandas as pd
 import scipy.cluster.hierarchy as hierarchy
 import seaborn as sns
-from django.core.cache import cache
 from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 
 from querytgdb.utils import async_loader
 from .parser import filter_df_by_ids
+from .result_store import result_store
 from ..models import Analysis
 from ..utils import clear_data, column_string, get_metadata
 
@@ -73,7 +73,7 @@ def gene_list_enrichment(uid: Union[str, UUID], draw=True, legend=False, use_lab
     :return:
     """
     # raising exception here if target genes are not uploaded by the user
-    cached_data = cache.get_many([
+    cached_data = result_store.get_many([
         f'{uid}/target_genes',
         f'{uid}/tabular_output_unfiltered',
         f'{uid}/background_genes',
@@ -139,20 +139,38 @@ def gene_list_enrichment(uid: Union[str, UUID], draw=True, legend=False, use_lab
             list_enrichment_influence = list_enrichment_pvals.copy()
             list_enrichment_specificity = list_enrichment_pvals.copy()
 
-            colnames = {}
+            colnames = {name: "{} ({})".format(name, len(user_list)) for name, user_list in list_to_name.items()}
 
-            for (analysis_name, analysis_list), (name, user_list) in product(targets.items(), list_to_name.items()):
-                intersect_len = len(analysis_list & user_list)
-                colnames[name] = "{} ({})".format(name, len(user_list))
+            def list_enrichment_rows(analysis_names):
+                rows = []
 
-                odds, pvalue = fisher_exact([
-                    [intersect_len, len(user_list - analysis_list)],
-                    [len(analysis_list - user_list), background - len(user_list | analysis_list)]
-                ], alternative='greater')
-                list_enrichment_pvals.at[analysis_name, name] = pvalue
-                list_enrichment_count.at[analysis_name, name] = intersect_len
-                list_enrichment_influence.at[analysis_name, name] = intersect_len / len(user_list)
-                list_enrichment_specificity.at[analysis_name, name] = intersect_len / len(analysis_list)
+                for analysis_name in analysis_names:
+                    analysis_list = targets[analysis_name]
+                    row = []
+
+                    for user_list in list_to_name.values():
+                        intersect_len = len(analysis_list & user_list)
+
+                        odds, pvalue = fisher_exact([
+                            [intersect_len, len(user_list - analysis_list)],
+                            [len(analysis_list - user_list), background - len(user_list | analysis_list)]
+                        ], alternative='greater')
+
+                        row.append((pvalue, intersect_len, intersect_len / len(user_list),
+                                    intersect_len / len(analysis_list)))
+
+                    rows.append(row)
+
+                return rows
+
+            rows = result_store.get_parts(f'{uid}/list_enrichment_rows', targets.keys(), list_enrichment_rows)
+
+            for analysis_name, row in zip(targets.keys(), rows):
+                for name, (pvalue, intersect_len, influence, specificity) in zip(list_to_name.keys(), row):
+                    list_enrichment_pvals.at[analysis_name, name] = pvalue
+                    list_enrichment_count.at[analysis_name, name] = intersect_len
+                    list_enrichment_influence.at[analysis_name, name] = influence
+                    list_enrichment_specificity.at[analysis_name, name] = specificity
 
             list_enrichment_pvals = list_enrichment_pvals.rename(columns=colnames)
             list_enrichment_count = list_enrichment_count.rename(columns=colnames)
@@ -165,7 +183,7 @@ def gene_list_enrichment(uid: Union[str, UUID], draw=True, legend=False, use_lab
             list_enrichment_pvals = pd.Series(pvalues, index=list_enrichment_pvals.index)
             list_enrichment_pvals = list_enrichment_pvals.unstack()
 
-            cache.set(
+            result_store.set(
                 f'{uid}/list_enrichment_data',
                 (list_enrichment_pvals, list_enrichment_count, list_enrichment_influence, list_enrichment_specificity))
 
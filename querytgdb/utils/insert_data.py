@@ -11,6 +11,7 @@ from django.db.transaction import atomic
 from django.db.utils import IntegrityError
 
 from querytgdb.models import Analysis, AnalysisData, Annotation, EdgeData, EdgeType, Interaction, MetaKey, Regulation, ImportHistory
+from querytgdb.utils.data_version import data_version
 from querytgdb.utils.sif import get_network
 
 logger = logging.getLogger(__name__)
@@ -165,6 +166,8 @@ def insert_data(data_file, metadata_file, sep=',', dry_run=False):
             ) for row in data.itertuples(index=False)
         )
 
+    data_version.bump(f"data: {data_file}")
+
 
 def read_annotation_file(annotation_file: str) -> pd.DataFrame:
     in_anno = pd.read_csv(annotation_file, comment='#').fillna('')
@@ -217,6 +220,8 @@ def import_annotations(annotation_file: str, dry_run: bool = False, delete_exist
             if delete_existing:
                 Annotation.objects.filter(pk__in=to_delete['id']).delete()
 
+        data_version.bump(f"annotations: {annotation_file}")
+
 
 def import_additional_edges(edge_file: str, sif: bool = False, directional: bool = True):
     print(f"Inserting edge file: {edge_file}\n")
@@ -286,3 +291,5 @@ def import_additional_edges(edge_file: str, sif: bool = False, directional: bool
         )
     except IntegrityError as e:
         print(f"Duplicate entry error, skipping edge file: {edge_file.split('/')[-1]}")
+    else:
+        data_version.bump(f"edges: {edge_file}")
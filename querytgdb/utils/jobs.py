@@ -0,0 +1,275 @@
+"""
+Query jobs, run outside of the request that posts them.
+
+A posted query runs as a job in a pool of ``QUERY_JOBS['WORKERS']`` threads, so a long query doesn't run into the
+timeout of the gunicorn worker that took it, and with no workers it runs in the request. With ``'PROCESSES': True``
+jobs run in processes instead, so the pandas work of several queries runs in parallel. Every gunicorn worker starts
+its own pool, and every pool process loads the edges of the database again, so processes multiply the memory of a
+server by up to ``WORKERS + 1``; only use them with few gunicorn workers or a snapshot, see
+:mod:`querytgdb.utils.snapshot`.
+
+The status of a job is kept in the result store as ``{uid}/job``, so any worker can report it:
+
+- state: queued, running, done or failed
+- phase and percent done, see :mod:`querytgdb.utils.progress`
+- error message and response status of a failed job
+- warnings about the uploaded files
+- estimated size of the result, see :mod:`querytgdb.utils.query_cost`
+
+The size of the result of a query is estimated before anything is fetched. Estimates are upper bounds, so they only
+decide how a job runs: queries estimated over ``QUERY_JOBS['HEAVY_CELLS']`` cells run at most
+``QUERY_JOBS['HEAVY_JOBS']`` at a time per server process, the rest stay queued, so a few large queries can't run a
+worker out of memory together. Queries are rejected when their built result is over ``QUERY_JOBS['MAX_CELLS']``
+cells.
+
+Processes only see results through the result store, so jobs of an in-process ``fake://`` store run in threads.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from uuid import UUID
+
+import pyparsing as pp
+from django.conf import settings
+
+from querytgdb.apps import setup_process
+from querytgdb.utils import metadata_to_dict
+from querytgdb.utils.file import BadFile
+from querytgdb.utils.formatter import FormattedResult, format_result
+from querytgdb.utils.parser import Ids, QueryError, compile_query, get_query_result
+from querytgdb.utils.progress import Progress, report, tracking
+from querytgdb.utils.query_cost import Cost, cost_model
+from querytgdb.utils.result_store import result_store
+
+logger = logging.getLogger(__name__)
+
+QUERY_JOBS = {
+    'WORKERS': 2,
+    'PROCESSES': False,
+    'WAIT': 150,  # seconds a request waits for a job, under the gunicorn timeout
+    'POLL_WAIT': 10,  # seconds the views of a result page wait for its job
+    'MAX_CELLS': 50_000_000,
+    'HEAVY_CELLS': 5_000_000,
+    'HEAVY_JOBS': 1,
+    **getattr(settings, 'QUERY_JOBS', {})
+}
+
+JobResult = Tuple[FormattedResult, dict, Ids]
+
+
+def job_key(uid: Union[str, UUID]) -> str:
+    return f'{uid}/job'
+
+
+def get_job(uid: Union[str, UUID]) -> Optional[Dict[str, Any]]:
+    return result_store.get(job_key(uid))
+
+
+def update_job(uid: Union[str, UUID], **status) -> Dict[str, Any]:
+    job = {**(get_job(uid) or {}), **status, 'updated': time.time()}
+    result_store.set(job_key(uid), job)
+
+    return job
+
+
+def estimate_query(query: str, file_opts: Dict[str, Any]) -> Cost:
+    """
+    Estimate the size of the result of a query, raises QueryError if it doesn't parse
+    :param query:
+    :param file_opts: keyword arguments of get_query_result from uploaded files
+    :return:
+    """
+    try:
+        plan = compile_query(query)
+    except pp.ParseException as e:
+        raise QueryError("Could not parse query") from e
+
+    cost = cost_model.estimate(plan,
+                               file_opts.get('tf_filter_list'),
+                               file_opts.get('target_filter_list'),
+                               file_opts.get('user_lists'))
+
+    return cost
+
+
+def run_query(uid: str, query: str, edges: List[str], file_opts: Dict[str, Any]) -> Optional[JobResult]:
+    """
+    Run a query and store its results for the views that come after it
+    :param uid:
+    :param query:
+    :param edges:
+    :param file_opts: keyword arguments of get_query_result from uploaded files
+    :return: formatted result, metadata and analysis ids, None if the query failed
+    """
+    update_job(uid, state='running', started=time.time())
+
+    try:
+        with tracking(Progress(lambda phase, percent: update_job(uid, phase=phase, percent=percent))):
+            result, metadata, stats, _uid, ids = get_query_result(query=query,
+                                                                  edges=edges,
+                                                                  size_limit=QUERY_JOBS['MAX_CELLS'],
+                                                                  uid=uid,
+                                                                  **file_opts)
+            report('format')
+            formatted = format_result(result, stats, metadata, ids)
+            metadata = metadata_to_dict(metadata)
+
+        result_store.set(f'{uid}/query', query.strip() + '\n')  # save queries
+    except (QueryError, BadFile) as e:
+        update_job(uid, state='failed', status=400, error=str(e), finished=time.time())
+        return None
+    except ValueError as e:
+        update_job(uid, state='failed', status=404, error=f'Query not available: {e}', finished=time.time())
+        return None
+    except Exception:
+        logger.exception(f"query job {uid} failed")
+        update_job(uid, state='failed', status=500, error='Query failed', finished=time.time())
+        return None
+
+    update_job(uid, state='done', percent=100, finished=time.time())
+
+    return formatted, metadata, ids
+
+
+class QueryJobs:
+    """
+    Runs query jobs, the pool is started with the first job
+
+    Heavy jobs are passed to the pool by heavy_jobs threads, each waits for its job to finish before passing the
+    next.
+    """
+
+    def __init__(self, workers: int = QUERY_JOBS['WORKERS'], processes: bool = QUERY_JOBS['PROCESSES'],
+                 heavy_cells: int = QUERY_JOBS['HEAVY_CELLS'], heavy_jobs: int = QUERY_JOBS['HEAVY_JOBS']):
+        self.workers = workers
+        self.processes = processes
+        self.heavy_cells = heavy_cells
+        self.heavy_jobs = heavy_jobs
+        self._lock = threading.Lock()
+        self._executor: Optional[Executor] = None
+        self._heavy_executor: Optional[Executor] = None
+        self._futures: Dict[str, Future] = {}  # jobs of this process
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.processes and result_store.backend.shared:
+                    self._executor = ProcessPoolExecutor(self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'),
+                                                         initializer=setup_process,
+                                                         initargs=(settings.DATABASES,))
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='query-job')
+
+            return self._executor
+
+    def _get_heavy_executor(self) -> Executor:
+        with self._lock:
+            if self._heavy_executor is None:
+                self._heavy_executor = ThreadPoolExecutor(self.heavy_jobs, thread_name_prefix='heavy-query-job')
+
+            return self._heavy_executor
+
+    def _run_heavy(self, func: Callable[..., Any], *args) -> Any:
+        return self._get_executor().submit(func, *args).result()
+
+    def run_heavy(self, func: Callable[..., Any], *args) -> Future:
+        """
+        Run other heavy work in the pool, in turn with heavy jobs
+
+        func and args are pickled when jobs run in processes.
+        :param func:
+        :param args:
+        :return: future of the value of func
+        """
+        if self.workers:
+            return self._get_heavy_executor().submit(self._run_heavy, func, *args)
+
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+    def submit(self, uid: Union[str, UUID], query: str, edges: List[str], file_opts: Dict[str, Any],
+               errors: Iterable[str] = (), cost: Optional[Cost] = None) -> Future:
+        """
+        Start a query job
+        :param uid:
+        :param query:
+        :param edges:
+        :param file_opts:
+        :param errors: warnings about uploaded files, kept with the job
+        :param cost: estimated size of the result, see estimate_query
+        :return: future of the formatted result, metadata and analysis ids, None if the query failed
+        """
+        uid = str(uid)
+        estimate = None if cost is None else {**cost._asdict(), 'cells': cost.cells, 'bytes': cost.bytes}
+
+        update_job(uid, state='queued', phase=None, percent=0, errors=list(errors), estimate=estimate,
+                   created=time.time())
+
+        if self.workers and cost is not None and cost.cells > self.heavy_cells:
+            logger.info(f"query job {uid} is heavy, {cost}")
+            future = self._get_heavy_executor().submit(self._run_heavy, run_query, uid, query, edges, file_opts)
+        elif self.workers:
+            future = self._get_executor().submit(run_query, uid, query, edges, file_opts)
+        else:
+            future = Future()
+            future.set_result(run_query(uid, query, edges, file_opts))
+
+        with self._lock:
+            self._futures[uid] = future
+
+        future.add_done_callback(partial(self._done, uid))
+
+        return future
+
+    def _done(self, uid: str, future: Future):
+        with self._lock:
+            self._futures.pop(uid, None)
+
+        try:
+            result = future.result()
+        except Exception:  # the process running it died
+            logger.exception(f"query job {uid} failed")
+            update_job(uid, state='failed', status=500, error='Query failed', finished=time.time())
+            return
+
+        if result is not None:  # keep the formatted result in memory of this process
+            result_store.set(f'{uid}/formatted_tabular_output', result[:2])
+
+    def wait(self, uid: Union[str, UUID], timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Wait for the job of a request to be done or fail, jobs of other processes are polled
+        :param uid:
+        :param timeout: seconds
+        :return: status of the job, None if there is no job
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+
+        with self._lock:
+            future = self._futures.get(str(uid))
+
+        if future is not None:
+            wait([future], timeout)
+
+        while True:
+            job = get_job(uid)
+            remaining = deadline - time.monotonic()
+
+            if job is None or job['state'] in ('done', 'failed') or remaining <= 0:
+                return job
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1)
+
+
+query_jobs = QueryJobs()
@@ -0,0 +1,117 @@
+"""
+Process-wide index of analysis metadata.
+
+Metadata predicates in modifiers (``[EXPERIMENT_TYPE=Expression]``) and column filters are resolved against this
+index, so a modifier tree of any size is matched without a round trip to the database.
+"""
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from querytgdb.models import Analysis, AnalysisData
+from querytgdb.utils import async_loader, skip_for_management
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataTables(NamedTuple):
+    # upper cased key -> upper cased value -> sorted analysis ids
+    lookup: Dict[str, Dict[str, np.ndarray]]
+
+    # analysis id by key, NaN where an analysis has no value for a key
+    values: pd.DataFrame
+
+    # analysis id by gene_id, gene_name
+    genes: pd.DataFrame
+
+
+class MetadataIndex:
+    """
+    Lazily loaded, thread safe analysis metadata index
+
+    Call :meth:`invalidate` after changing Analysis or AnalysisData rows. The next lookup reloads the data.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Optional[MetadataTables] = None
+        self.generation = 0
+
+    def load(self) -> MetadataTables:
+        metadata = pd.DataFrame(
+            AnalysisData.objects.values_list('analysis_id', 'key__name', 'value').iterator(chunk_size=2000),
+            columns=['id', 'key', 'value'])
+
+        lookup: Dict[str, Dict[str, np.ndarray]] = defaultdict(dict)
+        for (key, value), ids in metadata.groupby([metadata['key'].str.upper(),
+                                                   metadata['value'].str.upper()])['id']:
+            lookup[key][value] = np.unique(ids.to_numpy())
+
+        genes = pd.DataFrame(Analysis.objects.values_list('id', 'tf__gene_id', 'tf__name').iterator(),
+                             columns=['id', 'gene_id', 'gene_name']).set_index('id')
+
+        logger.info(f"metadata index loaded {metadata.shape[0]} values of {genes.shape[0]} analyses")
+
+        return MetadataTables(dict(lookup), metadata.set_index(['id', 'key'])['value'].unstack(), genes)
+
+    @property
+    def data(self) -> MetadataTables:
+        data = self._data
+        if data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = self.load()
+                data = self._data
+
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self.generation += 1
+
+    def ids(self, key: str, value: str) -> np.ndarray:
+        """
+        Get ids of analyses with a metadata value, ignoring case
+        :param key:
+        :param value:
+        :return:
+        """
+        try:
+            return self.data.lookup[str(key).upper()][str(value).upper()]
+        except KeyError:
+            return np.array([], dtype=np.int64)
+
+    def metadata(self, analyses: Iterable) -> pd.DataFrame:
+        """
+        Same as :func:`querytgdb.utils.get_metadata` without fields
+        :param analyses: analysis ids
+        :return:
+        """
+        data = self.data
+        analyses = pd.Index(analyses)
+
+        values = (data.values.loc[data.values.index.isin(analyses), :]
+                  .dropna(axis=1, how='all')
+                  .fillna('None'))
+        genes = data.genes.loc[data.genes.index.isin(analyses), :]
+
+        metadata = genes.merge(values, left_index=True, right_index=True)
+        metadata.insert(0, 'analysis_id', metadata.index.astype(str))
+
+        return metadata.fillna('')
+
+
+metadata_index = MetadataIndex()
+
+
+@skip_for_management
+def preload_metadata():
+    return metadata_index.data
+
+
+async_loader['metadata_index'] = preload_metadata
@@ -14,14 +14,14 @@ import pandas as pd
 import scipy.cluster.hierarchy as hierarchy
 import seaborn as sns
 from django.conf import settings
-from django.core.cache import cache
 from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 
 from querytgdb.models import Analysis
-from querytgdb.utils import clear_data, column_string, get_metadata, svg_font_adder
+from querytgdb.utils import EDGE_COLUMNS, clear_data, column_string, get_metadata, svg_font_adder
 from querytgdb.utils.motif_enrichment.motif import AdditionalMotifData, MotifData, Region
 from querytgdb.utils.parser import Id, Ids
+from querytgdb.utils.result_store import result_store
 
 sns.set()
 
@@ -198,35 +198,33 @@ def motif_enrichment(res: Dict[Tuple[Tuple[str, str, str], int], Set[str]],
 
     results: Dict[str, List[pd.Series]] = OrderedDict()
 
-    if uid is not None:
-        cached_region = cache.get_many([f'{uid}/{r}_enrich' for r in regions])
-    else:
-        cached_region = {}
-
     annotated = None
 
+    def region_enrichment(region: str, columns: List[Id]) -> List[pd.Series]:
+        nonlocal annotated
+
+        if annotated is None:
+            genes = set(chain.from_iterable(res.values()))
+            annotated = motif_data.annotation
+            annotated = annotated.loc[(
+                                          annotated.index.get_level_values(0).isin(genes),
+                                          regions,
+                                          slice(None)
+                                      ), :]
+
+        return list(map(partial(get_list_enrichment,
+                                annotated=annotated.loc[(slice(None), region, slice(None)), :],
+                                ann_cluster_size=getattr(motif_data, f'{region}_cluster_size'),
+                                total=motif_data.region_total.loc[region, :].squeeze()),
+                        map(res.__getitem__, columns),
+                        map(motif_dict.__getitem__, columns)))
+
     for region in regions:
-        try:
-            region_enrich = cached_region[f'{uid}/{region}_enrich']
-        except KeyError:
-            if annotated is None:
-                genes = set(chain.from_iterable(res.values()))
-                annotated = motif_data.annotation
-                annotated = annotated.loc[(
-                                              annotated.index.get_level_values(0).isin(genes),
-                                              regions,
-                                              slice(None)
-                                          ), :]
-            region_enrich = list(map(partial(get_list_enrichment,
-                                             annotated=annotated.loc[(slice(None), region, slice(None)), :],
-                                             ann_cluster_size=getattr(motif_data, f'{region}_cluster_size'),
-                                             total=motif_data.region_total.loc[region, :].squeeze()),
-                                     res.values(),
-                                     motif_dict.values()))
-            if uid is not None:
-                cache.set(f'{uid}/{region}_enrich', region_enrich)
-
-        results[region] = region_enrich
+        if uid is not None:
+            results[region] = result_store.get_parts(f'{uid}/{region}_enrich', res.keys(),
+                                                     partial(region_enrichment, region))
+        else:
+            results[region] = region_enrichment(region, list(res.keys()))
 
     result_df = pd.concat(chain.from_iterable(zip(*results.values())), axis=1, sort=True)
 
@@ -264,7 +262,8 @@ def motif_enrichment(res: Dict[Tuple[Tuple[str, str, str], int], Set[str]],
 
 
 def get_analysis_gene_list(uid: Union[str, UUID]) -> Dict[Id, Set[str]]:
-    cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/target_genes'])
+    cached_data = result_store.get_many([f'{uid}/tabular_output', f'{uid}/target_genes'],
+                                        columns={f'{uid}/tabular_output': EDGE_COLUMNS})
     df = cached_data[f'{uid}/tabular_output']
     df = clear_data(df)
     res = OrderedDict((name, set(col.index[col.notnull()])) for name, col in df.items())
@@ -316,7 +315,7 @@ def get_motif_enrichment_json(uid: Union[str, UUID],
                               alpha: float = 0.05,
                               use_labels: bool = False,
                               motif_data: MotifData = MOTIFS) -> Dict:
-    ids = cache.get(f'{uid}/analysis_ids')
+    ids = result_store.get(f'{uid}/analysis_ids')
     if ids is None:
         raise ValueError("Analysis not found")
 
@@ -348,7 +347,7 @@ def get_additional_motif_enrichment_json(uid: Union[str, UUID],
                                          use_default_motifs: bool = False,
                                          motif_data: MotifData = ADD_MOTIFS,
                                          use_labels: bool = False) -> Dict:
-    ids = cache.get(f'{uid}/analysis_ids')
+    ids = result_store.get(f'{uid}/analysis_ids')
     if ids is None:
         raise ValueError("Analysis not found")
 
@@ -479,7 +478,7 @@ def get_motif_enrichment_heatmap(uid: Union[str, UUID],
     result_df = result_df.rename(
         index={idx: get_motif_name(idx) for idx in result_df.index})
 
-    ids = cache.get(f'{uid}/analysis_ids')
+    ids = result_store.get(f'{uid}/analysis_ids')
     if ids is None:
         raise ValueError("Analysis not found")
 
@@ -549,7 +548,8 @@ TableRow = Tuple[Dict, str, str, str, str, str]
 
 def get_motif_enrichment_heatmap_table(uid: Union[str, UUID], use_labels: bool = False) -> \
         Generator[TableRow, None, None]:
-    cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/target_genes', f'{uid}/analysis_ids'])
+    cached_data = result_store.get_many([f'{uid}/tabular_output', f'{uid}/target_genes', f'{uid}/analysis_ids'],
+                                        columns={f'{uid}/tabular_output': EDGE_COLUMNS})
     df, ids = itemgetter(f'{uid}/tabular_output', f'{uid}/analysis_ids')(cached_data)
     df = clear_data(df)
 
@@ -8,20 +8,30 @@ import seaborn as sns
 from django.conf import settings
 
 from querytgdb.utils import async_loader, skip_for_management
+from querytgdb.utils.snapshot import file_signature, get_snapshot
 
 
 class MotifError(Exception):
     pass
 
 
+def read_motif_counts(path: str, name: str) -> pd.DataFrame:
+    snapshot = get_snapshot()
+
+    if snapshot is not None and snapshot.is_current(name, file_signature(path)):
+        return snapshot.motifs(name)
+
+    return pd.read_csv(path, index_col=[0, 1, 2], header=None)
+
+
 @skip_for_management
 def get_annotations():
-    return pd.read_csv(settings.MOTIF_ANNOTATION, index_col=[0, 1, 2], header=None)
+    return read_motif_counts(settings.MOTIF_ANNOTATION, 'motifs')
 
 
 @skip_for_management
 def get_tf_annotations():
-    return pd.read_csv(settings.MOTIF_TF_ANNOTATION, index_col=[0, 1, 2], header=None)
+    return read_motif_counts(settings.MOTIF_TF_ANNOTATION, 'motifs_tf')
 
 
 async_loader['motifs'] = get_annotations
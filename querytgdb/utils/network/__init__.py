@@ -10,23 +10,29 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import pandas as pd
-from django.core.cache import cache
 from django.http import HttpResponse
 from sklearn.metrics import auc
 
 from querytgdb.utils import async_loader
 from ..parser import filter_df_by_ids
+from ..result_store import result_store
 from ...models import Analysis, Annotation, EdgeData, EdgeType
 from ...utils import data_to_edges, get_size
 from ...utils.network.utils import COLOR, COLOR_SHAPE
 
-GENE_TYPE = async_loader['annotations'][['Name', 'Type', 'id']]
 SIZE = 20
 GAP = 10
 TF_GAP = 50
 G_GAP = 40
 
 
+def get_gene_type() -> pd.DataFrame:
+    """
+    Name, type and id of genes, from the current annotations
+    """
+    return async_loader['annotations'][['Name', 'Type', 'id']]
+
+
 def make_nodes(df: pd.DataFrame, pos, show_label: bool = False, extra_attrs: Optional[Dict] = None) \
         -> Generator[Dict[str, Any], None, None]:
     """
@@ -78,16 +84,17 @@ def get_network_json(uid: Union[str, UUID],
     network_key = f'{uid}/network'
     df_key = f'{uid}/tabular_output'
 
-    cached_data = cache.get_many([df_key, network_key])
+    cached_data = result_store.get_many([df_key, network_key])
 
     df = cached_data[df_key]
+    gene_type = get_gene_type()
 
     analyses = (pd.DataFrame(
         Analysis.objects.filter(
             pk__in=df.columns.get_level_values(1).unique()
         ).values_list('pk', 'tf_id').iterator(),
         columns=['analysis_id', 'id'])
-                .merge(GENE_TYPE['id'].reset_index(), how='inner', on='id')
+                .merge(gene_type['id'].reset_index(), how='inner', on='id')
                 .set_index('analysis_id'))
 
     # network data cached separately. @todo: utilize the caching better
@@ -122,7 +129,7 @@ def get_network_json(uid: Union[str, UUID],
         tf_grid = np.array(np.meshgrid(np.arange(s_tfs), np.arange(s_tfs), indexing='ij')).reshape(
             (2, -1), order='F').T * (SIZE + TF_GAP) + SIZE / 2
 
-        data = list(make_nodes(GENE_TYPE.loc[tf_nodes.index, ['Name', 'Type']], tf_grid, True))
+        data = list(make_nodes(gene_type.loc[tf_nodes.index, ['Name', 'Type']], tf_grid, True))
 
         data.extend({
                         'group': 'edges',
@@ -179,7 +186,7 @@ def get_network_json(uid: Union[str, UUID],
 
                 data.extend(
                     make_nodes(
-                        GENE_TYPE.loc[e_group.index.unique(), ['Name', 'Type']].sort_values('Type', kind='mergesort'),
+                        gene_type.loc[e_group.index.unique(), ['Name', 'Type']].sort_values('Type', kind='mergesort'),
                         e_grid))
 
                 data.extend({
@@ -196,7 +203,7 @@ def get_network_json(uid: Union[str, UUID],
         else:
             groups_edge_len = 0
 
-        cache.set_many({network_key: (data, network_table, e_tfs, groups_edge_len)})
+        result_store.set_many({network_key: (data, network_table, e_tfs, groups_edge_len)})
 
     # additional edges
     if edges:
@@ -257,9 +264,9 @@ def get_network_json(uid: Union[str, UUID],
     if precision_cutoff is not None:
         try:
             try:
-                recall, precision, g = cache.get(f'{uid}/figure_data')
+                recall, precision, g = result_store.get(f'{uid}/figure_data')
             except TypeError:
-                cached_data = cache.get_many([
+                cached_data = result_store.get_many([
                     f"{uid}/target_network",
                     f'{uid}/tabular_output_unfiltered',
                     f'{uid}/analysis_ids'
@@ -320,16 +327,17 @@ def get_network_sif(uid: Union[str, UUID],
     network_key = f'{uid}/network'
     df_key = f'{uid}/tabular_output'
 
-    cached_data = cache.get_many([df_key, network_key])
+    cached_data = result_store.get_many([df_key, network_key])
 
     df = cached_data[df_key]
+    gene_type = get_gene_type()
 
     analyses = (pd.DataFrame(
         Analysis.objects.filter(
             pk__in=df.columns.get_level_values(1).unique()
         ).values_list('pk', 'tf_id').iterator(),
         columns=['analysis_id', 'id'])
-                .merge(GENE_TYPE['id'].reset_index(), how='inner', on='id')
+                .merge(gene_type['id'].reset_index(), how='inner', on='id')
                 .set_index('analysis_id'))
 
     try:
@@ -395,9 +403,9 @@ def get_network_sif(uid: Union[str, UUID],
     if precision_cutoff is not None:
         try:
             try:
-                recall, precision, g = cache.get(f'{uid}/figure_data')
+                recall, precision, g = result_store.get(f'{uid}/figure_data')
             except TypeError:
-                cached_data = cache.get_many([
+                cached_data = result_store.get_many([
                     f"{uid}/target_network",
                     f'{uid}/tabular_output_unfiltered',
                     f'{uid}/analysis_ids'
@@ -590,14 +598,14 @@ def get_prediction_data(df: pd.DataFrame, predicted_network: pd.DataFrame, rando
 
 
 def get_pruned_network(uid: str, cutoff: float) -> pd.DataFrame:
-    name, data = cache.get(f"{uid}/target_network")
+    name, data = result_store.get(f"{uid}/target_network")
     data = data.sort_values('rank')
 
     try:
-        recall, precision, g = cache.get(f'{uid}/figure_data')
+        recall, precision, g = result_store.get(f'{uid}/figure_data')
     except TypeError:
         try:
-            cached_data = cache.get_many([f'{uid}/tabular_output_unfiltered', f'{uid}/analysis_ids'])
+            cached_data = result_store.get_many([f'{uid}/tabular_output_unfiltered', f'{uid}/analysis_ids'])
             df = cached_data[f'{uid}/tabular_output_unfiltered']
             ids = cached_data[f'{uid}/analysis_ids']
             df = filter_df_by_ids(df, ids)
@@ -649,7 +657,7 @@ def get_auc_figure(network: Tuple[str, pd.DataFrame], df: pd.DataFrame, uid: Uni
     data_cache = f'{uid}/figure_data'
 
     try:
-        cached_data = cache.get_many([f'{uid}/figure', f'{uid}/figure_data'])
+        cached_data = result_store.get_many([f'{uid}/figure', f'{uid}/figure_data'])
 
         fig, gs, cell_text = cached_data[figure_cache]
         recall, precision, g = cached_data[data_cache]
@@ -694,7 +702,7 @@ def get_auc_figure(network: Tuple[str, pd.DataFrame], df: pd.DataFrame, uid: Uni
             [format(p_value, '.3f') if p_value else '<0.001']
         ]
 
-        cache.set_many({
+        result_store.set_many({
             figure_cache: (fig, gs, cell_text),
             data_cache: (recall, precision, g)
         })
@@ -1,25 +1,30 @@
+import hashlib
 import logging
 import operator
 import re
-from collections import UserDict, defaultdict, deque
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial, reduce
+from collections import UserDict, defaultdict
+from functools import lru_cache, partial, reduce
 from operator import and_, itemgetter, methodcaller, or_
-from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Collection, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 from uuid import UUID, uuid4
 
 import numpy as np
 import pandas as pd
 import pyparsing as pp
 from django.conf import settings
-from django.core.cache import cache, caches
+from django.core.cache import caches
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
-from django.db.models import Q
 
-from querytgdb.models import Analysis, Annotation, EdgeData, EdgeType, Interaction, Regulation
-from querytgdb.utils import async_loader
+from querytgdb.models import Analysis, Annotation, EdgeData, EdgeType
+from querytgdb.utils import async_loader, progress
+from querytgdb.utils.data_version import data_version
+from querytgdb.utils.edge_store import edge_store
+from querytgdb.utils.metadata_index import metadata_index
+from querytgdb.utils.result_store import result_store
 from ..utils import CaselessDict, clear_data, get_metadata as get_meta_df
 from ..utils.file import UserGeneLists
+from ..utils.query_plan import ALL_TFS_QUERIES, BinOp, ColumnFilter, Function, Gene, ModBinOp, ModNot, Modified, \
+    Node, Not, Predicate, SubplanMemo, build_plan, fold_query, genes, normalize_query
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +32,13 @@ mem_cache = caches['mem']
 
 NAMED_QUERIES = CaselessDict(getattr(settings, 'NAMED_QUERIES', {}))
 
+# how long single TF edges are shared between queries
+TF_CACHE_TIMEOUT = getattr(settings, 'TF_CACHE_TIMEOUT', 300)
+
 PVALUE = 'Pvalue'
 LOG2FC = 'Log2FC'
+EDGE_FIELDS = ['EDGE', PVALUE, LOG2FC, 'ADD_EDGES']
+EDGE_DTYPE = pd.CategoricalDtype(['*', '+'])  # edges of expression and other analyses, sorted as text
 
 
 class QueryError(ValueError):
@@ -105,7 +115,7 @@ multitype = pp.CaselessKeyword('multitype')
 
 
 def parse_prebuilt_query(tocs):
-    return expr.parseString(NAMED_QUERIES[tocs[0]], parseAll=True)
+    return compile_query(NAMED_QUERIES[tocs[0]])
 
 
 named_query = reduce(lambda a, b: a | b, map(pp.CaselessKeyword, NAMED_QUERIES.keys())).setParseAction(
@@ -122,44 +132,70 @@ query_func = (func_name + pp.Suppress('(') + pp.delimitedList(quoted_name | pp.W
 expr <<= pp.infixNotation(gene, [(modifier | column_filter, 1, pp.opAssoc.LEFT)] + opers)('query') ^ query_func
 
 
-def is_name(key: str, item: Union[pp.ParseResults, Any]) -> bool:
-    try:
-        return item.getName() == key
-    except AttributeError:
-        return False
+@lru_cache(maxsize=getattr(settings, 'QUERY_PLAN_CACHE_SIZE', 1024))
+def _compile_query(query: str) -> Node:
+    parse = expr.parseString(query, parseAll=True)
 
+    if parse.getName() == 'function':
+        fname, *args = parse
+        return Function(fname, tuple(args))
 
-is_modifier = partial(is_name, 'modifier')
-is_mod = partial(is_name, 'mod')
-is_column_filter = partial(is_name, 'column_filter')
+    return build_plan(parse.get('query'))
 
 
-def mod_to_str(curr: pp.ParseResults) -> str:
-    if isinstance(curr, str):
-        return curr
+def compile_query(query: str) -> Node:
+    """
+    Parse query into a query plan
 
-    if isinstance(curr, pp.ParseResults) and curr.getName() != 'mod':
-        return '(' + ' '.join(map(mod_to_str, curr)) + ')'
+    Plans are cached by query text with whitespace normalized and case insensitive parts folded, so repeated
+    queries and named queries are only parsed once.
+    :param query:
+    :return:
+    """
+    return _compile_query(fold_query(normalize_query(query)))
 
-    try:
-        return ' '.join(map(mod_to_str, curr))
-    except TypeError:
-        return str(curr)
+
+def plan_cache_info():
+    """
+    Plan cache statistics, hits counts queries that skipped parsing
+    """
+    return _compile_query.cache_info()
 
 
-def query_metadata(df: TargetFrame, key: str, value: str) -> pd.DataFrame:
-    ref_ids = Analysis.objects.filter(
-        (Q(analysisdata__key__name__iexact=key) & Q(analysisdata__value__iexact=value))
-    ).values_list('id', flat=True)
+class ColumnGroups(NamedTuple):
+    """
+    (TF, analysis) groups of the columns of a TF DataFrame
+    """
+    codes: np.ndarray  # group of each column
+    analyses: pd.Index  # analysis of each group
 
-    if not ref_ids:
-        return pd.DataFrame(False, columns=df.columns, index=df.index)
+    def __len__(self):
+        return len(self.analyses)
 
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
 
-    mask.loc[:, ~df.columns.get_level_values(1).isin(ref_ids)] = False
+def column_groups(df: TargetFrame) -> ColumnGroups:
+    if not len(df.columns):
+        return ColumnGroups(np.zeros(0, dtype=np.intp), pd.Index([]))
 
-    return mask
+    name_codes = pd.factorize(df.columns.get_level_values(0))[0]
+    analysis_codes, analyses = pd.factorize(df.columns.get_level_values(1), use_na_sentinel=False)
+
+    keys = name_codes.astype(np.int64) * len(analyses) + analysis_codes
+    uniques, first, codes = np.unique(keys, return_index=True, return_inverse=True)
+
+    return ColumnGroups(codes, df.columns.get_level_values(1)[first])
+
+
+def field_columns(df: TargetFrame, key: str) -> np.ndarray:
+    return np.flatnonzero(df.columns.get_level_values(2) == key)
+
+
+# Modifier masks are boolean arrays that broadcast to (targets, column groups): a row of shape (1, groups) for
+# masks that only depend on the analysis, a column of shape (targets, 1) for masks that only depend on the target.
+
+
+def query_metadata(df: TargetFrame, groups: ColumnGroups, key: str, value: str) -> np.ndarray:
+    return groups.analyses.isin(metadata_index.ids(key, value)).reshape(1, -1)
 
 
 OPERS = {
@@ -173,45 +209,44 @@ OPERS = {
 }
 
 
-def apply_comp_mod(df: TargetFrame, key: str, oper: str, value: float) -> pd.DataFrame:
+def apply_comp_mod(df: TargetFrame, groups: ColumnGroups, key: str, oper: str, value: float) -> np.ndarray:
     """
     apply Pvalue and Log2FC (fold change)
     """
     try:
-        c = df[(*df.name, key)]
-    except KeyError:
-        return pd.DataFrame(False, columns=df.columns, index=df.index)
-
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
-
-    try:
-        return mask.where(OPERS[oper](c, value), False)
+        op = OPERS[oper]
     except KeyError as e:
         raise ValueError('invalid operator: {}'.format(oper)) from e
 
+    mask = np.zeros((df.shape[0], len(groups)), dtype=bool)
+    cols = field_columns(df, key)
 
-def apply_search_column(df: TargetFrame, key, value) -> pd.DataFrame:
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
+    if cols.size:
+        with np.errstate(invalid='ignore'):
+            mask[:, groups.codes[cols]] = op(df.iloc[:, cols].to_numpy(dtype=np.float64), value)
+
+    return mask
 
-    try:
-        return mask.where(df[(*df.name, key)].str.contains(value, case=False, regex=False), False)
-    except KeyError:
-        mask.loc[:, :] = False
-        return mask
 
+def apply_search_column(df: TargetFrame, groups: ColumnGroups, key, value) -> np.ndarray:
+    mask = np.zeros((df.shape[0], len(groups)), dtype=bool)
 
-def match_id(df: TargetFrame, oper: str, analysis_id: Union[str, int]):
+    for col in field_columns(df, key):
+        mask[:, groups.codes[col]] = df.iloc[:, col].str.contains(value, case=False, regex=False).fillna(False)
+
+    return mask
+
+
+def match_id(df: TargetFrame, groups: ColumnGroups, oper: str, analysis_id: Union[str, int]) -> np.ndarray:
     """
     Filter dataframe by analysis_id
     :param df:
+    :param groups:
     :param oper:
     :param analysis_id:
     :return:
     """
-    mask = pd.DataFrame(False, columns=df.columns, index=df.index)
-    mask.loc[:, (slice(None), OPERS[oper](df.columns.get_level_values(1), int(analysis_id)), slice(None))] = True
-
-    return mask
+    return np.asarray(OPERS[oper](groups.analyses, int(analysis_id))).reshape(1, -1)
 
 
 COL_TRANSLATE = {
@@ -221,37 +256,51 @@ COL_TRANSLATE = {
 }
 
 
-def apply_has_column(df: TargetFrame, value) -> pd.DataFrame:
+def apply_has_column(df: TargetFrame, groups: ColumnGroups, value) -> np.ndarray:
     try:
         value = COL_TRANSLATE[value]
     except KeyError:
         pass
 
-    if (*df.name, value) in df:
-        return pd.DataFrame(True, columns=df.columns, index=df.index)
+    mask = np.zeros((1, len(groups)), dtype=bool)
+    mask[0, groups.codes[field_columns(df, value)]] = True
+
+    return mask
 
-    return pd.DataFrame(False, columns=df.columns, index=df.index)
 
+def apply_has_add_edges(df: TargetFrame, groups: ColumnGroups, value) -> np.ndarray:
+    mask = np.zeros((df.shape[0], len(groups)), dtype=bool)
 
-def apply_has_add_edges(df: TargetFrame, analyses, anno_ids, value) -> pd.DataFrame:
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
     try:
         edge_type = EdgeType.objects.get(name__iexact=value)
-        target_ids = set(EdgeData.objects.filter(
+    except (ObjectDoesNotExist, MultipleObjectsReturned):
+        return mask
+
+    tf_ids = dict(Analysis.objects.filter(pk__in=groups.analyses).values_list('pk', 'tf_id').iterator())
+    group_tfs = pd.Series(groups.analyses).map(tf_ids)
+
+    edge_data = pd.DataFrame(
+        EdgeData.objects.filter(
             type=edge_type,
-            tf_id=analyses.get(pk=df.name[1]).tf_id
-        ).values_list('target_id', flat=True).iterator())
+            tf_id__in=group_tfs.dropna().unique().tolist()
+        ).values_list('tf_id', 'target_id').iterator(),
+        columns=['tf_id', 'target_id'])
 
-        target_ids &= set(anno_ids.loc[df.index[df.notna().any(axis=1)]].unique())
+    # rows with any data in each group
+    has_data = np.zeros((len(groups), df.shape[0]), dtype=bool)
+    np.logical_or.at(has_data, groups.codes, df.notna().to_numpy().T)
 
-        mask.loc[~df.index.isin(anno_ids.index[anno_ids.isin(target_ids)]), :] = False
-    except (ObjectDoesNotExist, MultipleObjectsReturned):
-        mask.loc[:, :] = False
+    anno_ids = async_loader['annotations'].loc[df.index, 'id'].to_numpy()
+
+    for tf_id, targets in edge_data.groupby('tf_id')['target_id']:
+        is_target = np.isin(anno_ids, targets.to_numpy())
+        for group in np.flatnonzero(group_tfs == tf_id):
+            mask[:, group] = is_target & has_data[group]
 
     return mask
 
 
-def match_targeted_by(df, oper, value):
+def match_targeted_by(df: TargetFrame, groups: ColumnGroups, oper: str, value: str) -> np.ndarray:
     frac = False
     if '%' in value:
         value = float(value.rstrip('% ')) / 100
@@ -262,8 +311,6 @@ def match_targeted_by(df, oper, value):
     if 0 <= value < 1:
         frac = True
 
-    mask = pd.DataFrame(False, columns=df.columns, index=df.index)
-
     cleared = df.pipe(clear_data)
 
     targeted_count = cleared.count(axis=1)
@@ -275,58 +322,177 @@ def match_targeted_by(df, oper, value):
     else:
         rows = op_func(targeted_count, value)
 
-    mask.loc[rows, :] = True
+    return rows.to_numpy(dtype=bool).reshape(-1, 1)
 
-    return mask
+
+def get_mod_mask(df: TargetFrame, groups: ColumnGroups, query: Node) -> np.ndarray:
+    if isinstance(query, ModBinOp):
+        prec, succ = get_mod_mask(df, groups, query.left), get_mod_mask(df, groups, query.right)
+        if query.oper == 'and':
+            return prec & succ
+        return prec | succ
+    elif isinstance(query, ModNot):
+        return ~get_mod_mask(df, groups, query.operand)
+    elif isinstance(query, Predicate):
+        key, oper, value = query.key, query.oper, query.value
+        if key == 'pvalue':
+            return apply_comp_mod(df, groups, PVALUE, oper, value)
+        elif key == 'log2fc':
+            return apply_comp_mod(df, groups, LOG2FC, oper, value)
+        elif key == 'additional_edge':
+            return apply_has_add_edges(df, groups, value)
+        elif key == 'id':
+            return match_id(df, groups, oper, value)
+        elif key == 'targeted_by':
+            return match_targeted_by(df, groups, oper, value)
+        else:
+            return query_metadata(df, groups, key, value)
+
+    raise ValueError(query)
 
 
-def get_mod(df: TargetFrame, query: Union[pp.ParseResults, pd.DataFrame]) -> pd.DataFrame:
+def get_mod(df: TargetFrame, query: Union[Node, pd.DataFrame]) -> pd.DataFrame:
     """
     Get ref_id from modifier to filter TF dataframe
 
-    Careful not to modify original df
+    Masks are combined per target and (TF, analysis) group, and only expanded to the columns of df at the end.
+    """
+    if isinstance(query, pd.DataFrame):
+        return query
+
+    groups = column_groups(df)
+    mask = np.broadcast_to(get_mod_mask(df, groups, query), (df.shape[0], len(groups)))
+
+    return pd.DataFrame(mask[:, groups.codes], index=df.index, columns=df.columns)
+
+
+# modifiers that need more than the edges of the modified TF
+NOT_PUSHED = frozenset({'additional_edge', 'targeted_by'})
+
+
+def can_push_down(query: Node) -> bool:
+    """
+    Whether a modifier can be applied to the long format edges before they are pivoted
+    :param query:
+    :return:
+    """
+    if isinstance(query, ModBinOp):
+        return can_push_down(query.left) and can_push_down(query.right)
+    elif isinstance(query, ModNot):
+        return can_push_down(query.operand)
+    elif isinstance(query, Predicate):
+        return query.key not in NOT_PUSHED
+    return False
+
+
+def is_analysis_level(query: Node) -> bool:
     """
-    if isinstance(query, pp.ParseResults):
-        if 'key' not in query:
-            it = iter(query)
-            stack: Deque[Union[pp.ParseResults, pd.DataFrame]] = deque()
+    Whether a modifier only depends on the analysis, like id and metadata
+    :param query:
+    :return:
+    """
+    if isinstance(query, ModBinOp):
+        return is_analysis_level(query.left) and is_analysis_level(query.right)
+    elif isinstance(query, ModNot):
+        return is_analysis_level(query.operand)
+    elif isinstance(query, Predicate):
+        return query.key not in NOT_PUSHED and query.key not in {'pvalue', 'log2fc'}
+    return False
+
+
+def edge_mask(df: pd.DataFrame, query: Node) -> pd.Series:
+    """
+    Same as get_mod, but on long format edges
+
+    A p-value or fold change comparison is False for every edge of an analysis with no values in that
+    column, which is a missing column once the edges are pivoted.
+    :param df: edges with ANALYSIS column
+    :param query: modifier
+    :return:
+    """
+    if isinstance(query, ModBinOp):
+        prec, succ = edge_mask(df, query.left), edge_mask(df, query.right)
+        if query.oper == 'and':
+            return prec & succ
+        return prec | succ
+    elif isinstance(query, ModNot):
+        return ~edge_mask(df, query.operand)
+    elif isinstance(query, Predicate) and query.key not in NOT_PUSHED:
+        key, oper, value = query.key, query.oper, query.value
+        if key in {'pvalue', 'log2fc'}:
+            col = PVALUE if key == 'pvalue' else LOG2FC
+
+            if col not in df:
+                return pd.Series(False, index=df.index)
+
+            has_column = df['ANALYSIS'].isin(df.loc[df[col].notna(), 'ANALYSIS'].unique())
 
             try:
-                while True:
-                    curr = next(it)
-                    if curr in ('and', 'or'):
-                        prec, succ = get_mod(df, stack.pop()), get_mod(df, next(it))
-                        if curr == 'and':
-                            stack.append(prec & succ)
-                        else:
-                            stack.append(prec | succ)
-                    elif curr == 'not':
-                        succ = get_mod(df, next(it))
-                        stack.append(~succ)
-                    else:
-                        stack.append(curr)
-            except StopIteration:
-                return get_mod(df, stack.pop())
+                return has_column & OPERS[oper](df[col], value)
+            except KeyError as e:
+                raise ValueError('invalid operator: {}'.format(oper)) from e
+        elif key == 'id':
+            return OPERS[oper](df['ANALYSIS'], int(value))
         else:
-            key, oper, value = itemgetter('key', 'oper', 'value')(query)
-            if key == 'pvalue':
-                return df.groupby(level=[0, 1], axis=1).apply(apply_comp_mod, key=PVALUE, oper=oper, value=value)
-            elif key == 'log2fc':
-                return df.groupby(level=[0, 1], axis=1).apply(apply_comp_mod, key=LOG2FC, oper=oper, value=value)
-            elif key == 'additional_edge':
-                analyses = Analysis.objects.filter(pk__in=df.columns.get_level_values(1)).prefetch_related('tf')
-                anno_ids = async_loader['annotations'].loc[df.index, 'id']
-                return df.groupby(level=[0, 1], axis=1).apply(apply_has_add_edges,
-                                                              analyses=analyses,
-                                                              anno_ids=anno_ids,
-                                                              value=value)
-            elif key == 'id':
-                return match_id(df, oper, value)
-            elif key == 'targeted_by':
-                return match_targeted_by(df, oper, value)
-            else:
-                return query_metadata(df, key, value)
-    return query
+            return df['ANALYSIS'].isin(metadata_index.ids(key, value))
+
+    raise ValueError(query)
+
+
+def split_modified(query: Modified) -> Optional[Tuple[Gene, List[Modified]]]:
+    """
+    Split a chain of modifiers on a TF or all TFs that can be pushed down to the edges
+    :param query:
+    :return: TF, modifiers from innermost outwards
+    """
+    chain = []
+
+    while isinstance(query, Modified) and can_push_down(query.modifier):
+        chain.append(query)
+        query = query.operand
+
+    if chain and isinstance(query, Gene):
+        return query, chain[::-1]
+
+    return None
+
+
+def get_modified_edges(tf: Gene,
+                       chain: Sequence[Modified],
+                       edges: Optional[List[str]] = None,
+                       tf_filter_list: Optional[pd.Series] = None,
+                       target_filter_list: Optional[pd.Series] = None) -> Tuple[str, pd.DataFrame, str]:
+    """
+    Get long format edges with modifiers applied
+
+    Modifiers on all TFs that only look at the analysis are applied before edges are added.
+    :param tf:
+    :param chain: modifiers from innermost outwards
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return: TF name, edges, filter string
+    """
+    filter_string = ''.join(f'[{query.text}]' for query in chain)
+
+    if tf.name in ALL_TFS_QUERIES:
+        name, analyses = tf.name, None
+
+        if is_analysis_level(chain[0].modifier):
+            analyses = edge_store.analyses[['ANALYSIS']]
+            analyses = analyses.loc[edge_mask(analyses, chain[0].modifier), 'ANALYSIS']
+            chain = chain[1:]
+
+        df = get_all_tf_edges(name, edges, tf_filter_list, target_filter_list, analyses)
+    else:
+        name, df = get_tf_edges(tf.name, edges, tf_filter_list, target_filter_list)
+
+    for query in chain:
+        if df.empty:
+            break
+        df = df[edge_mask(df, query.modifier)]
+
+    return name, df, name + filter_string
 
 
 def gene_to_ids(metadata, ids):
@@ -337,13 +503,12 @@ def gene_to_ids(metadata, ids):
     return d
 
 
-def get_column_filter(df: TargetFrame, filter_list) -> TargetFrame:
-    metadata = get_meta_df(Analysis.objects.filter(pk__in=df.columns.get_level_values(1)))
+def get_column_filter(df: TargetFrame, filter_list: Sequence[Predicate]) -> TargetFrame:
+    metadata = metadata_index.metadata(df.columns.get_level_values(1))
     metadata.columns = metadata.columns.str.lower()
     result = []
     for query in filter_list:
-        key, oper, value = itemgetter('key', 'oper', 'value')(query)
-        key = key.lower()
+        key, oper, value = query.key.lower(), query.oper, query.value
 
         if key == 'pvalue':
             c = OPERS[oper](df.loc[:, (slice(None), slice(None), [PVALUE])], value)
@@ -415,6 +580,7 @@ def add_edges(df: pd.DataFrame, edges: List[str]) -> pd.DataFrame:
     edge_data = edge_data.merge(anno, left_on='source', right_on='id')
     edge_data = edge_data[['TARGET', 'target', 'edge']]
     edge_data.columns = ['TF', 'id', 'ADD_EDGES']
+    edge_data['ADD_EDGES'] = edge_data['ADD_EDGES'].astype('category')
 
     if 'TF' in df:
         return df.merge(edge_data, on=['TF', 'id'], how='left')
@@ -425,52 +591,75 @@ def initialize_column_name(col_name) -> Tuple[str, str, str]:
     return col_name, "", str(uuid4())
 
 
-def get_tf_data(query: str,
-                edges: Optional[List[str]] = None,
-                tf_filter_list: Optional[pd.Series] = None,
-                target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+def list_key(genes: Optional[pd.Series]) -> str:
+    if genes is None:
+        return ''
+    return hashlib.md5('\n'.join(sorted(genes.str.upper().unique())).encode()).hexdigest()
+
+
+def tf_cache_key(query: str,
+                 edges: Optional[List[str]] = None,
+                 tf_filter_list: Optional[pd.Series] = None,
+                 target_filter_list: Optional[pd.Series] = None) -> str:
+    return '/'.join(['tf_edges', str(data_version.version), query.upper(), ','.join(sorted(edges or [])),
+                     list_key(tf_filter_list), list_key(target_filter_list)])
+
+
+def get_tf_edges(query: str,
+                 edges: Optional[List[str]] = None,
+                 tf_filter_list: Optional[pd.Series] = None,
+                 target_filter_list: Optional[pd.Series] = None) -> Tuple[str, pd.DataFrame]:
     """
-    Get data for single TF
+    Get edges for single TF in long format, one row per target and analysis
+
+    Results are kept in the memory cache for a short time, shared between queries.
     :param query:
     :param edges:
     :param tf_filter_list:
     :param target_filter_list:
-    :return:
+    :return: TF name, edges
     """
+    result = mem_cache.get_or_set(tf_cache_key(query, edges, tf_filter_list, target_filter_list),
+                                  partial(fetch_tf_edges, query, edges, tf_filter_list, target_filter_list),
+                                  TF_CACHE_TIMEOUT)
+    progress.report('fetch', step=True)
+
+    return result
+
+
+def fetch_tf_edges(query: str,
+                   edges: Optional[List[str]] = None,
+                   tf_filter_list: Optional[pd.Series] = None,
+                   target_filter_list: Optional[pd.Series] = None) -> Tuple[str, pd.DataFrame]:
     anno = async_loader['annotations']
 
     if (tf_filter_list is not None and tf_filter_list.str.contains(rf'^{re.escape(query)}$', flags=re.I).any()) \
             or tf_filter_list is None:
-        analyses = Analysis.objects.filter(tf__gene_id__iexact=query)
+        tf_analyses = edge_store.analyses
+        tf_analyses = tf_analyses[tf_analyses['TF'].str.upper() == query.upper()]
 
-        if not analyses.exists():
+        if tf_analyses.empty:
             raise ValueError(f'"{query}" is not in database')
 
-        df = TargetFrame(
-            Interaction.objects.filter(analysis__in=analyses).values_list(
-                'target_id', 'analysis_id').iterator(),
-            columns=['id', 'ANALYSIS'])
+        analyses = tf_analyses['ANALYSIS'].tolist()
+
+        target_ids, analysis_ids = edge_store.interactions(analyses)
+        df = TargetFrame({'id': target_ids, 'ANALYSIS': analysis_ids})
         df = df.merge(anno['id'].reset_index(), on=['id'])
         if target_filter_list is not None:
             df = df[df['TARGET'].str.upper().isin(target_filter_list.str.upper())]
         df = df.reindex(columns=['TARGET', 'ANALYSIS', 'id'])
     else:
+        tf_analyses = None
         analyses = []
         df = TargetFrame(columns=['TARGET', 'ANALYSIS', 'id'])
 
     if not df.empty:
-        reg = TargetFrame(
-            Regulation.objects.filter(analysis__in=analyses).values_list(
-                'analysis_id', 'target_id', 'p_value', 'foldchange').iterator(),
-            columns=['ANALYSIS', 'id', PVALUE, LOG2FC])
+        reg = TargetFrame(dict(zip(['ANALYSIS', 'id', PVALUE, LOG2FC], edge_store.regulation(analyses))))
 
-        df.insert(2, 'EDGE', '+')
+        df.insert(2, 'EDGE', pd.Series('+', index=df.index, dtype=EDGE_DTYPE))
 
-        expressions = Analysis.objects.filter(
-            pk__in=analyses,
-            analysisdata__key__name='EXPERIMENT_TYPE',
-            analysisdata__value__iexact='expression'
-        ).values_list('pk', flat=True)
+        expressions = metadata_index.ids('EXPERIMENT_TYPE', 'expression')
 
         df.loc[df['ANALYSIS'].isin(expressions), 'EDGE'] = '*'
 
@@ -486,74 +675,159 @@ def get_tf_data(query: str,
 
         df = df.drop('id', axis=1)
 
-        df = (df.pivot(index='TARGET', columns='ANALYSIS')
-              .swaplevel(0, 1, axis=1)
-              .sort_index(axis=1, level=0, sort_remaining=False)
-              .dropna(axis=1, how='all'))
-    else:
-        df = TargetFrame(columns=[(np.nan, 'EDGE')])
-
     try:
-        query = anno.index[np.argmax(anno['id'] == analyses[0].tf_id)].upper()
-    except IndexError:
+        query = anno.index[np.argmax(anno['id'] == tf_analyses['tf_id'].iat[0])].upper()
+    except (IndexError, TypeError):
         query = query.upper()
 
-    q = initialize_column_name(query)
-    df.columns = pd.MultiIndex.from_tuples((q, *c) for c in df.columns)
+    return query, df
+
+
+def get_tf_data(query: str,
+                edges: Optional[List[str]] = None,
+                tf_filter_list: Optional[pd.Series] = None,
+                target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    """
+    Get data for single TF
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return:
+    """
+    query, df = get_tf_edges(query, edges, tf_filter_list, target_filter_list)
+
+    if not df.empty:
+        df = pivot_tf_edges(query, df)
+    else:
+        df = TargetFrame(columns=[(np.nan, 'EDGE')])
+        df.columns = pd.MultiIndex.from_tuples((initialize_column_name(query), *c) for c in df.columns)
+
     df.filter_string = query
 
     return df
 
 
-def get_all_interaction(qs):
-    return TargetFrame(qs.iterator(), columns=['id', 'ANALYSIS'])
+def build_target_frame(df: pd.DataFrame, names: Union[str, pd.Series]) -> TargetFrame:
+    """
+    Build a wide TargetFrame from edges in long format
+
+    Gives the frame of pivoting edges to one row per target and a column per TF, analysis and field, sorted by TF
+    and analysis, without empty columns. Values are written straight into arrays allocated for the columns with
+    values, so no intermediate wide frames are made. Text fields are categorical, with the categories of the edges.
+    :param df: edges with TARGET, ANALYSIS and field columns
+    :param names: TF of each edge, or the TF of all edges
+    :return:
+    """
+    fields = [f for f in df.columns if f in EDGE_FIELDS]
+
+    row_codes, targets = pd.factorize(df['TARGET'], sort=True)
+    analysis_codes, analyses = pd.factorize(df['ANALYSIS'], sort=True)
+
+    if isinstance(names, str):
+        name_codes, names = np.zeros(len(df), dtype=np.intp), [names]
+    else:
+        name_codes, names = pd.factorize(names, sort=True)
+
+    # columns are numbered by TF and analysis pair, then field
+    pair_codes, pairs = pd.factorize(name_codes.astype(np.int64) * len(analyses) + analysis_codes, sort=True)
+
+    col_keys, blocks = [], []
+
+    for i, field in enumerate(fields):
+        values = df[field]
+        numeric = values.dtype.kind == 'f'
+
+        if numeric:
+            values = values.to_numpy()
+            notna = ~np.isnan(values)
+        else:  # text as categorical codes
+            values = values.astype('category')
+            dtype = values.dtype
+            values = values.cat.codes.to_numpy()
+            notna = values >= 0
 
+        counts = np.bincount(pair_codes[notna], minlength=len(pairs))
+        positions = np.cumsum(counts > 0) - 1
 
-def get_all_regulation(qs):
-    return TargetFrame(qs.iterator(), columns=['ANALYSIS', 'id', PVALUE, LOG2FC])
+        block = np.full((np.count_nonzero(counts), len(targets)), np.nan if numeric else -1, dtype=values.dtype)
+        block[positions[pair_codes[notna]], row_codes[notna]] = values[notna]
 
+        col_keys.append(np.flatnonzero(counts) * len(fields) + i)
 
-def get_all_analyses(qs):
-    return TargetFrame(qs.iterator(), columns=['ANALYSIS', 'TF'])
+        if numeric:
+            blocks.append(TargetFrame(block.T, index=targets, copy=False))
+        else:
+            blocks.append(TargetFrame({j: pd.Categorical.from_codes(codes, dtype=dtype)
+                                       for j, codes in enumerate(block)}, index=targets))
+
+    col_keys = np.concatenate(col_keys) if col_keys else np.empty(0, dtype=np.int64)
+    order = np.argsort(col_keys, kind='stable')
+
+    if order.size:
+        pair_codes, field_codes = np.divmod(col_keys[order], len(fields))
+        name_codes, analysis_codes = np.divmod(pairs[pair_codes], len(analyses))
+        name_map = [initialize_column_name(n) for n in names]
+
+        columns = pd.MultiIndex.from_tuples(zip(map(name_map.__getitem__, name_codes.tolist()),
+                                                analyses[analysis_codes],
+                                                map(fields.__getitem__, field_codes.tolist())))
+    else:
+        columns = pd.MultiIndex(levels=[[], [], []], codes=[[], [], []])
+
+    if blocks:
+        # the only copy, to put columns of the blocks in order
+        result = pd.concat(blocks, axis=1, ignore_index=True, copy=False).take(order, axis=1)
+    else:
+        result = TargetFrame(index=targets)
+
+    result.index.name = 'TARGET'
+    result.columns = columns
+
+    return result
+
+
+def pivot_tf_edges(query: str, df: pd.DataFrame) -> TargetFrame:
+    df = build_target_frame(df, query)
+
+    progress.report('pivot', step=True)
+
+    return df
 
 
 def get_all_df(query: str,
                tf_filter_list: Optional[pd.Series] = None,
                target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
-    qs = Interaction.objects.values_list('target_id', 'analysis_id')
     anno = async_loader['annotations']
+    analyses = edge_store.analyses[['ANALYSIS', 'tf_id', 'TF']]
 
     if tf_filter_list is not None:
-        qs = qs.filter(analysis__tf_id__in=anno.loc[anno.index.str.upper().isin(tf_filter_list.str.upper()), 'id'])
-
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        interaction_task = executor.submit(get_all_interaction, qs)
-        regulation_task = executor.submit(get_all_regulation,
-                                          Regulation.objects.values_list('analysis_id', 'target_id', 'p_value',
-                                                                         'foldchange'))
-        analysis_task = executor.submit(get_all_analyses, Analysis.objects.values_list('id', 'tf__gene_id'))
+        analyses = analyses[analyses['tf_id'].isin(
+            anno.loc[anno.index.str.upper().isin(tf_filter_list.str.upper()), 'id'])]
+        target_ids, analysis_ids = edge_store.interactions(analyses['ANALYSIS'])
+    else:
+        target_ids, analysis_ids = edge_store.interactions()
 
-        df = interaction_task.result()
+    df = TargetFrame({'id': target_ids, 'ANALYSIS': analysis_ids})
 
-        df = df.merge(anno['id'].reset_index(), on='id')
-        df = df.reindex(columns=['TARGET', 'ANALYSIS', 'id'])
+    df = df.merge(anno['id'].reset_index(), on='id')
+    df = df.reindex(columns=['TARGET', 'ANALYSIS', 'id'])
 
-        if query == "multitype":
-            a = pd.DataFrame(Analysis.objects.filter(
-                analysisdata__key__name__iexact="EXPERIMENT_TYPE"
-            ).values_list('id', 'tf_id', 'analysisdata__value', named=True).iterator())
+    if query == "multitype":
+        a = pd.DataFrame(Analysis.objects.filter(
+            analysisdata__key__name__iexact="EXPERIMENT_TYPE"
+        ).values_list('id', 'tf_id', 'analysisdata__value', named=True).iterator())
 
-            a = a.groupby('tf_id').filter(lambda x: x['analysisdata__value'].nunique() > 1)
+        a = a.groupby('tf_id').filter(lambda x: x['analysisdata__value'].nunique() > 1)
 
-            df = df[df['ANALYSIS'].isin(a['id'])]
+        df = df[df['ANALYSIS'].isin(a['id'])]
 
-        if target_filter_list is not None:
-            df = df[df['TARGET'].str.upper().isin(target_filter_list.str.upper())]
+    if target_filter_list is not None:
+        df = df[df['TARGET'].str.upper().isin(target_filter_list.str.upper())]
 
-        analyses = analysis_task.result()
-        df = df.merge(analyses, on='ANALYSIS')
+    df = df.merge(analyses[['ANALYSIS', 'TF']], on='ANALYSIS')
 
-        reg = regulation_task.result()
+    reg = TargetFrame(dict(zip(['ANALYSIS', 'id', PVALUE, LOG2FC], edge_store.regulation())))
 
     df = df.merge(reg, on=['ANALYSIS', 'id'], how='left')
 
@@ -568,26 +842,35 @@ def replace_filter_str(col: Tuple[str, str, str], filter_string: str) -> Tuple[s
     return col[0], filter_string, col[2]
 
 
-def get_all_tf(query: str,
-               edges: Optional[List[str]] = None,
-               tf_filter_list: Optional[pd.Series] = None,
-               target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+def all_tf_cache_key(query: str) -> str:
+    return f'{query}/{data_version.version}'
+
+
+def get_all_tf_edges(query: str,
+                     edges: Optional[List[str]] = None,
+                     tf_filter_list: Optional[pd.Series] = None,
+                     target_filter_list: Optional[pd.Series] = None,
+                     analyses: Optional[Collection[int]] = None) -> pd.DataFrame:
     """
-    Get data for all TFs at once
+    Get edges for all TFs in long format, one row per target and analysis
     :param query:
     :param edges:
     :param tf_filter_list:
     :param target_filter_list:
+    :param analyses: only get edges of these analyses
     :return:
     """
     if tf_filter_list is None and target_filter_list is None:
-        df = mem_cache.get_or_set(query, partial(get_all_df, query))
+        df = mem_cache.get_or_set(all_tf_cache_key(query), partial(get_all_df, query))
     else:
         df = get_all_df(query, tf_filter_list, target_filter_list)
 
     if df.empty:
         raise ValueError("No data in database.")
 
+    if analyses is not None:
+        df = df[df['ANALYSIS'].isin(analyses)]
+
     if edges:
         try:
             df = add_edges(df, edges)
@@ -596,122 +879,202 @@ def get_all_tf(query: str,
 
     df = df.drop('id', axis=1)
 
-    df.insert(3, 'EDGE', np.nan)
+    df.insert(3, 'EDGE', pd.Series(np.nan, index=df.index, dtype=EDGE_DTYPE))
     df['EDGE'] = df['EDGE'].where(df[LOG2FC].notna() | df[PVALUE].notna(), '+')
 
-    expressions = Analysis.objects.filter(
-        analysisdata__key__name='EXPERIMENT_TYPE',
-        analysisdata__value__iexact='expression'
-    ).values_list('pk', flat=True)
+    expressions = metadata_index.ids('EXPERIMENT_TYPE', 'expression')
 
     df.loc[df[LOG2FC].isna() & df[PVALUE].isna() & (df['ANALYSIS'].isin(expressions)), 'EDGE'] = '*'
 
-    df = (df.set_index(['TF', 'ANALYSIS', 'TARGET'])
-          .unstack(level=[0, 1])
-          .reorder_levels([1, 2, 0], axis=1)
-          .sort_index(axis=1, level=[0, 1], sort_remaining=False)
-          .dropna(how='all', axis=1))
+    progress.report('fetch', step=True)
 
-    col_names = {c: initialize_column_name(c) for c in df.columns.levels[0]}
+    return df
 
-    df = df.rename(columns=col_names, level=0)
+
+def get_all_tf(query: str,
+               edges: Optional[List[str]] = None,
+               tf_filter_list: Optional[pd.Series] = None,
+               target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    """
+    Get data for all TFs at once
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return:
+    """
+    df = pivot_all_tf_edges(get_all_tf_edges(query, edges, tf_filter_list, target_filter_list))
 
     df.filter_string += query
 
     return df
 
 
-def get_tf(query: Union[pp.ParseResults, str, TargetFrame],
+def pivot_all_tf_edges(df: pd.DataFrame) -> TargetFrame:
+    df = build_target_frame(df, df['TF'])
+    df.columns.names = ['TF', 'ANALYSIS', None]
+
+    progress.report('pivot', step=True)
+
+    return df
+
+
+def get_modified_tf(tf: Gene,
+                    chain: Sequence[Modified],
+                    edges: Optional[List[str]] = None,
+                    tf_filter_list: Optional[pd.Series] = None,
+                    target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    """
+    Get data for a TF or all TFs with modifiers, filtering edges before they are pivoted
+    :param tf:
+    :param chain: modifiers from innermost outwards
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return:
+    """
+    name, df, filter_string = get_modified_edges(tf, chain, edges, tf_filter_list, target_filter_list)
+
+    if df.empty:
+        df = TargetFrame(index=pd.Index([], name='TARGET'), columns=pd.MultiIndex(levels=[[], [], []],
+                                                                                   codes=[[], [], []]))
+    elif tf.name in ALL_TFS_QUERIES:
+        df = pivot_all_tf_edges(df)
+    else:
+        df = pivot_tf_edges(name, df)
+
+    df.filter_string = filter_string
+
+    return df.rename(columns=partial(replace_filter_str, filter_string=filter_string), level=0)
+
+
+def relabel(df: TargetFrame) -> TargetFrame:
+    """
+    Copy of a result with new column ids, used when a result is reused within a query
+    :param df:
+    :return:
+    """
+    df = df.copy()
+
+    if len(df.columns):
+        names = {c: (*c[:2], str(uuid4())) for c in df.columns.get_level_values(0).unique()}
+        df.columns = pd.MultiIndex.from_tuples([(names[c[0]], *c[1:]) for c in df.columns])
+
+    return df
+
+
+def get_tf(query: Union[Node, str, TargetFrame],
            edges: Optional[List[str]] = None,
            tf_filter_list: Optional[pd.Series] = None,
-           target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+           target_filter_list: Optional[pd.Series] = None,
+           memo: Optional[SubplanMemo] = None) -> TargetFrame:
     """
-    Query TF DataFrame according to query
+    Query TF DataFrame according to query plan
+
+    Sub-plans repeated within the query are only evaluated once.
     :param query:
     :param edges:
     :param tf_filter_list:
     :param target_filter_list:
+    :param memo:
     :return:
     """
-    if isinstance(query, pp.ParseResults):
-        it = iter(query)
-        stack: Deque[Union[pd.DataFrame, str, pp.ParseResults]] = deque()
+    if memo is None:
+        memo = SubplanMemo(query)
+
+    if isinstance(query, Node) and query in memo:
+        return relabel(memo[query])
+
+    df = evaluate_plan(query, edges, tf_filter_list, target_filter_list, memo)
+
+    if isinstance(query, Node) and query in memo.repeated:
+        memo[query] = df
+        return relabel(df)
+
+    return df
+
+
+def evaluate_plan(query: Union[Node, str, TargetFrame],
+                  edges: Optional[List[str]],
+                  tf_filter_list: Optional[pd.Series],
+                  target_filter_list: Optional[pd.Series],
+                  memo: SubplanMemo) -> TargetFrame:
+    if isinstance(query, BinOp):
+        prec, succ = get_tf(query.left, edges, tf_filter_list, target_filter_list, memo), \
+                     get_tf(query.right, edges, tf_filter_list, target_filter_list, memo)
+
+        filter_string = prec.filter_string
+        if query.oper == 'and':
+            filter_string += ' and '
+
+            if prec.include and succ.include:
+                df = prec.merge(succ, how='inner', left_index=True, right_index=True)
+            elif not prec.include and succ.include:
+                df = succ.loc[~succ.index.isin(prec.index), :]
+            elif prec.include and not succ.include:
+                df = prec.loc[~prec.index.isin(succ.index), :]
+            else:  # not prec.include and not succ.include
+                df = prec.merge(succ, how='outer', left_index=True, right_index=True)
+                df.include = False
+        else:
+            filter_string += ' or '
+
+            # doesn't make much sense using not with or, but oh well
+            if prec.include and succ.include:
+                df = prec.merge(succ, how='outer', left_index=True, right_index=True)
+            elif not prec.include and succ.include:
+                df = succ
+            elif prec.include and not succ.include:
+                df = prec
+            else:
+                df = prec.merge(succ, how='inner', left_index=True, right_index=True)
+                df.include = False
+        filter_string = '(' + filter_string + succ.filter_string + ')'
 
         try:
-            while True:
-                curr = next(it)
-                if curr in ('and', 'or'):
-                    prec, succ = get_tf(stack.pop(), edges, tf_filter_list, target_filter_list), \
-                                 get_tf(next(it), edges, tf_filter_list, target_filter_list)
-
-                    filter_string = prec.filter_string
-                    if curr == 'and':
-                        filter_string += ' and '
-
-                        if prec.include and succ.include:
-                            df = prec.merge(succ, how='inner', left_index=True, right_index=True)
-                        elif not prec.include and succ.include:
-                            df = succ.loc[~succ.index.isin(prec.index), :]
-                        elif prec.include and not succ.include:
-                            df = prec.loc[~prec.index.isin(succ.index), :]
-                        else:  # not prec.include and not succ.include
-                            df = prec.merge(succ, how='outer', left_index=True, right_index=True)
-                            df.include = False
-                    else:
-                        filter_string += ' or '
-
-                        # doesn't make much sense using not with or, but oh well
-                        if prec.include and succ.include:
-                            df = prec.merge(succ, how='outer', left_index=True, right_index=True)
-                        elif not prec.include and succ.include:
-                            df = succ
-                        elif prec.include and not succ.include:
-                            df = prec
-                        else:
-                            df = prec.merge(succ, how='inner', left_index=True, right_index=True)
-                            df.include = False
-                    filter_string = '(' + filter_string + succ.filter_string + ')'
-
-                    try:
-                        df = df.dropna(axis=1, how='all')
-                    except IndexError:
-                        # beware of the shape of indices and columns
-                        df = TargetFrame(columns=pd.MultiIndex(levels=[[], [], []]))
-
-                    df.filter_string = filter_string
-
-                    if curr == 'and':
-                        # df = df.rename(columns=partial(replace_filter_str, filter_string=filter_string), level=0)
-                        df.columns = pd.MultiIndex.from_tuples([(replace_filter_str(c[0], filter_string), c[1], c[2]) for c in df.columns])
-
-                    stack.append(df)
-
-                elif curr == 'not':
-                    succ = get_tf(next(it), edges, tf_filter_list, target_filter_list)
-                    succ.include = not succ.include
-                    succ.filter_string = 'not ' + succ.filter_string
-                    stack.append(succ)
-                elif is_modifier(curr):
-                    prec = get_tf(stack.pop(), edges, tf_filter_list, target_filter_list)
-                    mod = get_mod(prec, curr)
-                    prec = prec[mod].dropna(how='all').dropna(how='all', axis=1)  # filter out empty tfs
-
-                    prec.filter_string += f'[{mod_to_str(curr[0])}]'
-                    prec = prec.rename(columns=partial(replace_filter_str, filter_string=prec.filter_string), level=0)
-
-                    stack.append(prec)
-                elif is_column_filter(curr):
-                    prec = get_tf(stack.pop(), edges, tf_filter_list, target_filter_list)
-                    prec = get_column_filter(prec, curr)
-
-                    stack.append(prec)
-                else:
-                    stack.append(curr)
-        except StopIteration:
-            return get_tf(stack.pop(), edges, tf_filter_list, target_filter_list)
+            df = df.dropna(axis=1, how='all')
+        except IndexError:
+            # beware of the shape of indices and columns
+            df = TargetFrame(columns=pd.MultiIndex(levels=[[], [], []]))
+
+        df.filter_string = filter_string
+
+        if query.oper == 'and':
+            # df = df.rename(columns=partial(replace_filter_str, filter_string=filter_string), level=0)
+            df.columns = pd.MultiIndex.from_tuples(
+                [(replace_filter_str(c[0], filter_string), c[1], c[2]) for c in df.columns])
+
+        return df
+    elif isinstance(query, Not):
+        succ = get_tf(query.operand, edges, tf_filter_list, target_filter_list, memo)
+        succ.include = not succ.include
+        succ.filter_string = 'not ' + succ.filter_string
+
+        return succ
+    elif isinstance(query, Modified):
+        pushed_down = split_modified(query)
+
+        if pushed_down is not None:
+            return get_modified_tf(*pushed_down, edges, tf_filter_list, target_filter_list)
+
+        prec = get_tf(query.operand, edges, tf_filter_list, target_filter_list, memo)
+        mod = get_mod(prec, query.modifier)
+        prec = prec[mod].dropna(how='all').dropna(how='all', axis=1)  # filter out empty tfs
+
+        prec.filter_string += f'[{query.text}]'
+        prec = prec.rename(columns=partial(replace_filter_str, filter_string=prec.filter_string), level=0)
+
+        return prec
+    elif isinstance(query, ColumnFilter):
+        prec = get_tf(query.operand, edges, tf_filter_list, target_filter_list, memo)
+
+        return get_column_filter(prec, query.filters)
     elif isinstance(query, (TargetFrame, TargetSeries)):
         return query
-    elif isinstance(query, str):
+    elif isinstance(query, (Gene, str)):
+        if isinstance(query, Gene):
+            query = query.name
+
         if query.lower() in {'andalltfs', 'all_tfs', 'multitype'}:
             return get_all_tf(query.lower(), edges, tf_filter_list, target_filter_list)
 
@@ -720,21 +1083,89 @@ def get_tf(query: Union[pp.ParseResults, str, TargetFrame],
         raise ValueError(query)
 
 
-def reorder_data(df: TargetFrame) -> TargetFrame:
+def get_engine() -> Callable[..., TargetFrame]:
+    """
+    Get the query evaluator selected by the QUERY_ENGINE setting
+    :return:
+    """
+    engine = getattr(settings, 'QUERY_ENGINE', 'pandas')
+
+    if engine == 'pandas':
+        return get_tf
+    if engine == 'sparse':
+        from .sparse_engine import get_tf_sparse
+        return get_tf_sparse
+
+    raise ValueError(f'Unknown QUERY_ENGINE "{engine}"')
+
+
+class ColumnStats(NamedTuple):
+    counts: pd.Series  # edges of each EDGE and Log2FC column
+    row_counts: TargetSeries  # edges of each target
+    induced: pd.Series  # positive fold changes of each Log2FC column
+    repressed: pd.Series  # negative fold changes of each Log2FC column
+
+    @property
+    def total(self) -> pd.Series:
+        """
+        Edges of each TF and analysis
+        """
+        return self.counts.groupby(level=[0, 1]).sum()
+
+
+def column_stats(df: pd.DataFrame) -> ColumnStats:
+    """
+    Count the edges of a query result once, for ordering it and the stats of the result
+
+    Stats are by label, so they still hold after the result is reordered.
+    :param df:
+    :return:
+    """
+    fields = df.columns.get_level_values(2)
+    edge_cols = np.flatnonzero(np.isin(fields, ['EDGE', LOG2FC]))
+    fc_cols = np.flatnonzero(fields == LOG2FC)
+
+    notna = df.iloc[:, edge_cols].notna().to_numpy()
+    fc = df.iloc[:, fc_cols].to_numpy(dtype=np.float64)
+
+    row_counts = TargetSeries(notna.sum(axis=1), index=df.index, name='Edge Count')
+
+    return ColumnStats(pd.Series(notna.sum(axis=0), index=df.columns[edge_cols]),
+                       row_counts,
+                       pd.Series((fc > 0).sum(axis=0), index=df.columns[fc_cols]),
+                       pd.Series((fc < 0).sum(axis=0), index=df.columns[fc_cols]))
+
+
+def reorder_data(df: TargetFrame, stats: Optional[ColumnStats] = None) -> TargetFrame:
     """
     Order by TF with most edges, then analysis with most edges within tf
+
+    Columns of TFs and analyses without EDGE or Log2FC columns are dropped.
     :param df:
+    :param stats: column stats of df, counted if missing
     :return:
     """
-    edges = clear_data(df)
+    if stats is None:
+        stats = column_stats(df)
+
+    total = stats.total
+
+    analysis_order = total.groupby(level=1).sum().sort_values(ascending=False)
+    tf_order = total.groupby(level=0).sum()
+    tf_total = tf_order.groupby(by=tf_order.index.map(itemgetter(0))).sum()
 
-    analysis_order = edges.groupby(level=1, axis=1).count().sum().sort_values(ascending=False)
-    tf_order = edges.groupby(level=0, axis=1).count().sum()
-    tf_total = tf_order.groupby(by=list(map(itemgetter(0), tf_order.index))).sum()
-    tf_reorder = sorted(tf_order.index, key=lambda i: (tf_total[i[0]], tf_order.at[i]), reverse=True)
+    # stable sort, most edges first
+    tf_reorder = tf_order.index[np.lexsort((-tf_order.to_numpy(),
+                                            -tf_total.reindex(tf_order.index.map(itemgetter(0))).to_numpy()))]
 
-    return (df.reindex(columns=analysis_order.index, level=1)
-            .reindex(columns=tf_reorder, level=0))
+    tf_rank = pd.Series(np.arange(len(tf_reorder)), index=tf_reorder)
+    analysis_rank = pd.Series(np.arange(len(analysis_order)), index=analysis_order.index)
+
+    tf_pos = tf_rank.reindex(df.columns.get_level_values(0)).to_numpy()
+    analysis_pos = analysis_rank.reindex(df.columns.get_level_values(1)).to_numpy()
+    keep = np.flatnonzero(~(np.isnan(tf_pos) | np.isnan(analysis_pos)))
+
+    return df.iloc[:, keep[np.lexsort((analysis_pos[keep], tf_pos[keep]))]]
 
 
 def get_metadata(ids: Sequence) -> pd.DataFrame:
@@ -746,15 +1177,15 @@ def get_metadata(ids: Sequence) -> pd.DataFrame:
     return df
 
 
-def get_tf_count(df: TargetFrame) -> TargetSeries:
-    counts = df.loc[:, (slice(None), slice(None), ['EDGE', 'Log2FC'])].count(axis=1)
-    counts.name = 'Edge Count'
+def get_tf_count(df: TargetFrame, stats: Optional[ColumnStats] = None) -> TargetSeries:
+    if stats is None:
+        stats = column_stats(df)
 
-    return counts
+    return stats.row_counts
 
 
-def add_tf_count(df: TargetFrame) -> TargetFrame:
-    counts = df.pipe(get_tf_count)
+def add_tf_count(df: TargetFrame, stats: Optional[ColumnStats] = None) -> TargetFrame:
+    counts = get_tf_count(df, stats)
 
     df = df.copy()
     df.columns = df.columns.to_flat_index()
@@ -820,16 +1251,17 @@ def parse_query(query: str,
                 tf_filter_list: Optional[pd.Series] = None,
                 target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
     try:
-        parse = expr.parseString(query, parseAll=True)
+        progress.report('parse')
+        plan = compile_query(query)
+        progress.set_total(len(genes(plan)))
 
-        if parse.getName() == 'function':
-            fname, *args = parse
-            return QUERY_FUNCS[fname](*args,
-                                      edges=edges,
-                                      tf_filter_list=tf_filter_list,
-                                      target_filter_list=target_filter_list)
+        if isinstance(plan, Function):
+            return QUERY_FUNCS[plan.name](*plan.args,
+                                          edges=edges,
+                                          tf_filter_list=tf_filter_list,
+                                          target_filter_list=target_filter_list)
 
-        result = get_tf(parse.get('query'), edges, tf_filter_list, target_filter_list)
+        result = get_engine()(plan, edges, tf_filter_list, target_filter_list)
 
         if result.empty or not result.include:
             raise QueryError('empty query')
@@ -843,13 +1275,20 @@ def parse_query(query: str,
         raise QueryError("Could not parse query") from e
 
 
-def get_total(df: pd.DataFrame) -> pd.DataFrame:
-    return df.pipe(clear_data).groupby(level=[0, 1], axis=1).count().sum()
+def get_total(df: pd.DataFrame, stats: Optional[ColumnStats] = None) -> pd.Series:
+    if stats is None:
+        stats = column_stats(df)
+
+    return stats.total
 
 
-def induce_repress_count(result: TargetFrame) -> pd.DataFrame:
-    fc_result = result.loc[:, (slice(None), slice(None), ['Log2FC'])]
-    return pd.DataFrame([(fc_result > 0).sum(axis=0), (fc_result < 0).sum(axis=0)], index=['induced', 'repressed'])
+def induce_repress_count(result: TargetFrame, stats: Optional[ColumnStats] = None) -> pd.DataFrame:
+    if stats is None:
+        stats = column_stats(result)
+
+    columns = result.columns[result.columns.get_level_values(2) == LOG2FC]  # in the order of the result
+
+    return pd.DataFrame([stats.induced, stats.repressed], index=['induced', 'repressed']).reindex(columns=columns)
 
 
 Id = Tuple[Tuple[str, str, str], int]
@@ -873,6 +1312,134 @@ def filter_df_by_ids(df: pd.DataFrame, ids: Ids) -> pd.DataFrame:
     return df.loc[:, list(map(lambda c: itemgetter(0, 1)(c) in show_ids, df.columns))]
 
 
+def filter_df_by_user_lists(df: pd.DataFrame, user_lists: UserGeneLists) -> pd.DataFrame:
+    df = filter_rows_by_user_lists(df, user_lists)
+
+    return reorder_data(df)  # reorder again here due to filtering
+
+
+def filter_rows_by_user_lists(df: pd.DataFrame, user_lists: UserGeneLists) -> pd.DataFrame:
+    df = df[df.index.str.upper().isin(user_lists[0].index.str.upper())].dropna(axis=1, how='all')
+
+    if df.empty:
+        raise QueryError("Empty result (user list too restrictive).")
+
+    return df
+
+
+def derive_tabular_output(uid: Union[str, UUID], result: pd.DataFrame, ids: Ids,
+                          user_lists: Optional[UserGeneLists] = None) -> pd.DataFrame:
+    """
+    Query result with hidden analyses removed, and filtered by the user gene lists if there are any
+
+    The filtered result is not stored, it is derived from the unfiltered result when needed.
+    :param uid:
+    :param result: unfiltered query result
+    :param ids:
+    :param user_lists:
+    :return:
+    """
+    result = filter_df_by_ids(result, ids)
+
+    if user_lists is not None:
+        result = filter_df_by_user_lists(result, user_lists)
+
+    return result
+
+
+result_store.derive('tabular_output', derive_tabular_output, ('tabular_output_unfiltered', 'analysis_ids'),
+                    optional=('target_genes',))
+
+
+def result_fingerprint(query: str,
+                       edges: Optional[List[str]] = None,
+                       tf_filter_list: Optional[pd.Series] = None,
+                       target_filter_list: Optional[pd.Series] = None) -> str:
+    """
+    Fingerprint of everything the unfiltered result of a query depends on
+
+    Queries are compared by query plan, so spacing, case and named queries written out in full don't matter.
+    Uploaded target gene lists are not part of it, they only filter the result afterwards.
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return:
+    """
+    try:
+        plan = compile_query(query)
+    except pp.ParseException as e:
+        raise QueryError("Could not parse query") from e
+
+    return hashlib.md5('\n'.join([str(data_version.version), repr(plan), ','.join(sorted(edges or [])),
+                                   list_key(tf_filter_list), list_key(target_filter_list)]).encode()).hexdigest()
+
+
+def shared_result_key(query: str,
+                      edges: Optional[List[str]] = None,
+                      tf_filter_list: Optional[pd.Series] = None,
+                      target_filter_list: Optional[pd.Series] = None) -> str:
+    fingerprint = result_fingerprint(query, edges, tf_filter_list, target_filter_list)
+    return f'query-{fingerprint}/tabular_output_unfiltered'
+
+
+def store_shared_result(query: str,
+                        edges: Optional[List[str]] = None,
+                        tf_filter_list: Optional[pd.Series] = None,
+                        target_filter_list: Optional[pd.Series] = None) -> bool:
+    """
+    Run query and store it as a shared result, unless it is already stored
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return: if the query was run
+    """
+    shared_key = shared_result_key(query, edges, tf_filter_list, target_filter_list)
+
+    if result_store.touch(shared_key):
+        return False
+
+    result_store.set(shared_key, parse_query(query, edges, tf_filter_list, target_filter_list))
+
+    return True
+
+
+def get_shared_result(uid: Union[str, UUID],
+                      query: str,
+                      edges: Optional[List[str]] = None,
+                      tf_filter_list: Optional[pd.Series] = None,
+                      target_filter_list: Optional[pd.Series] = None) -> pd.DataFrame:
+    """
+    Unfiltered query result, stored as {uid}/tabular_output_unfiltered
+
+    Results are shared by fingerprint. A query that was already run by anyone with the same data and filters is
+    linked to the stored result instead of being run again.
+    :param uid:
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return:
+    """
+    shared_key = shared_result_key(query, edges, tf_filter_list, target_filter_list)
+    key = f'{uid}/tabular_output_unfiltered'
+
+    if result_store.link(key, shared_key):
+        result = result_store.get(key)
+        if result is not None:
+            logger.info(f"shared result {shared_key}")
+            return result
+
+    result = parse_query(query, edges, tf_filter_list, target_filter_list)
+
+    result_store.set(shared_key, result)
+    if not result_store.link(key, shared_key):
+        result_store.set(key, result)
+
+    return result
+
+
 def get_query_result(query: Optional[str] = None,
                      uid: Optional[Union[str, UUID]] = None,
                      user_lists: Optional[UserGeneLists] = None,
@@ -897,17 +1464,16 @@ def get_query_result(query: Optional[str] = None,
         uid = uuid4()
 
     if query is not None:  # Check if cached
-        result = parse_query(query, edges, tf_filter_list, target_filter_list)
+        result = get_shared_result(uid, query, edges, tf_filter_list, target_filter_list)
         metadata = get_metadata(result.columns.get_level_values(1))
         ids = get_result_ids(result)
 
-        cache.set_many({
-            f'{uid}/tabular_output_unfiltered': result,
+        result_store.set_many({
             f'{uid}/metadata': metadata,
             f'{uid}/analysis_ids': ids
         })
     else:
-        data = cache.get_many([
+        data = result_store.get_many([
             f'{uid}/tabular_output_unfiltered',
             f'{uid}/analysis_ids'
         ])
@@ -920,37 +1486,38 @@ def get_query_result(query: Optional[str] = None,
         result = filter_df_by_ids(result, ids)
         metadata = get_metadata(result.columns.get_level_values(1))
 
-        cache.set(f'{uid}/metadata', metadata)
+        result_store.set(f'{uid}/metadata', metadata)
+
+    progress.report('filter')
+
+    col_stats = column_stats(result)
 
     stats = {
-        'total': get_total(result)
+        'total': get_total(result, col_stats)
     }
 
     if user_lists is None and query is None:
-        user_lists = cache.get(f'{uid}/target_genes')
+        user_lists = result_store.get(f'{uid}/target_genes')
 
     if user_lists is not None:
-        result = result[result.index.str.upper().isin(user_lists[0].index.str.upper())].dropna(axis=1, how='all')
-
-        if result.empty:
-            raise QueryError("Empty result (user list too restrictive).")
-
-        result = reorder_data(result)  # reorder again here due to filtering
+        result = filter_rows_by_user_lists(result, user_lists)
+        col_stats = column_stats(result)
+        result = reorder_data(result, col_stats)
 
-        stats['edge_counts'] = get_total(result)
+        stats['edge_counts'] = get_total(result, col_stats)
     else:
         stats['edge_counts'] = stats['total']
 
-    stats['induce_repress_count'] = result.pipe(induce_repress_count)
+    stats['induce_repress_count'] = induce_repress_count(result, col_stats)
 
-    cache.set_many({f'{uid}/tabular_output': result})
+    result_store.set(f'{uid}/tabular_output', result)  # derived, only kept in memory
 
     logger.info(f"Unfiltered Dataframe size: {result.size}")
 
     if size_limit is not None and result.size > size_limit:
         raise QueryError("Result too large.")
 
-    result = result.pipe(add_tf_count)
+    result = add_tf_count(result, col_stats)
 
     if user_lists:
         result = user_lists[0].merge(result,
@@ -0,0 +1,99 @@
+"""
+Progress of the query running in the current thread.
+
+Query code reports the phase it is in with :func:`report`, which does nothing unless the query runs inside
+:func:`tracking`, as query jobs do. Fetching and pivoting are reported once per TF, so their share of the percent
+done grows with the number of TFs in the query.
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+PHASES = {  # phase: range of percent done
+    'parse': (0, 5),
+    'fetch': (5, 50),
+    'pivot': (50, 70),
+    'filter': (70, 85),
+    'format': (85, 100)
+}
+
+
+class Progress:
+    """
+    Phase and percent done of a query
+
+    callback is called with the phase and percent done when the phase changes, and at most every interval seconds
+    when only the percent done changes.
+    """
+
+    def __init__(self, callback: Callable[[str, float], None], interval: float = 0.5):
+        self.callback = callback
+        self.interval = interval
+        self.phase: Optional[str] = None
+        self.percent = 0.0
+        self.total = 1
+        self.steps: Counter = Counter()
+        self._reported = 0.0
+
+    def set_total(self, total: int):
+        """
+        Set the number of TFs to fetch
+        :param total:
+        :return:
+        """
+        self.total = max(total, 1)
+
+    def update(self, phase: str, step: bool = False):
+        if step:
+            self.steps[phase] += 1
+
+        start, end = PHASES[phase]
+        percent = start + (end - start) * min(self.steps[phase] / self.total, 1)
+        self.percent = max(self.percent, percent)
+
+        now = time.monotonic()
+
+        if phase != self.phase or now - self._reported >= self.interval:
+            self.phase = phase
+            self._reported = now
+            self.callback(phase, round(self.percent, 1))
+
+
+_current: ContextVar[Optional[Progress]] = ContextVar('query_progress', default=None)
+
+
+def report(phase: str, step: bool = False):
+    """
+    Report the phase of the current query
+    :param phase: one of PHASES
+    :param step: a TF was fetched or pivoted
+    :return:
+    """
+    progress = _current.get()
+
+    if progress is not None:
+        progress.update(phase, step)
+
+
+def set_total(total: int):
+    progress = _current.get()
+
+    if progress is not None:
+        progress.set_total(total)
+
+
+@contextmanager
+def tracking(progress: Progress) -> Iterator[Progress]:
+    """
+    Report the progress of queries run in the block to progress
+    :param progress:
+    :return:
+    """
+    token = _current.set(progress)
+
+    try:
+        yield progress
+    finally:
+        _current.reset(token)
@@ -0,0 +1,152 @@
+"""
+Size of a query result estimated from its plan, before any edges are fetched.
+
+A result has a row for each target, a few columns about the target and a column for each field of each analysis:
+Pvalue and Log2FC for analyses with regulation data, EDGE for the rest. The number of columns and distinct targets
+of each TF are counted from the edge store once per load.
+
+Estimates are upper bounds. "or" adds up rows, "and" keeps the smaller side, and modifiers and column filters are
+assumed to keep everything. Estimates only decide whether a query is heavy, see :mod:`querytgdb.utils.jobs`.
+"""
+import threading
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from querytgdb.utils.edge_store import EdgeArrays, edge_store
+from querytgdb.utils.file import UserGeneLists
+from querytgdb.utils.query_plan import ALL_TFS_QUERIES, BinOp, Gene, Node, children
+
+BYTES_PER_CELL = 16  # a float or pointer, and about as much again for the formatted result
+INFO_COLUMNS = 7  # target annotations, user lists and edge count
+
+
+class Cost(NamedTuple):
+    rows: int
+    columns: int
+
+    @property
+    def cells(self) -> int:
+        return self.rows * self.columns
+
+    @property
+    def bytes(self) -> int:
+        return self.cells * BYTES_PER_CELL
+
+    def __str__(self):
+        return f'about {self.rows:,} targets by {self.columns:,} columns, {self.cells:,} cells ' \
+               f'or {self.bytes / 2 ** 30:.1f} GB'
+
+
+class TfCounts(NamedTuple):
+    counts: pd.DataFrame  # columns and targets by upper case TF
+    targets: int  # distinct targets of all TFs
+
+
+def count_tfs(data: EdgeArrays) -> TfCounts:
+    """
+    Count result columns and distinct targets of each TF
+    :param data:
+    :return:
+    """
+    analysis_ids, edges = np.unique(data.analysis, return_counts=True)
+    tfs = data.analyses.set_index('ANALYSIS')['TF'].str.upper().reindex(analysis_ids)
+    codes, names = pd.factorize(tfs)
+
+    regulation = np.isin(analysis_ids, data.reg_analysis)
+
+    edge_codes = np.repeat(codes, edges).astype(np.int64)
+    keys = np.unique((edge_codes << 32) | data.target.astype(np.int64))
+    keys = keys[keys >= 0]  # analyses without TF
+
+    known = codes >= 0
+    counts = pd.DataFrame({
+        'columns': np.bincount(codes[known], weights=1 + regulation[known], minlength=len(names)),
+        'targets': np.bincount(keys >> 32, minlength=len(names))
+    }, index=names).astype(int)
+
+    return TfCounts(counts, np.unique(data.target).size)
+
+
+class CostModel:
+    """
+    Thread safe TF counts, counted again after the edge store is reloaded
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation: Optional[int] = None
+        self._counts: Optional[TfCounts] = None
+
+    @property
+    def counts(self) -> TfCounts:
+        with self._lock:
+            data = edge_store.data
+            generation = edge_store.generation
+
+            if self._counts is None or self._generation != generation:
+                self._counts = count_tfs(data)
+                self._generation = generation
+
+            return self._counts
+
+    def estimate(self, plan: Node,
+                 tf_filter_list: Optional[pd.Series] = None,
+                 target_filter_list: Optional[pd.Series] = None,
+                 user_lists: Optional[UserGeneLists] = None) -> Cost:
+        return estimate_plan(plan, self.counts, tf_filter_list, target_filter_list, user_lists)
+
+
+def estimate_node(node: Node, counts: pd.DataFrame, targets: int) -> Cost:
+    if isinstance(node, Gene) and node.name.lower() not in ALL_TFS_QUERIES:
+        try:
+            return Cost(*counts.loc[node.name.upper(), ['targets', 'columns']])
+        except KeyError:  # not in database, fails when it is run
+            return Cost(0, 0)
+
+    if isinstance(node, BinOp):
+        left, right = estimate_node(node.left, counts, targets), estimate_node(node.right, counts, targets)
+        rows = min(left.rows + right.rows, targets) if node.oper == 'or' else min(left.rows, right.rows)
+
+        return Cost(rows, left.columns + right.columns)
+
+    operands = list(children(node))
+    if operands:  # not, modifiers and column filters
+        return estimate_node(operands[0], counts, targets)
+
+    return Cost(targets, int(counts['columns'].sum()))  # all TFs and functions over the filter TFs
+
+
+def estimate_plan(plan: Node,
+                  tf_counts: TfCounts,
+                  tf_filter_list: Optional[pd.Series] = None,
+                  target_filter_list: Optional[pd.Series] = None,
+                  user_lists: Optional[UserGeneLists] = None) -> Cost:
+    """
+    Estimate the size of the result of a plan
+    :param plan:
+    :param tf_counts:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :param user_lists:
+    :return:
+    """
+    counts, targets = tf_counts
+
+    if tf_filter_list is not None:
+        counts = counts[counts.index.isin(tf_filter_list.str.upper())]
+        targets = min(targets, int(counts['targets'].sum()))
+
+    if target_filter_list is not None:
+        targets = min(targets, len(target_filter_list))
+
+    if user_lists is not None:
+        targets = min(targets, len(user_lists[0].index))
+
+    cost = estimate_node(plan, counts, targets)
+
+    return Cost(min(cost.rows, targets), cost.columns + INFO_COLUMNS)
+
+
+cost_model = CostModel()
@@ -0,0 +1,271 @@
+"""
+Immutable query plans built from parsed queries.
+
+Plans are hashable, so they can be cached and used as keys. The plan keeps the operand order as written,
+since it shows up in the result column names.
+"""
+import re
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Deque, Dict, Iterator, Set, Tuple, Union
+
+import pyparsing as pp
+
+ALL_TFS_QUERIES = frozenset({'andalltfs', 'all_tfs', 'multitype'})
+
+
+def is_name(key: str, item: Union[pp.ParseResults, Any]) -> bool:
+    try:
+        return item.getName() == key
+    except AttributeError:
+        return False
+
+
+is_modifier = partial(is_name, 'modifier')
+is_mod = partial(is_name, 'mod')
+is_column_filter = partial(is_name, 'column_filter')
+
+
+def mod_to_str(curr: pp.ParseResults) -> str:
+    if isinstance(curr, str):
+        return curr
+
+    if isinstance(curr, pp.ParseResults) and curr.getName() != 'mod':
+        return '(' + ' '.join(map(mod_to_str, curr)) + ')'
+
+    try:
+        return ' '.join(map(mod_to_str, curr))
+    except TypeError:
+        return str(curr)
+
+
+class Node:
+    """
+    Base class of query plan nodes
+    """
+
+
+@dataclass(frozen=True)
+class Gene(Node):
+    name: str
+
+
+@dataclass(frozen=True)
+class Not(Node):
+    operand: Node
+
+
+@dataclass(frozen=True)
+class BinOp(Node):
+    oper: str
+    left: Node
+    right: Node
+
+
+@dataclass(frozen=True)
+class Predicate(Node):
+    key: str
+    oper: str
+    value: Union[str, int, float]
+
+
+@dataclass(frozen=True)
+class ModNot(Node):
+    operand: Node
+
+
+@dataclass(frozen=True)
+class ModBinOp(Node):
+    oper: str
+    left: Node
+    right: Node
+
+
+@dataclass(frozen=True)
+class Modified(Node):
+    operand: Node
+    modifier: Node
+    text: str  # modifier as written, used in filter strings
+
+
+@dataclass(frozen=True)
+class ColumnFilter(Node):
+    operand: Node
+    filters: Tuple[Predicate, ...]
+
+
+@dataclass(frozen=True)
+class Function(Node):
+    name: str
+    args: Tuple[str, ...]
+
+
+QUOTED = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')')
+# quoted strings, modifiers and column filters, matched case sensitively or kept as written
+CASED = re.compile(r'({0}|\[(?:{0}|[^]"\'])*]|{{(?:{0}|[^}}"\'])*}})'.format(QUOTED.pattern[1:-1]))
+FUNCTION = re.compile(r'\s*(?!not\b)[^\W\d]\w*\s*\(', re.I)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Collapse whitespace outside of quoted strings
+    :param query:
+    :return:
+    """
+    parts = QUOTED.split(query)
+    parts[::2] = [re.sub(r'\s+', ' ', p) for p in parts[::2]]
+
+    return ''.join(parts).strip()
+
+
+def fold_query(query: str) -> str:
+    """
+    Lower case the parts of a query that are matched case insensitively
+
+    Gene names, named queries and operators are folded. Quoted strings, modifiers, column filters and function
+    calls are kept as written, since they show up in the result or are matched case sensitively.
+    :param query:
+    :return:
+    """
+    if FUNCTION.match(query):
+        return query
+
+    parts = CASED.split(query)
+    parts[::2] = [p.lower() for p in parts[::2]]
+
+    return ''.join(parts)
+
+
+def make_gene(name: str) -> Gene:
+    if name.lower() in ALL_TFS_QUERIES:
+        return Gene(name.lower())
+
+    return Gene(name.upper())
+
+
+def make_predicate(mod: pp.ParseResults) -> Predicate:
+    return Predicate(mod['key'], mod['oper'], mod['value'])
+
+
+def build_modifier(query: Union[pp.ParseResults, Node]) -> Node:
+    if isinstance(query, Node):
+        return query
+
+    if 'key' in query:
+        return make_predicate(query)
+
+    it = iter(query)
+    stack: Deque[Union[pp.ParseResults, Node]] = deque()
+
+    try:
+        while True:
+            curr = next(it)
+            if curr in ('and', 'or'):
+                prec, succ = build_modifier(stack.pop()), build_modifier(next(it))
+                stack.append(ModBinOp(curr, prec, succ))
+            elif curr == 'not':
+                stack.append(ModNot(build_modifier(next(it))))
+            else:
+                stack.append(curr)
+    except StopIteration:
+        return build_modifier(stack.pop())
+
+
+def build_plan(query: Union[pp.ParseResults, Node, str]) -> Node:
+    """
+    Build query plan from the parsed query
+    :param query:
+    :return:
+    """
+    if isinstance(query, Node):
+        return query
+
+    if isinstance(query, str):
+        return make_gene(query)
+
+    if not isinstance(query, pp.ParseResults):
+        raise ValueError(query)
+
+    it = iter(query)
+    stack: Deque[Union[pp.ParseResults, Node, str]] = deque()
+
+    try:
+        while True:
+            curr = next(it)
+            if curr in ('and', 'or'):
+                prec, succ = build_plan(stack.pop()), build_plan(next(it))
+                stack.append(BinOp(curr, prec, succ))
+            elif curr == 'not':
+                stack.append(Not(build_plan(next(it))))
+            elif is_modifier(curr):
+                stack.append(Modified(build_plan(stack.pop()), build_modifier(curr), mod_to_str(curr[0])))
+            elif is_column_filter(curr):
+                stack.append(ColumnFilter(build_plan(stack.pop()), tuple(map(make_predicate, curr))))
+            else:
+                stack.append(curr)
+    except StopIteration:
+        return build_plan(stack.pop())
+
+
+def children(node: Node) -> Iterator[Node]:
+    if isinstance(node, BinOp):
+        yield node.left
+        yield node.right
+    elif isinstance(node, (Not, Modified, ColumnFilter)):
+        yield node.operand
+
+
+def genes(plan: Node) -> Set[Gene]:
+    """
+    TFs a plan fetches, including all TFs queries
+    :param plan:
+    :return:
+    """
+    found = set()
+    stack = [plan]
+
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Gene):
+            found.add(node)
+        stack.extend(children(node))
+
+    return found
+
+
+def repeated_subplans(plan: Node) -> Set[Node]:
+    """
+    Sub-plans that appear more than once in a plan
+    :param plan:
+    :return:
+    """
+    counts: Dict[Node, int] = defaultdict(int)
+    stack = [plan]
+
+    while stack:
+        node = stack.pop()
+        counts[node] += 1
+        stack.extend(children(node))
+
+    return {node for node, count in counts.items() if count > 1}
+
+
+class SubplanMemo:
+    """
+    Results of repeated sub-plans within one query
+    """
+
+    def __init__(self, plan: Node):
+        self.repeated = repeated_subplans(plan) if isinstance(plan, Node) else set()
+        self.results: Dict[Node, Any] = {}
+
+    def __contains__(self, item):
+        return item in self.results
+
+    def __getitem__(self, item):
+        return self.results[item]
+
+    def __setitem__(self, key, value):
+        if key in self.repeated:
+            self.results[key] = value
@@ -0,0 +1,279 @@
+"""
+Result store backend on Redis, so requests of one session can go to any worker on any host.
+
+An entry is a small meta key, ``{prefix}result:{uid}/{name}``, naming the chunks that hold its value,
+``{prefix}chunk:{token}:{i}``. Values, compressed by the result store, are split in chunks of at most ``CHUNK_SIZE``
+bytes, since Redis doesn't take values over 512MB. Every write has a new token, so a value is never changed in place
+and a reader never mixes chunks of two writes. Linked keys share chunks.
+
+Everything expires by itself: chunks and meta keys are written with the timeout of the store, touching or linking
+an entry extends both. Chunks of replaced or deleted entries stay until they expire, since other keys might be
+linked to them.
+
+``redis`` is only imported when a Redis URL is configured. :class:`FakeRedis` runs the few commands used here in
+process, for tests and development with a single process.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+import pyarrow as pa
+from django.core.exceptions import ImproperlyConfigured
+
+CHUNK_SIZE = 256 * 2 ** 20
+LOCK_TIMEOUT = 60  # seconds a lock is held at most, in case its holder dies
+
+
+class Meta(NamedTuple):
+    token: str
+    size: int
+    chunks: int
+
+    @classmethod
+    def parse(cls, value: bytes) -> 'Meta':
+        token, size, chunks = value.decode().split(' ')
+        return cls(token, int(size), int(chunks))
+
+    def encode(self) -> bytes:
+        return ' '.join(map(str, self)).encode()
+
+
+class FakeRedis:
+    """
+    In-process stand-in for a Redis client, with the commands the Redis backend uses
+
+    Commands of a pipeline run together when it is executed, like a MULTI/EXEC transaction.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._lock = threading.RLock()
+        self._data: Dict[str, Tuple[bytes, Optional[float]]] = {}
+
+    def _get(self, key: str) -> Optional[bytes]:
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return None
+
+        if expires is not None and expires <= self.clock():
+            del self._data[key]
+            return None
+
+        return value
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        with self._lock:
+            return [self._get(k) for k in keys]
+
+    def set(self, key: str, value: Any, px: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+        if isinstance(value, str):
+            value = value.encode()
+
+        with self._lock:
+            if nx and self._get(key) is not None:
+                return None
+
+            self._data[key] = (bytes(value), None if px is None else self.clock() + px / 1000)
+
+        return True
+
+    def pexpire(self, key: str, px: int) -> bool:
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                return False
+
+            self._data[key] = (value, self.clock() + px / 1000)
+
+        return True
+
+    def delete(self, *keys: str) -> int:
+        with self._lock:
+            return sum(self._data.pop(k, None) is not None for k in keys)
+
+    def pipeline(self, transaction: bool = True) -> 'FakePipeline':
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self._commands: List[Tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, name: str):
+        if name not in ('get', 'mget', 'set', 'pexpire', 'delete'):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self) -> List[Any]:
+        with self.client._lock:
+            results = [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+
+        self._commands = []
+
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._commands = []
+
+
+class RedisBackend:
+    """
+    Result store backend on a Redis client, see the module documentation for the layout
+    """
+
+    def __init__(self, client, timeout: float = 3600, prefix: str = 'connectf:', chunk_size: int = CHUNK_SIZE):
+        self.client = client
+        self.timeout = timeout
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.shared = not isinstance(client, FakeRedis)  # seen by other processes
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = 3600, **kwargs) -> 'RedisBackend':
+        """
+        Backend on the Redis server at url, or on a :class:`FakeRedis` for fake:// URLs
+        :param url:
+        :param timeout:
+        :param kwargs:
+        :return:
+        """
+        if urlsplit(url).scheme == 'fake':
+            return cls(FakeRedis(), timeout, **kwargs)
+
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured(f"install connectf-backend[redis] to store results at {url}") from e
+
+        return cls(redis.Redis.from_url(url), timeout, **kwargs)
+
+    @property
+    def _ttl(self) -> int:
+        return max(int(self.timeout * 1000), 1)
+
+    def path(self, uid: str, name: str) -> str:
+        return f'{self.prefix}result:{uid}/{name}'
+
+    def _chunk_keys(self, meta: Meta) -> List[str]:
+        return [f'{self.prefix}chunk:{meta.token}:{i}' for i in range(meta.chunks)]
+
+    def _meta(self, path: str) -> Meta:
+        value = self.client.get(path)
+
+        if value is None:
+            raise FileNotFoundError(path)
+
+        return Meta.parse(value)
+
+    def signature(self, path: str) -> Tuple[str, int]:
+        """
+        Token and size of the value, raises FileNotFoundError if it is missing or expired
+        :param path:
+        :return:
+        """
+        meta = self._meta(path)
+
+        return meta.token, meta.size
+
+    def read(self, path: str) -> Tuple[Tuple, pa.Buffer]:
+        meta = self._meta(path)
+        chunks = self.client.mget(self._chunk_keys(meta))
+
+        if any(c is None for c in chunks):
+            raise FileNotFoundError(path)
+
+        data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+        return (meta.token, meta.size), pa.py_buffer(data)
+
+    def write(self, path: str, data: Any) -> Tuple[str, int]:
+        data = pa.py_buffer(data)
+
+        view = memoryview(data)[:data.size]  # resizable buffers can show their capacity
+        chunks = [view[i:i + self.chunk_size] for i in range(0, max(view.nbytes, 1), self.chunk_size)]
+        meta = Meta(uuid4().hex, data.size, len(chunks))
+
+        with self.client.pipeline() as pipe:
+            for key, chunk in zip(self._chunk_keys(meta), chunks):
+                pipe.set(key, chunk, px=self._ttl)
+            pipe.set(path, meta.encode(), px=self._ttl)
+            pipe.execute()
+
+        return meta.token, meta.size
+
+    @contextmanager
+    def lock(self, path: str) -> Iterator[None]:
+        """
+        Hold a lock on path, across hosts, while changing its value
+
+        The lock is a key set if missing, that expires after ``LOCK_TIMEOUT`` seconds.
+        :param path:
+        :return:
+        """
+        key = f'{path}:lock'
+        token = uuid4().hex.encode()
+
+        while not self.client.set(key, token, px=LOCK_TIMEOUT * 1000, nx=True):
+            time.sleep(0.05)
+
+        try:
+            yield
+        finally:
+            if self.client.get(key) == token:
+                self.client.delete(key)
+
+    def _expire(self, path: str, meta: Meta, value: Optional[bytes] = None) -> bool:
+        with self.client.pipeline() as pipe:
+            if value is not None:
+                pipe.set(path, value, px=self._ttl)
+            else:
+                pipe.pexpire(path, self._ttl)
+            for key in self._chunk_keys(meta):
+                pipe.pexpire(key, self._ttl)
+
+            return all(pipe.execute())
+
+    def touch(self, path: str) -> bool:
+        try:
+            meta = self._meta(path)
+        except FileNotFoundError:
+            return False
+
+        return self._expire(path, meta)
+
+    def link(self, path: str, target_path: str) -> bool:
+        value = self.client.get(target_path)
+
+        if value is None:
+            return False
+
+        meta = Meta.parse(value)
+
+        if not self._expire(target_path, meta) or not self._expire(path, meta, value):  # chunks expired
+            self.client.delete(path)
+            return False
+
+        return True
+
+    def delete(self, path: str):
+        self.client.delete(path)
+
+    def cull(self, force: bool = False):
+        pass  # everything expires by itself
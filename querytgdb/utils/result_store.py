@@ -0,0 +1,755 @@
+"""
+Store for the results of a query request.
+
+Everything a query leaves for the views that come after it (``{uid}/tabular_output``, ``{uid}/analysis_ids``,
+``{uid}/figure``...) is kept here. Data frames are written as Arrow IPC, so a subset of the columns can be read without
+decompressing or converting the rest. Anything else is pickled. Values over ``COMPRESSION['THRESHOLD']`` bytes are
+compressed with ``COMPRESSION['CODEC']``, see :class:`Compression`. Requests that run the same query share one stored
+value, see :meth:`ResultStore.link`.
+
+Where values are kept depends on ``LOCATION``:
+
+- a directory: one directory per request id and one file per key, memory mapped on load. Every process of a host
+  sees the same results, so all requests of a session have to go to the same host.
+- a ``redis://``, ``rediss://`` or ``unix://`` URL: values are kept in Redis, or anything that speaks its protocol,
+  split in chunks, see :mod:`querytgdb.utils.redis_store`. Requests can go to any host.
+- ``fake://``: an in-process stand-in for Redis, for tests and development with a single process.
+
+Entries expire ``TIMEOUT`` seconds after they were last written. Up to ``MEMORY_LIMIT`` bytes of loaded entries
+are kept in memory as well.
+"""
+import fcntl
+import logging
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, \
+    Union
+from urllib.parse import quote, urlsplit
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ARROW_MAGIC = b'ARROW1'
+AXES_KEY = b'pandas_axes'
+CATEGORICAL_KEY = b'pandas_categorical'
+COMPRESSED_MAGIC = b'CFZ1'  # pickles start with b'\x80', Arrow files with ARROW_MAGIC
+HEADER = struct.Struct('<4sBQ')  # magic, codec, uncompressed size
+CODECS = {'zstd': 1, 'lz4': 2}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+STATS = ('written', 'compressed', 'read', 'raw_bytes', 'stored_bytes', 'encode_seconds', 'decode_seconds')
+REDIS_SCHEMES = {'redis', 'rediss', 'unix', 'fake'}
+
+
+def frame_to_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Arrow table of a data frame
+
+    Columns are named by position, the row and column index are pickled into the schema metadata so labels of any
+    type survive. Float columns keep NaN as is, text columns are dictionary encoded. Categorical columns keep their
+    categories as the dictionary, and are marked to be read back as categorical.
+
+    Raises ArrowTypeError for object or categorical columns with anything but text and missing values.
+    :param df:
+    :return:
+    """
+    fields, arrays = [], []
+
+    for i, (_, s) in enumerate(df.items()):
+        values = s.to_numpy() if not isinstance(s.dtype, pd.CategoricalDtype) else None
+        metadata = None
+
+        if values is None:
+            array = pa.array(s.array)
+            if not pa.types.is_string(array.type.value_type):
+                raise pa.ArrowTypeError(f'cannot store {array.type} in categorical column')
+            metadata = {CATEGORICAL_KEY: b'1'}
+        elif values.dtype.kind == 'O':
+            array = pa.array(values, from_pandas=True)
+            if not (pa.types.is_string(array.type) or pa.types.is_null(array.type)):
+                raise pa.ArrowTypeError(f'cannot store {array.type} in object column')
+            if pa.types.is_string(array.type):
+                array = array.dictionary_encode()
+        else:
+            array = pa.array(values)
+
+        fields.append(pa.field(str(i), array.type, metadata=metadata))
+        arrays.append(array)
+
+    table = pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+    return table.replace_schema_metadata({AXES_KEY: pickle.dumps((df.index, df.columns), pickle.HIGHEST_PROTOCOL)})
+
+
+def column_values(array: pa.ChunkedArray, categorical: bool = False) -> Union[np.ndarray, pd.Categorical]:
+    """
+    Numpy array of a table column, text with missing values as NaN
+    :param array:
+    :param categorical: the column was categorical
+    :return:
+    """
+    array = array.combine_chunks()
+
+    if categorical:
+        return pd.Categorical.from_codes(array.indices.fill_null(-1).to_numpy(),
+                                         array.dictionary.to_numpy(zero_copy_only=False))
+
+    if pa.types.is_dictionary(array.type):
+        labels = np.append(array.dictionary.to_numpy(zero_copy_only=False), np.nan).astype(object)
+        return labels[array.indices.fill_null(-1).to_numpy()]
+
+    if pa.types.is_null(array.type):
+        return np.full(len(array), np.nan, dtype=object)
+
+    return array.to_numpy(zero_copy_only=False)
+
+
+def column_positions(column_index: pd.Index, columns: Any) -> Tuple[List[int], pd.Index]:
+    """
+    Positions and labels of df.loc[:, columns] for a frame with column_index
+    :param column_index:
+    :param columns:
+    :return:
+    """
+    positions = pd.DataFrame(np.arange(len(column_index))[np.newaxis, :]).set_axis(column_index, axis=1)
+    positions = positions.loc[:, columns]
+
+    return positions.iloc[0, :].tolist(), positions.columns
+
+
+def table_to_frame(table: pa.Table, columns: Any = None) -> pd.DataFrame:
+    """
+    Data frame of a table written by :func:`frame_to_table`
+    :param table: all columns, or at least the ones asked for
+    :param columns: only read these columns, any key that df.loc[:, columns] takes
+    :return:
+    """
+    index, column_index = pickle.loads(table.schema.metadata[AXES_KEY])
+
+    if columns is not None:
+        positions, column_index = column_positions(column_index, columns)
+        table = table.select([str(p) for p in positions])
+
+    df = pd.DataFrame({i: column_values(c, CATEGORICAL_KEY in (f.metadata or {}))
+                       for i, (f, c) in enumerate(zip(table.schema, table.columns))}, index=index)
+    df.columns = column_index
+
+    return df
+
+
+class Compression:
+    """
+    Compression of stored values, and how much it saves
+
+    Data frames are written as Arrow IPC files with compressed buffers, so reading some of the columns only
+    decompresses those. Pickled values get a header with the codec and uncompressed size. Values under threshold
+    bytes are stored as they are. Values are read whatever codec they were written with.
+
+    Uncompressed sizes of data frames are the sizes of their Arrow tables, which is close to the size of an
+    uncompressed file.
+    """
+
+    def __init__(self, codec: Optional[str] = 'zstd', level: Optional[int] = None, threshold: int = 64 * 2 ** 10):
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f'unsupported codec: {codec}')
+
+        self.codec = pa.Codec(codec, compression_level=level) if codec else None
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(STATS, 0)
+
+    def _count(self, **stats):
+        with self._lock:
+            for name, value in stats.items():
+                self._stats[name] += value
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Counts of values written and read by this process, their uncompressed and stored bytes, and the seconds spent
+        writing and reading them
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['saved_bytes'] = stats['raw_bytes'] - stats['stored_bytes']
+
+        return stats
+
+    def write_table(self, table: pa.Table) -> pa.Buffer:
+        start = time.perf_counter()
+        codec = self.codec if self.codec is not None and table.nbytes >= self.threshold else None
+
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=codec)) as writer:
+            writer.write_table(table)
+        data = sink.getvalue()
+
+        self._count(written=1, compressed=int(codec is not None), raw_bytes=table.nbytes if codec else data.size,
+                    stored_bytes=data.size, encode_seconds=time.perf_counter() - start)
+
+        return data
+
+    def read_table(self, data: pa.Buffer, columns: Any = None) -> pa.Table:
+        """
+        Table of an Arrow IPC file written by :meth:`write_table`
+        :param data:
+        :param columns: only read the columns of df.loc[:, columns], as in :func:`table_to_frame`
+        :return:
+        """
+        start = time.perf_counter()
+        reader = pa.ipc.open_file(data)
+
+        if columns is not None:
+            _index, column_index = pickle.loads(reader.schema.metadata[AXES_KEY])
+            fields = sorted(set(column_positions(column_index, columns)[0]))
+
+            if fields:  # no fields reads all
+                reader = pa.ipc.open_file(data, options=pa.ipc.IpcReadOptions(included_fields=fields))
+
+        table = reader.read_all()
+
+        self._count(read=1, decode_seconds=time.perf_counter() - start)
+
+        return table
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec is None or len(data) < self.threshold:
+            self._count(written=1, raw_bytes=len(data), stored_bytes=len(data))
+            return data
+
+        start = time.perf_counter()
+        compressed = HEADER.pack(COMPRESSED_MAGIC, CODECS[self.codec.name], len(data)) + \
+            self.codec.compress(data, asbytes=True)
+
+        self._count(written=1, compressed=1, raw_bytes=len(data), stored_bytes=len(compressed),
+                    encode_seconds=time.perf_counter() - start)
+
+        return compressed
+
+    def decompress(self, data: pa.Buffer) -> bytes:
+        start = time.perf_counter()
+
+        if data[:len(COMPRESSED_MAGIC)].to_pybytes() == COMPRESSED_MAGIC:
+            _magic, codec, size = HEADER.unpack(data[:HEADER.size].to_pybytes())
+            data = pa.Codec(CODEC_NAMES[codec]).decompress(data[HEADER.size:], decompressed_size=size, asbytes=True)
+        else:
+            data = data.to_pybytes()
+
+        self._count(read=1, decode_seconds=time.perf_counter() - start)
+
+        return data
+
+
+class MemoryEntry(NamedTuple):
+    signature: Tuple  # backend signature of the stored value, or of the sources of a derived value
+    value: Any  # data frame, pickled bytes or derived value
+    size: int
+
+
+class Derived(NamedTuple):
+    func: Callable[..., Any]
+    sources: Tuple[str, ...]
+    optional: Tuple[str, ...]
+
+
+def value_size(value: Any) -> int:
+    """
+    Approximate size of a value in memory, text in data frames is not counted
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, (tuple, list)):
+        return sum(map(value_size, value))
+    if isinstance(value, bytes):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class FileBackend:
+    """
+    Entries as files on the local file system, one directory per request id
+
+    Shared by the processes of one host. Files are replaced, never changed in place, and memory mapped on read.
+    """
+    shared = True  # seen by other processes
+
+    def __init__(self, location: str, timeout: float = 3600):
+        self.location = location
+        self.timeout = timeout
+        self._last_cull = time.time()
+        self._lock = threading.Lock()
+
+    def path(self, uid: str, name: str) -> str:
+        return os.path.join(self.location, quote(uid, safe=''), quote(name, safe=''))
+
+    def _expired(self, mtime: float) -> bool:
+        return mtime + self.timeout < time.time()
+
+    def signature(self, path: str) -> Tuple[int, int]:
+        """
+        Modification time and size of the file, raises FileNotFoundError if it is missing or expired
+        :param path:
+        :return:
+        """
+        stat = os.stat(path)
+
+        if stat.st_size == 0 or self._expired(stat.st_mtime):
+            raise FileNotFoundError(path)
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self, path: str) -> Tuple[Tuple, pa.Buffer]:
+        signature = self.signature(path)
+
+        return signature, pa.memory_map(path).read_buffer()
+
+    def write(self, path: str, data: Any) -> Tuple[int, int]:
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        stat = os.stat(path)
+
+        return stat.st_mtime_ns, stat.st_size
+
+    @contextmanager
+    def lock(self, path: str) -> Iterator[None]:
+        """
+        Hold a lock on path, across processes, while changing its value
+        :param path:
+        :return:
+        """
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, '.lock' + name), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def touch(self, path: str) -> bool:
+        try:
+            self.signature(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def link(self, path: str, target_path: str) -> bool:
+        try:
+            self.signature(target_path)
+        except FileNotFoundError:
+            return False
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        tmp_path = os.path.join(directory, f'.tmp{uuid4().hex}')
+        try:
+            try:
+                os.link(target_path, tmp_path)
+            except FileNotFoundError:  # removed in the mean time
+                return False
+            except OSError:  # no hard links on this file system
+                shutil.copyfile(target_path, tmp_path)
+
+            os.utime(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return True
+
+    def delete(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def cull(self, force: bool = False):
+        """
+        Remove requests with no entry written in the last timeout seconds, at most once every timeout / 10 seconds
+        unless forced
+        :param force:
+        :return:
+        """
+        now = time.time()
+
+        with self._lock:
+            if not force and now - self._last_cull < self.timeout / 10:
+                return
+            self._last_cull = now
+
+        try:
+            entries = list(os.scandir(self.location))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir() and all(self._expired(f.stat().st_mtime) for f in os.scandir(entry.path)):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    logger.debug(f"removed results of {entry.name}")
+            except FileNotFoundError:
+                pass
+
+
+def get_backend(location: str, timeout: float = 3600, options: Optional[Dict[str, Any]] = None):
+    """
+    Backend for a location, a directory or a redis://, rediss://, unix:// or fake:// URL
+    :param location:
+    :param timeout:
+    :param options: keyword arguments of the Redis backend
+    :return:
+    """
+    if urlsplit(location).scheme in REDIS_SCHEMES:
+        from querytgdb.utils.redis_store import RedisBackend
+
+        return RedisBackend.from_url(location, timeout, **(options or {}))
+
+    return FileBackend(location, timeout)
+
+
+class ResultStore:
+    """
+    Per request result store, with the get, set and delete methods of a Django cache
+
+    Keys are "{request_id}/{name}".
+
+    Up to memory_limit bytes of loaded values are also kept in memory, least recently used first out, so views of
+    the same request load a value once. Entries are checked against the backend on every get, so writes from other
+    processes are seen. Data frames are handed out as copies and everything else is unpickled on every get, so
+    callers can change what they get. Reads of some columns of a frame that isn't in memory only decode those
+    columns, and don't keep them.
+
+    Names registered with :meth:`derive` are not stored, they are computed from other entries of the same request
+    when needed and only kept in memory.
+    """
+
+    def __init__(self, location: str, timeout: float = 3600, memory_limit: int = 0,
+                 options: Optional[Dict[str, Any]] = None, compression: Optional[Compression] = None):
+        self.backend = get_backend(location, timeout, options)
+        self.compression = compression if compression is not None else Compression(None)
+        self.memory_limit = memory_limit
+        self._lock = threading.Lock()
+        self._memory: 'OrderedDict[str, MemoryEntry]' = OrderedDict()
+        self._memory_size = 0
+        self._derived: Dict[str, Derived] = {}
+
+    def derive(self, name: str, func: Callable[..., Any], sources: Iterable[str], optional: Iterable[str] = ()):
+        """
+        Compute name from other entries instead of storing it
+
+        func is called with the request id and the values of sources, missing optional sources as None. The name
+        is missing if any other source is. Values other than data frames are shared by everyone who gets them, and
+        must not be changed.
+
+        Setting a derived name only keeps the value in memory, until a source changes.
+        :param name:
+        :param func:
+        :param sources:
+        :param optional: sources that can be missing
+        :return:
+        """
+        optional = tuple(optional)
+        self._derived[name] = Derived(func, tuple(sources) + optional, optional)
+
+    def _split(self, key: str) -> Tuple[str, str, str]:
+        uid, sep, name = str(key).partition('/')
+
+        if not uid or not sep or not name:
+            raise ValueError(f'bad result key: {key}')
+
+        return uid, name, self.backend.path(uid, name)
+
+    def _path(self, key: str) -> str:
+        return self._split(key)[2]
+
+    def _source_signature(self, uid: str, derived: Derived) -> Tuple:
+        signature = []
+
+        for source in derived.sources:
+            try:
+                signature.append(self.backend.signature(self._path(f'{uid}/{source}')))
+            except FileNotFoundError:
+                if source not in derived.optional:
+                    raise
+                signature.append(None)
+
+        return tuple(signature)
+
+    def _remember(self, path: str, signature: Tuple, value: Any):
+        size = value_size(value)
+
+        with self._lock:
+            self._forget(path)
+
+            if size > self.memory_limit:
+                return
+
+            self._memory[path] = MemoryEntry(signature, value, size)
+            self._memory_size += size
+
+            while self._memory_size > self.memory_limit:
+                _path, entry = self._memory.popitem(last=False)
+                self._memory_size -= entry.size
+
+    def _forget(self, path: str):
+        entry = self._memory.pop(path, None)
+        if entry is not None:
+            self._memory_size -= entry.size
+
+    def _recall(self, path: str, signature: Tuple) -> Optional[MemoryEntry]:
+        with self._lock:
+            entry = self._memory.get(path)
+
+            if entry is None:
+                return None
+
+            if entry.signature != signature:
+                self._forget(path)
+                return None
+
+            self._memory.move_to_end(path)
+
+        return entry
+
+    def _read_derived(self, uid: str, path: str, derived: Derived, columns: Any = None) -> Any:
+        signature = self._source_signature(uid, derived)
+
+        entry = self._recall(path, signature)
+        if entry is not None:
+            value = entry.value
+        else:
+            value = derived.func(uid, *(self.get(f'{uid}/{source}') for source in derived.sources))
+
+            if self.memory_limit:
+                self._remember(path, signature, value)
+
+        if isinstance(value, pd.DataFrame):
+            if columns is not None:
+                return value.take(column_positions(value.columns, columns)[0], axis=1)
+            return value.copy()
+
+        return value
+
+    def _read(self, key: str, columns: Any = None) -> Any:
+        uid, name, path = self._split(key)
+
+        derived = self._derived.get(name)
+        if derived is not None:
+            return self._read_derived(uid, path, derived, columns)
+
+        entry = self._recall(path, self.backend.signature(path)) if self.memory_limit else None
+        if entry is not None:
+            value = entry.value
+        else:
+            signature, data = self.backend.read(path)
+
+            if data[:len(ARROW_MAGIC)].to_pybytes() == ARROW_MAGIC:
+                if columns is not None or not self.memory_limit:  # partial frames are not kept in memory
+                    return table_to_frame(self.compression.read_table(data, columns), columns)
+
+                value = table_to_frame(self.compression.read_table(data))
+            else:
+                value = self.compression.decompress(data)
+
+            if self.memory_limit:
+                self._remember(path, signature, value)
+
+        if isinstance(value, pd.DataFrame):
+            if columns is not None:
+                return value.take(column_positions(value.columns, columns)[0], axis=1)
+            return value.copy()
+
+        return pickle.loads(value)
+
+    def get(self, key: str, default: Any = None, columns: Any = None) -> Any:
+        """
+        Get value of key
+        :param key:
+        :param default: returned if the key is missing or expired
+        :param columns: only read these columns if the value is a data frame, see :func:`table_to_frame`
+        :return:
+        """
+        try:
+            return self._read(key, columns)
+        except FileNotFoundError:
+            return default
+
+    def get_many(self, keys: Iterable[str], columns: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Get the values of keys that exist
+        :param keys:
+        :param columns: columns to read by key, for data frames
+        :return:
+        """
+        if columns is None:
+            columns = {}
+
+        data = {}
+
+        for key in keys:
+            try:
+                data[key] = self._read(key, columns.get(key))
+            except FileNotFoundError:
+                pass
+
+        return data
+
+    def get_parts(self, key: str, parts: Iterable[Hashable],
+                  func: Callable[[List[Hashable]], Sequence[Any]]) -> List[Any]:
+        """
+        Get the values of parts of key, computing only the parts that are not stored yet
+
+        The value of key is a dict of part -> value, for results that are made of independent parts, like one value
+        per analysis column or per pair of columns. Parts stay stored when they are not asked for, so hiding an
+        analysis and showing it again computes nothing. Missing parts are computed without a lock, then merged with
+        the parts stored meanwhile under a lock on key, so requests computing different parts keep each other's.
+        :param key:
+        :param parts:
+        :param func: called with the missing parts, returns their values in the same order
+        :return: values of parts
+        """
+        parts = list(parts)
+        stored = self.get(key, {})
+
+        missing = [p for p in parts if p not in stored]
+        if missing:
+            values = dict(zip(missing, func(missing)))
+
+            with self.backend.lock(self._path(key)):
+                stored = {**self.get(key, {}), **values}
+                self.set(key, stored)
+
+        return [stored[p] for p in parts]
+
+    def set(self, key: str, value: Any):
+        uid, name, path = self._split(key)
+
+        if name in self._derived:
+            if self.memory_limit:
+                try:
+                    signature = self._source_signature(uid, self._derived[name])
+                except FileNotFoundError:
+                    return
+                self._remember(path, signature, value.copy() if isinstance(value, pd.DataFrame) else value)
+            return
+
+        table = None
+        if isinstance(value, pd.DataFrame):
+            try:
+                table = frame_to_table(value)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):  # mixed types
+                pass
+
+        if table is not None:
+            memory_value = value.copy() if self.memory_limit else None
+            data = self.compression.write_table(table)
+        else:
+            memory_value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            data = self.compression.compress(memory_value)
+
+        signature = self.backend.write(path, data)
+
+        if self.memory_limit:
+            self._remember(path, signature, memory_value)
+
+        self.backend.cull()
+
+    def touch(self, key: str) -> bool:
+        """
+        Keep key from expiring for another timeout seconds
+        :param key:
+        :return: False if key is missing or expired
+        """
+        return self.backend.touch(self._path(key))
+
+    def link(self, key: str, target: str) -> bool:
+        """
+        Make key refer to the stored value of target without copying it
+
+        Both keys are touched so neither expires before the other. Values are only ever replaced, never changed in
+        place, so setting or deleting either key later leaves the other as it is.
+        :param key:
+        :param target:
+        :return: False if target is missing or expired
+        """
+        path = self._path(key)
+
+        if not self.backend.link(path, self._path(target)):
+            return False
+
+        with self._lock:
+            self._forget(path)
+
+        self.backend.cull()
+
+        return True
+
+    def set_many(self, data: Dict[str, Any]):
+        for key, value in data.items():
+            self.set(key, value)
+
+    def delete(self, key: str):
+        path = self._path(key)
+
+        with self._lock:
+            self._forget(path)
+
+        self.backend.delete(path)
+
+    def delete_many(self, keys: Iterable[str]):
+        for key in keys:
+            self.delete(key)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Compression statistics and memory use of this process
+        """
+        with self._lock:
+            memory = {'memory_entries': len(self._memory), 'memory_bytes': self._memory_size}
+
+        return {**self.compression.stats(), **memory}
+
+    def cull(self, force: bool = False):
+        """
+        Remove expired entries the backend doesn't expire by itself
+        :param force: don't wait timeout / 10 seconds since the last cull
+        :return:
+        """
+        self.backend.cull(force)
+
+
+COMPRESSION = settings.RESULT_STORE.get('COMPRESSION', {})
+
+result_store = ResultStore(settings.RESULT_STORE['LOCATION'], settings.RESULT_STORE['TIMEOUT'],
+                           settings.RESULT_STORE['MEMORY_LIMIT'], settings.RESULT_STORE.get('OPTIONS'),
+                           Compression(COMPRESSION.get('CODEC', 'zstd'), COMPRESSION.get('LEVEL'),
+                                       COMPRESSION.get('THRESHOLD', 64 * 2 ** 10)))
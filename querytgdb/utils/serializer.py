@@ -0,0 +1,199 @@
+"""
+JSON and Arrow serialisation of formatted query results.
+
+Cells are encoded a column at a time straight from the column arrays: floats with numpy's shortest round trip
+formatting (the same text as ``json.dumps``), NaN and infinity as ``null``, and everything else once per distinct
+value with :class:`PandasJSONEncoder`. Rows are then joined into the response, so the result never goes through
+a list of Python objects.
+
+The Arrow IPC stream has the same data rows as typed columns with validity bitmaps, with the rest of the response
+(column formats, merged cells, header rows...) as JSON in the schema metadata.
+"""
+import json
+from json.encoder import encode_basestring_ascii
+from typing import Any, Dict, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from django.http import HttpRequest, HttpResponse
+
+from . import PandasJSONEncoder
+from .formatter import FormattedResult
+
+NULL = 'null'
+
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+
+_encoder = PandasJSONEncoder()
+
+
+def dumps(o: Any) -> str:
+    if isinstance(o, str):
+        return encode_basestring_ascii(o)
+    return _encoder.encode(o)
+
+
+def encode_column(s: pd.Series) -> np.ndarray:
+    """
+    JSON text of every cell of a column
+    :param s:
+    :return:
+    """
+    values = s.to_numpy()
+
+    if values.dtype.kind == 'f':
+        values = values.astype(np.float64, copy=False)
+        finite = np.isfinite(values)
+
+        # result columns are mostly empty, only format the cells that have a value
+        text = np.empty(values.shape, dtype=object)
+        text.fill(NULL)
+        text[finite] = values[finite].astype(str)
+        return text
+
+    if values.dtype.kind in 'iu':
+        return values.astype(str).astype(object)
+
+    if values.dtype.kind == 'b':
+        return np.where(values, 'true', 'false').astype(object)
+
+    codes, uniques = pd.factorize(values)
+    encoded = np.array([dumps(u) for u in uniques] + [NULL], dtype=object)
+
+    return encoded[codes]  # missing values have code -1
+
+
+def iter_rows(df: pd.DataFrame) -> Iterator[str]:
+    """
+    JSON arrays of the rows of df
+    :param df:
+    :return:
+    """
+    columns = [encode_column(s).tolist() for _, s in df.items()]
+
+    for row in zip(*columns):
+        yield '[' + ','.join(row) + ']'
+
+
+def dumps_rows(formatted: FormattedResult, df: Optional[pd.DataFrame] = None, header: bool = True) -> str:
+    """
+    JSON array of formatted result rows
+    :param formatted:
+    :param df: window of data rows, all rows if None
+    :param header: include header rows
+    :return:
+    """
+    if df is None:
+        df = formatted.data
+
+    rows = iter_rows(df)
+
+    if header:
+        rows = (*map(dumps, formatted.header), *rows)
+
+    return '[' + ','.join(rows) + ']'
+
+
+def dumps_with(obj: Dict[str, Any], **raw: str) -> str:
+    """
+    Dump a dict to JSON, with extra members that are already JSON text
+    :param obj:
+    :param raw:
+    :return:
+    """
+    members = [f'{dumps(k)}: {v}' for k, v in raw.items()]
+
+    if obj:
+        members.append(dumps(obj)[1:-1])
+
+    return '{' + ', '.join(members) + '}'
+
+
+def result_json(res: Dict[str, Any], formatted: FormattedResult, df: Optional[pd.DataFrame] = None) -> str:
+    """
+    Query response with the formatted result as res['result']['data']
+    :param res: response without result data
+    :param formatted:
+    :param df: window of data rows, all rows if None
+    :return:
+    """
+    res = dict(res)
+    result = res.pop('result', {})
+
+    return dumps_with(res, result=dumps_with(result, data=dumps_rows(formatted, df)))
+
+
+class ResultJSONResponse(HttpResponse):
+    def __init__(self, content: str, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=content, **kwargs)
+
+
+def arrow_column(s: pd.Series) -> pa.Array:
+    """
+    Arrow array of a column, with NaN and infinity as null, and text as dictionary encoded strings
+    :param s:
+    :return:
+    """
+    values = s.to_numpy()
+
+    if values.dtype.kind == 'f':
+        values = values.astype(np.float64, copy=False)
+        return pa.array(values, mask=~np.isfinite(values))
+
+    if values.dtype.kind in 'iub':
+        return pa.array(values)
+
+    codes, uniques = pd.factorize(values)
+
+    try:
+        dictionary = pa.array(uniques, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):  # mixed types
+        dictionary = pa.array([str(u) for u in uniques], type=pa.string())
+
+    # smallest index type that fits, most text columns only have a handful of values
+    index_type = np.min_scalar_type(-max(len(uniques), 1))
+
+    return pa.DictionaryArray.from_arrays(pa.array(codes.astype(index_type), mask=codes < 0), dictionary)
+
+
+def result_arrow(res: Dict[str, Any], formatted: FormattedResult, df: Optional[pd.DataFrame] = None) -> bytes:
+    """
+    Query response as an Arrow IPC stream
+
+    Columns are named by position. The header rows go in res['result']['header'], and res is stored as JSON in
+    the "result" schema metadata.
+    :param res: response without result data
+    :param formatted:
+    :param df: window of data rows, all rows if None
+    :return:
+    """
+    if df is None:
+        df = formatted.data
+
+    res = {**res, 'result': {**res.get('result', {}), 'header': formatted.header}}
+
+    table = pa.Table.from_arrays([arrow_column(s) for _, s in df.items()],
+                                 names=[str(i) for i in range(df.shape[1])])
+    table = table.replace_schema_metadata({'result': json.dumps(res, cls=PandasJSONEncoder)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def accepts_arrow(request: HttpRequest) -> bool:
+    """
+    If the Arrow stream is explicitly asked for in the Accept header, a wildcard doesn't count
+    """
+    return any(f'{t.main_type}/{t.sub_type}' == ARROW_STREAM for t in request.accepted_types)
+
+
+class ArrowResponse(HttpResponse):
+    def __init__(self, content: bytes, **kwargs):
+        kwargs.setdefault('content_type', ARROW_STREAM)
+        super().__init__(content=content, **kwargs)
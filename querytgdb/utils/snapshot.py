@@ -0,0 +1,285 @@
+"""
+Read-only on-disk snapshot of edges, annotations and motif counts.
+
+Every array is written as a separate .npy file and read back with ``mmap_mode='r'``, so all gunicorn workers
+share the same page cache instead of each holding their own copy of the data. A ``manifest.json`` describes
+the contents and what the snapshot was built from, which is used to ignore stale snapshots.
+
+Writing is done by the ``snapshot`` management command.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import Count, Max
+
+from querytgdb.models import Analysis, Annotation, DataVersion
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _to_array(values) -> np.ndarray:
+    """
+    Convert values to an array that can be saved without pickling
+    """
+    arr = np.asarray(values)
+
+    if arr.dtype == object:
+        arr = np.asarray(pd.Series(values).fillna('').astype(str).tolist(), dtype=str)
+
+    return arr
+
+
+def _json_key(key):
+    if isinstance(key, np.generic):
+        return key.item()
+    return key
+
+
+def save_arrays(path: str, arrays: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    os.makedirs(path, exist_ok=True)
+
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), _to_array(arr), allow_pickle=False)
+
+    return {'arrays': list(arrays.keys())}
+
+
+def load_arrays(path: str, info: Dict[str, Any]) -> Dict[str, np.ndarray]:
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+            for name in info['arrays']}
+
+
+def save_frame(path: str, df: pd.DataFrame) -> Dict[str, Any]:
+    """
+    Save a DataFrame as a set of arrays
+
+    A frame with a single numeric dtype is saved as one 2D array, so it can be wrapped without copying when
+    it is loaded.
+    :param path:
+    :param df:
+    :return: frame description for the manifest
+    """
+    os.makedirs(path, exist_ok=True)
+
+    info: Dict[str, Any] = {
+        'columns': [_json_key(c) for c in df.columns],
+        'index_names': [_json_key(n) for n in df.index.names]
+    }
+
+    if isinstance(df.index, pd.MultiIndex):
+        info['multiindex'] = True
+        for i, (level, codes) in enumerate(zip(df.index.levels, df.index.codes)):
+            np.save(os.path.join(path, f'level_{i}.npy'), _to_array(level), allow_pickle=False)
+            np.save(os.path.join(path, f'codes_{i}.npy'), np.asarray(codes), allow_pickle=False)
+    else:
+        info['multiindex'] = False
+        np.save(os.path.join(path, 'index.npy'), _to_array(df.index), allow_pickle=False)
+
+    dtypes = df.dtypes.unique()
+
+    if len(dtypes) == 1 and np.issubdtype(dtypes[0], np.number):
+        info['block'] = True
+        np.save(os.path.join(path, 'values.npy'), df.to_numpy(), allow_pickle=False)
+    else:
+        info['block'] = False
+        for i, (name, col) in enumerate(df.items()):
+            np.save(os.path.join(path, f'col_{i}.npy'), _to_array(col), allow_pickle=False)
+
+    return info
+
+
+def _load_index(arr: np.ndarray) -> np.ndarray:
+    if arr.dtype.kind == 'U':
+        return arr.astype(object)
+    return arr
+
+
+def load_frame(path: str, info: Dict[str, Any]) -> pd.DataFrame:
+    if info['multiindex']:
+        levels, codes = [], []
+        i = 0
+        while os.path.exists(os.path.join(path, f'level_{i}.npy')):
+            levels.append(_load_index(np.load(os.path.join(path, f'level_{i}.npy'), allow_pickle=False)))
+            codes.append(np.load(os.path.join(path, f'codes_{i}.npy'), mmap_mode='r', allow_pickle=False))
+            i += 1
+        index = pd.MultiIndex(levels=levels, codes=codes, names=info['index_names'], verify_integrity=False)
+    else:
+        index = pd.Index(_load_index(np.load(os.path.join(path, 'index.npy'), allow_pickle=False)),
+                         name=info['index_names'][0])
+
+    if info['block']:
+        return pd.DataFrame(np.load(os.path.join(path, 'values.npy'), mmap_mode='r', allow_pickle=False),
+                            index=index, columns=info['columns'], copy=False)
+
+    data = {}
+    for i, name in enumerate(info['columns']):
+        arr = np.load(os.path.join(path, f'col_{i}.npy'), mmap_mode='r', allow_pickle=False)
+        data[name] = arr.astype(object) if arr.dtype.kind == 'U' else arr
+
+    return pd.DataFrame(data, index=index, columns=info['columns'])
+
+
+def file_signature(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        stat = os.stat(path)
+        return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    except OSError:
+        return None
+
+
+def write_snapshot(path: str,
+                   edges: Dict[str, np.ndarray],
+                   analyses: pd.DataFrame,
+                   annotations: pd.DataFrame,
+                   motifs: Optional[Dict[str, pd.DataFrame]] = None,
+                   sources: Optional[Dict[str, Any]] = None):
+    """
+    Write snapshot to path
+
+    The snapshot is written to a temporary directory first and then swapped in, so readers never see a
+    half written snapshot.
+    :param path: snapshot directory
+    :param edges: edge arrays
+    :param analyses: analysis to TF table
+    :param annotations: gene annotations
+    :param motifs: motif count tables by name
+    :param sources: extra information used to check if the snapshot is still current
+    :return:
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(prefix='.snapshot-', dir=parent)
+
+    try:
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'created': time.time(),
+            'sources': sources or {},
+            'edges': save_arrays(os.path.join(tmp_dir, 'edges'), edges),
+            'analyses': save_frame(os.path.join(tmp_dir, 'analyses'), analyses),
+            'annotations': save_frame(os.path.join(tmp_dir, 'annotations'), annotations),
+            'motifs': {}
+        }
+
+        for name, df in (motifs or {}).items():
+            manifest['motifs'][name] = save_frame(os.path.join(tmp_dir, 'motifs', name), df)
+
+        with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        old_dir = None
+        if os.path.exists(path):
+            old_dir = tempfile.mkdtemp(prefix='.snapshot-old-', dir=parent)
+            os.rename(path, os.path.join(old_dir, 'snapshot'))
+
+        os.rename(tmp_dir, path)
+
+        if old_dir is not None:
+            # workers still mapping the old files keep them alive until they reload
+            shutil.rmtree(old_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+class Snapshot:
+    """
+    Lazily opened snapshot
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or settings.SNAPSHOT_DIR
+        self._manifest: Optional[Dict[str, Any]] = None
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.path, MANIFEST)) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError) as e:
+                raise SnapshotError(f'No snapshot at {self.path}') from e
+
+            if manifest.get('version') != SNAPSHOT_VERSION:
+                raise SnapshotError('Snapshot version mismatch')
+
+            self._manifest = manifest
+
+        return self._manifest
+
+    @property
+    def sources(self) -> Dict[str, Any]:
+        return self.manifest['sources']
+
+    def edges(self) -> Dict[str, np.ndarray]:
+        return load_arrays(os.path.join(self.path, 'edges'), self.manifest['edges'])
+
+    def analyses(self) -> pd.DataFrame:
+        return load_frame(os.path.join(self.path, 'analyses'), self.manifest['analyses']).reset_index(drop=True)
+
+    def annotations(self) -> pd.DataFrame:
+        return load_frame(os.path.join(self.path, 'annotations'), self.manifest['annotations'])
+
+    def motifs(self, name: str) -> pd.DataFrame:
+        try:
+            info = self.manifest['motifs'][name]
+        except KeyError as e:
+            raise SnapshotError(f'No motif table "{name}" in snapshot') from e
+
+        return load_frame(os.path.join(self.path, 'motifs', name), info)
+
+    def is_current(self, key: str, value: Any) -> bool:
+        return self.sources.get(key) == value
+
+
+def get_snapshot() -> Optional[Snapshot]:
+    """
+    Get the configured snapshot if there is one
+    :return:
+    """
+    if not getattr(settings, 'SNAPSHOT_DIR', None):
+        return None
+
+    snapshot = Snapshot(settings.SNAPSHOT_DIR)
+
+    try:
+        snapshot.manifest
+    except SnapshotError:
+        return None
+
+    return snapshot
+
+
+def analysis_signature() -> List[int]:
+    """
+    Analyses currently in the database
+
+    Analyses are only ever added or removed as a whole, so the edge tables change exactly when this does.
+    """
+    return sorted(Analysis.objects.values_list('id', flat=True))
+
+
+def annotation_signature() -> Dict[str, Any]:
+    """
+    Annotations currently in the database
+
+    Annotations are updated in place, so the data version is included, every import of annotations bumps it.
+    """
+    return {**Annotation.objects.aggregate(count=Count('id'), max_id=Max('id')),
+            **DataVersion.objects.aggregate(version=Max('id'))}
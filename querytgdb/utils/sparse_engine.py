@@ -0,0 +1,434 @@
+"""
+Sparse execution engine for the TF query algebra.
+
+Operands are kept as a scipy.sparse target × column matrix and a target bitset over every annotated gene.
+``and``/``or``/``not`` become bitset operations plus a column stack, and the wide TargetFrame is only built
+once, for the final result. Modifiers on a TF are applied to its edges before the matrix is built, other
+modifiers and column filters still run on a materialised frame, so results are the same as
+:func:`querytgdb.utils.parser.get_tf`.
+
+Enable with ``QUERY_ENGINE = 'sparse'`` in the settings.
+"""
+from functools import partial
+from typing import List, Optional, Sequence, Tuple, Union
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from querytgdb.utils import async_loader, progress
+from querytgdb.utils.parser import EDGE_FIELDS, LOG2FC, PVALUE, TargetFrame, TargetSeries, get_all_tf_edges, \
+    get_column_filter, get_mod, get_modified_edges, get_tf_edges, initialize_column_name, replace_filter_str, \
+    split_modified
+from querytgdb.utils.query_plan import ALL_TFS_QUERIES, BinOp, ColumnFilter, Gene, Modified, Node, Not, \
+    SubplanMemo
+
+NUMERIC_FIELDS = {PVALUE, LOG2FC}
+
+Column = Tuple[Tuple[str, str, str], int, str]
+
+
+def mask_rows(matrix: sp.csc_matrix, rows: np.ndarray) -> Tuple[sp.csc_matrix, np.ndarray]:
+    """
+    Remove entries outside of rows
+    :param matrix:
+    :param rows: row bitset
+    :return: masked matrix, number of entries left in each column
+    """
+    keep = rows[matrix.indices]
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    indptr = kept[matrix.indptr]
+
+    return sp.csc_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape), np.diff(indptr)
+
+
+class SparseTargetFrame:
+    """
+    Target × column matrix of query results
+
+    Matrix entries are 1-based positions into ``numbers`` for p-value and fold change columns, and into
+    ``labels`` for edge columns.
+    """
+
+    def __init__(self,
+                 universe: pd.Index,
+                 rows: np.ndarray,
+                 columns: List[Column],
+                 matrix: sp.csc_matrix,
+                 numbers: np.ndarray,
+                 labels: np.ndarray,
+                 include: bool = True,
+                 filter_string: str = ''):
+        self.universe = universe
+        self.rows = rows
+        self.columns = columns
+        self.matrix = matrix
+        self.numbers = numbers
+        self.labels = labels
+        self.include = include
+        self.filter_string = filter_string
+
+    @property
+    def numeric(self) -> np.ndarray:
+        return np.fromiter((c[2] in NUMERIC_FIELDS for c in self.columns), dtype=bool, count=len(self.columns))
+
+    @classmethod
+    def empty(cls, universe: pd.Index) -> 'SparseTargetFrame':
+        return cls(universe, np.zeros(len(universe), dtype=bool), [],
+                   sp.csc_matrix((len(universe), 0), dtype=np.int64), np.empty(0), np.empty(0, dtype=object))
+
+    @classmethod
+    def from_entries(cls,
+                     universe: pd.Index,
+                     targets: pd.Series,
+                     columns: List[Column],
+                     col_codes: np.ndarray,
+                     values: pd.Series) -> 'SparseTargetFrame':
+        """
+        Build from one row per non-empty cell
+        :param universe:
+        :param targets: target of each cell
+        :param columns:
+        :param col_codes: column of each cell
+        :param values: value of each cell
+        :return:
+        """
+        row_codes = universe.get_indexer(targets)
+        rows = np.zeros(len(universe), dtype=bool)
+        rows[row_codes] = True
+
+        numeric = np.fromiter((c[2] in NUMERIC_FIELDS for c in columns), dtype=bool, count=len(columns))
+        is_number = numeric[col_codes]
+
+        data = np.empty(len(col_codes), dtype=np.int64)
+        data[is_number] = np.arange(1, is_number.sum() + 1)
+        data[~is_number] = np.arange(1, (~is_number).sum() + 1)
+
+        matrix = sp.csc_matrix((data, (row_codes, col_codes)), shape=(len(universe), len(columns)))
+
+        return cls(universe, rows, columns, matrix,
+                   values[is_number].to_numpy(dtype=np.float64),
+                   values[~is_number].to_numpy(dtype=object))
+
+    @classmethod
+    def from_edges(cls, universe: pd.Index, df: pd.DataFrame, names: pd.Series) -> 'SparseTargetFrame':
+        """
+        Build from long format edges
+        :param universe:
+        :param df: edges with TARGET, ANALYSIS and value columns
+        :param names: column name of each edge
+        :return:
+        """
+        fields = [f for f in df.columns if f in EDGE_FIELDS]
+
+        name_codes, name_uniques = pd.factorize(names, sort=True)
+        analysis_codes, analysis_uniques = pd.factorize(df['ANALYSIS'], sort=True)
+
+        cells = []
+        for i, field in enumerate(fields):
+            notna = df[field].notna().to_numpy()
+            cells.append((
+                (name_codes[notna] * len(analysis_uniques) + analysis_codes[notna]) * len(fields) + i,
+                df.loc[notna, 'TARGET'],
+                df.loc[notna, field]
+            ))
+
+        if not cells:
+            return cls.empty(universe)
+
+        keys, targets, values = zip(*cells)
+        col_keys, col_codes = np.unique(np.concatenate(keys), return_inverse=True)
+
+        name_map = [initialize_column_name(n) for n in name_uniques]
+        columns = [(name_map[k // len(fields) // len(analysis_uniques)],
+                    analysis_uniques[k // len(fields) % len(analysis_uniques)],
+                    fields[k % len(fields)]) for k in col_keys.tolist()]
+
+        return cls.from_entries(universe, pd.concat(targets), columns, col_codes, pd.concat(values))
+
+    @classmethod
+    def from_frame(cls, universe: pd.Index, df: TargetFrame) -> 'SparseTargetFrame':
+        """
+        Build from a wide TargetFrame, keeping its rows and columns as they are
+        """
+        columns = list(df.columns)
+        values = df.to_numpy(dtype=object)
+        notna = pd.notna(values)
+        row_pos, col_codes = np.nonzero(notna)
+
+        result = cls.from_entries(universe, df.index[row_pos].to_series(), columns, col_codes,
+                                  pd.Series(values[row_pos, col_codes], dtype=object))
+        result.rows = np.zeros(len(universe), dtype=bool)
+        result.rows[universe.get_indexer(df.index)] = True
+        result.include = df.include
+        result.filter_string = df.filter_string
+
+        return result
+
+    def with_rows(self, rows: np.ndarray, drop_columns: bool = True) -> 'SparseTargetFrame':
+        matrix, counts = mask_rows(self.matrix, rows)
+        columns = self.columns
+
+        if drop_columns:
+            keep = counts > 0
+            matrix = matrix[:, keep]
+            columns = [c for c, k in zip(columns, keep) if k]
+
+        return SparseTargetFrame(self.universe, rows, columns, matrix, self.numbers, self.labels,
+                                 self.include, self.filter_string)
+
+    def hstack(self, other: 'SparseTargetFrame') -> 'SparseTargetFrame':
+        """
+        Put columns of other to the right, rows are the union of both
+        """
+        other_matrix = other.matrix.copy()
+        per_entry_numeric = np.repeat(other.numeric, np.diff(other_matrix.indptr))
+        other_matrix.data = other_matrix.data + np.where(per_entry_numeric, len(self.numbers), len(self.labels))
+
+        return SparseTargetFrame(self.universe,
+                                 self.rows | other.rows,
+                                 self.columns + other.columns,
+                                 sp.hstack([self.matrix, other_matrix], format='csc'),
+                                 np.concatenate((self.numbers, other.numbers)),
+                                 np.concatenate((self.labels, other.labels)),
+                                 self.include,
+                                 self.filter_string)
+
+    def relabel(self) -> 'SparseTargetFrame':
+        """
+        Copy with new column ids, used when a result is reused within a query
+        """
+        names = {c[0]: (*c[0][:2], str(uuid4())) for c in self.columns}
+
+        return SparseTargetFrame(self.universe, self.rows, [(names[c[0]], *c[1:]) for c in self.columns],
+                                 self.matrix, self.numbers, self.labels, self.include, self.filter_string)
+
+    def rename(self, filter_string: str) -> 'SparseTargetFrame':
+        self.columns = [(replace_filter_str(c[0], filter_string), c[1], c[2]) for c in self.columns]
+        return self
+
+    def to_frame(self) -> TargetFrame:
+        """
+        Materialise as a wide TargetFrame
+        """
+        row_codes = np.flatnonzero(self.rows)
+        targets = self.universe[row_codes]
+        order = np.argsort(targets, kind='stable')
+        row_codes, targets = row_codes[order], targets[order]
+
+        if not self.columns:
+            df = TargetFrame(columns=pd.MultiIndex(levels=[[], [], []], codes=[[], [], []]))
+            df.include = self.include
+            df.filter_string = self.filter_string
+            return df
+
+        row_pos = np.full(len(self.universe), -1, dtype=np.intp)
+        row_pos[row_codes] = np.arange(len(row_codes))
+
+        matrix = self.matrix.tocoo()
+        rows = row_pos[matrix.row]
+        cols = matrix.col
+        data = matrix.data - 1
+
+        numeric = self.numeric
+        is_number = numeric[cols]
+
+        num_pos = np.cumsum(numeric) - 1
+        numbers = np.full((len(row_codes), numeric.sum()), np.nan)
+        numbers[rows[is_number], num_pos[cols[is_number]]] = self.numbers[data[is_number]]
+
+        # labels are categorical, like the text fields of get_tf frames
+        label_codes, categories = pd.factorize(self.labels, sort=True)
+        dtype = pd.CategoricalDtype(categories)
+
+        label_pos = np.cumsum(~numeric) - 1
+        labels = np.full(((~numeric).sum(), len(row_codes)), -1, dtype=np.min_scalar_type(-max(len(categories), 1)))
+        labels[label_pos[cols[~is_number]], rows[~is_number]] = label_codes[data[~is_number]]
+
+        index = pd.Index(targets, name='TARGET')
+        columns = pd.MultiIndex.from_tuples(self.columns)
+
+        df = TargetFrame(pd.concat([pd.DataFrame(numbers, index=index),
+                                    pd.DataFrame({i: pd.Categorical.from_codes(codes, dtype=dtype)
+                                                  for i, codes in enumerate(labels)}, index=index)],
+                                   axis=1, ignore_index=True))
+        # numeric columns come first, put them back in order
+        df = df.iloc[:, np.argsort(np.concatenate((np.flatnonzero(numeric), np.flatnonzero(~numeric))))]
+        df.columns = columns
+        df.include = self.include
+        df.filter_string = self.filter_string
+
+        return df
+
+
+def combine(oper: str, prec: SparseTargetFrame, succ: SparseTargetFrame) -> SparseTargetFrame:
+    """
+    Same semantics as the merges in :func:`querytgdb.utils.parser.get_tf`
+    """
+    if oper == 'and':
+        if prec.include and succ.include:
+            df = prec.hstack(succ).with_rows(prec.rows & succ.rows)
+        elif not prec.include and succ.include:
+            df = succ.with_rows(succ.rows & ~prec.rows)
+        elif prec.include and not succ.include:
+            df = prec.with_rows(prec.rows & ~succ.rows)
+        else:
+            df = prec.hstack(succ).with_rows(prec.rows | succ.rows)
+            df.include = False
+    else:
+        if prec.include and succ.include:
+            df = prec.hstack(succ).with_rows(prec.rows | succ.rows)
+        elif not prec.include and succ.include:
+            df = succ.with_rows(succ.rows)
+        elif prec.include and not succ.include:
+            df = prec.with_rows(prec.rows)
+        else:
+            df = prec.hstack(succ).with_rows(prec.rows & succ.rows)
+            df.include = False
+
+    df.filter_string = '(' + prec.filter_string + f' {oper} ' + succ.filter_string + ')'
+
+    if oper == 'and':
+        df.rename(df.filter_string)
+
+    return df
+
+
+def get_leaf(query: str,
+             universe: pd.Index,
+             edges: Optional[List[str]] = None,
+             tf_filter_list: Optional[pd.Series] = None,
+             target_filter_list: Optional[pd.Series] = None) -> SparseTargetFrame:
+    if query.lower() in {'andalltfs', 'all_tfs', 'multitype'}:
+        df = get_all_tf_edges(query.lower(), edges, tf_filter_list, target_filter_list)
+        result = SparseTargetFrame.from_edges(universe, df, df['TF'])
+        result.filter_string = query.lower()
+        progress.report('pivot', step=True)
+
+        return result
+
+    name, df = get_tf_edges(query, edges, tf_filter_list, target_filter_list)
+
+    if df.empty:
+        # mirror the placeholder column of an empty get_tf_data frame
+        result = SparseTargetFrame.empty(universe)
+        result.columns = [(initialize_column_name(name), np.nan, 'EDGE')]
+        result.matrix = sp.csc_matrix((len(universe), 1), dtype=np.int64)
+    else:
+        result = SparseTargetFrame.from_edges(universe, df, pd.Series(name, index=df.index))
+
+    result.filter_string = name
+    progress.report('pivot', step=True)
+
+    return result
+
+
+def get_modified_leaf(tf: Gene,
+                      chain: Sequence[Modified],
+                      universe: pd.Index,
+                      edges: Optional[List[str]] = None,
+                      tf_filter_list: Optional[pd.Series] = None,
+                      target_filter_list: Optional[pd.Series] = None) -> SparseTargetFrame:
+    name, df, filter_string = get_modified_edges(tf, chain, edges, tf_filter_list, target_filter_list)
+
+    if df.empty:
+        result = SparseTargetFrame.empty(universe)
+    elif tf.name in ALL_TFS_QUERIES:
+        result = SparseTargetFrame.from_edges(universe, df, df['TF'])
+    else:
+        result = SparseTargetFrame.from_edges(universe, df, pd.Series(name, index=df.index))
+
+    result.filter_string = filter_string
+    progress.report('pivot', step=True)
+
+    return result.rename(filter_string)
+
+
+def get_tf_sparse(query: Union[Node, str],
+                  edges: Optional[List[str]] = None,
+                  tf_filter_list: Optional[pd.Series] = None,
+                  target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    """
+    Query TF DataFrame according to query plan, drop-in replacement for get_tf
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return:
+    """
+    universe = async_loader['annotations'].index
+
+    return evaluate(query, universe, edges, tf_filter_list, target_filter_list).to_frame()
+
+
+def evaluate(query: Union[Node, str, SparseTargetFrame],
+             universe: pd.Index,
+             edges: Optional[List[str]] = None,
+             tf_filter_list: Optional[pd.Series] = None,
+             target_filter_list: Optional[pd.Series] = None,
+             memo: Optional[SubplanMemo] = None) -> SparseTargetFrame:
+    """
+    Evaluate query plan, sub-plans repeated within the query are only evaluated once
+    """
+    if memo is None:
+        memo = SubplanMemo(query)
+
+    if isinstance(query, Node) and query in memo:
+        return memo[query].relabel()
+
+    df = evaluate_plan(query, universe, edges, tf_filter_list, target_filter_list, memo)
+
+    if isinstance(query, Node) and query in memo.repeated:
+        memo[query] = df
+        return df.relabel()
+
+    return df
+
+
+def evaluate_plan(query: Union[Node, str, SparseTargetFrame],
+                  universe: pd.Index,
+                  edges: Optional[List[str]],
+                  tf_filter_list: Optional[pd.Series],
+                  target_filter_list: Optional[pd.Series],
+                  memo: SubplanMemo) -> SparseTargetFrame:
+    if isinstance(query, BinOp):
+        prec = evaluate(query.left, universe, edges, tf_filter_list, target_filter_list, memo)
+        succ = evaluate(query.right, universe, edges, tf_filter_list, target_filter_list, memo)
+
+        return combine(query.oper, prec, succ)
+    elif isinstance(query, Not):
+        succ = evaluate(query.operand, universe, edges, tf_filter_list, target_filter_list, memo)
+        succ.include = not succ.include
+        succ.filter_string = 'not ' + succ.filter_string
+
+        return succ
+    elif isinstance(query, Modified):
+        pushed_down = split_modified(query)
+
+        if pushed_down is not None:
+            return get_modified_leaf(*pushed_down, universe, edges, tf_filter_list, target_filter_list)
+
+        prec = evaluate(query.operand, universe, edges, tf_filter_list, target_filter_list, memo).to_frame()
+        mod = get_mod(prec, query.modifier)
+        prec = prec[mod].dropna(how='all').dropna(how='all', axis=1)
+
+        prec.filter_string += f'[{query.text}]'
+        prec = prec.rename(columns=partial(replace_filter_str, filter_string=prec.filter_string), level=0)
+
+        return SparseTargetFrame.from_frame(universe, prec)
+    elif isinstance(query, ColumnFilter):
+        prec = evaluate(query.operand, universe, edges, tf_filter_list, target_filter_list, memo).to_frame()
+
+        return SparseTargetFrame.from_frame(universe, get_column_filter(prec, query.filters))
+    elif isinstance(query, SparseTargetFrame):
+        return query
+    elif isinstance(query, (TargetFrame, TargetSeries)):
+        return SparseTargetFrame.from_frame(universe, query)
+    elif isinstance(query, (Gene, str)):
+        if isinstance(query, Gene):
+            query = query.name
+
+        return get_leaf(query, universe, edges, tf_filter_list, target_filter_list)
+    else:
+        raise ValueError(query)
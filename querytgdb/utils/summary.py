@@ -7,10 +7,10 @@ from uuid import UUID
 
 import numpy as np
 import pandas as pd
-from django.core.cache import cache
 
 from ..models import Analysis
-from ..utils import clear_data, data_to_edges
+from ..utils import EDGE_COLUMNS, clear_data, data_to_edges
+from ..utils.result_store import result_store
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +21,8 @@ def rename_tf(name: Tuple[str, str, str], gene_name_symbol: str) -> str:
 
 def get_summary(uid: Union[UUID, str], size_limit: int = 50) -> Dict[str, Any]:
     try:
-        cached_data = cache.get_many([f"{uid}/tabular_output", f"{uid}/analysis_ids"])
+        cached_data = result_store.get_many([f"{uid}/tabular_output", f"{uid}/analysis_ids"],
+                                            columns={f"{uid}/tabular_output": EDGE_COLUMNS})
         df, ids = itemgetter(f"{uid}/tabular_output", f"{uid}/analysis_ids")(cached_data)
     except KeyError as e:
         raise ValueError('data not found') from e
@@ -0,0 +1,155 @@
+"""
+Background warm-up of the queries everyone runs.
+
+When a worker starts, and again after the data version changes, a background thread builds the all TF edge frames
+of the memory cache and stores the results of ``WARMUP_QUERIES`` (all_tfs, multitype and every named query by
+default) as shared results, so the first user to run them doesn't wait for them. Shared results are stored once for
+all workers, a worker that finds one already stored skips it.
+
+Steps run as heavy work of the query job pool, see :meth:`QueryJobs.run_heavy`, so they take turns with heavy
+queries. With jobs in processes, the edge frames are warmed in the pool process that runs the step, where queries
+run. Warm-up runs again every ``WARMUP_INTERVAL`` seconds, half the shortest timeout of the memory cache and the
+result store by default, and keeps what it warmed from expiring.
+
+Progress is reported by :meth:`WarmUp.status`, the readiness endpoint shows it.
+"""
+import logging
+import threading
+import time
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from querytgdb.utils import skip_for_management
+from querytgdb.utils.data_version import data_version
+from querytgdb.utils.jobs import query_jobs
+from querytgdb.utils.parser import NAMED_QUERIES, all_tf_cache_key, get_all_tf_edges, mem_cache, store_shared_result
+
+logger = logging.getLogger(__name__)
+
+BASE_QUERIES = ('all_tfs', 'multitype')
+WARMUP_QUERIES = getattr(settings, 'WARMUP_QUERIES', [*BASE_QUERIES, *NAMED_QUERIES.keys()])
+WARMUP_INTERVAL = getattr(settings, 'WARMUP_INTERVAL',
+                          min(settings.CACHES['mem'].get('TIMEOUT', 300), settings.RESULT_STORE['TIMEOUT']) / 2)
+
+
+def warm_all_tf_edges(query: str):
+    """
+    Keep the all TF edges of query in the memory cache for another timeout, building them if they are missing
+    """
+    if not mem_cache.touch(all_tf_cache_key(query)):
+        get_all_tf_edges(query)
+
+
+class WarmUp:
+    """
+    Runs warm-up steps in a background thread, one run at a time, and again every interval seconds
+
+    Starting while a run is going runs it once more afterwards, with the data version at that time.
+    """
+
+    def __init__(self, queries: Iterable[str] = WARMUP_QUERIES, interval: Optional[float] = WARMUP_INTERVAL):
+        self.queries = list(queries)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+
+        self.ready = False  # stays ready while warming up again after a data change
+        self.state = 'idle'
+        self.version: Optional[int] = None
+        self.done = 0
+        self.total = 0
+        self.current: Optional[str] = None
+        self.errors: Dict[str, str] = {}
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    @staticmethod
+    def _run_heavy(func: Callable[..., Any], *args) -> Any:
+        return query_jobs.run_heavy(func, *args).result()
+
+    def steps(self) -> List[Tuple[str, Callable[[], Any]]]:
+        steps = [(f'{q} edges', partial(self._run_heavy, warm_all_tf_edges, q)) for q in BASE_QUERIES]
+        steps.extend((q, partial(self._run_heavy, store_shared_result, q)) for q in self.queries)
+
+        return steps
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'state': self.state,
+                'version': self.version,
+                'done': self.done,
+                'total': self.total,
+                'current': self.current,
+                'errors': dict(self.errors),
+                'started': self.started,
+                'finished': self.finished
+            }
+
+    def run(self):
+        steps = self.steps()
+
+        with self._lock:
+            self.state = 'running'
+            self.done = 0
+            self.total = len(steps)
+            self.errors = {}
+            self.started = time.time()
+            self.finished = None
+
+        self.version = data_version.version
+
+        for name, func in steps:
+            self.current = name
+            start = time.perf_counter()
+
+            try:
+                func()
+                logger.info(f"warm-up {name} took {time.perf_counter() - start:.2f}s")
+            except Exception as e:
+                logger.warning(f"warm-up {name} failed: {e}")
+                with self._lock:
+                    self.errors[name] = str(e)
+
+            with self._lock:
+                self.done += 1
+
+        with self._lock:
+            self.ready = True
+            self.state = 'done'
+            self.current = None
+            self.finished = time.time()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            self.run()
+            self._wake.wait(self.interval)  # started again, or refresh before warmed entries expire
+
+    def start(self):
+        """
+        Start warming up in the background
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._wake.set()
+                return
+
+            self._thread = threading.Thread(target=self._run, name='warm-up', daemon=True)
+            self._thread.start()
+
+
+warmup = WarmUp()
+
+
+@skip_for_management
+def start_warmup():
+    warmup.start()
+    data_version.connect(warmup.start)
+
+
+start_warmup()
@@ -6,17 +6,19 @@ import re
 import shutil
 import tempfile
 import warnings
+from concurrent.futures import wait
 from itertools import chain
 from operator import itemgetter
 from threading import Lock
-from typing import Optional
+from typing import List, Optional, Tuple
 from uuid import uuid4
 
 import matplotlib
 from django.conf import settings
-from django.core.cache import cache
 from django.core.files.storage import FileSystemStorage
-from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, \
+    JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.datastructures import MultiValueDictKeyError
 from django.views.generic import View
 from jsonschema import ValidationError, validate
@@ -28,14 +30,19 @@ from .utils import GzipFileResponse, NetworkJSONEncoder, PandasJSONEncoder, chec
 from .utils.analysis_enrichment import AnalysisEnrichmentError, analysis_enrichment, analysis_enrichment_csv
 from .utils.file import BadFile, filter_gene_lists_by_background, get_background_genes, get_file, get_gene_lists, \
     get_genes, get_network, merge_network_filter_tfs, merge_network_lists, network_to_filter_tfs, network_to_lists
-from .utils.formatter import format_data
+from .utils.formatter import FormattedResult, format_result, get_rows
+from .utils.jobs import QUERY_JOBS, estimate_query, get_job, query_jobs
 from .utils.motif_enrichment import ADD_MOTIFS, MOTIFS, MotifEnrichmentError, NoEnrichedMotif, \
     get_additional_motif_enrichment_json, get_motif_enrichment_heatmap, get_motif_enrichment_heatmap_table, \
     get_motif_enrichment_json
 from .utils.motif_enrichment.motif import AdditionalMotifData, MotifData
 from .utils.network import get_auc_figure, get_network_json, get_network_sif, get_network_stats, get_pruned_network
-from .utils.parser import Ids, QueryError, filter_df_by_ids, get_query_result, reorder_data
+from .utils.parser import Ids, QueryError, filter_df_by_ids, get_query_result
+from .utils.result_store import result_store
+from .utils.serializer import ArrowResponse, ResultJSONResponse, accepts_arrow, dumps_rows, dumps_with, iter_rows, \
+    result_arrow, result_json
 from .utils.summary import get_summary
+from .utils.warmup import warmup
 
 logger = logging.getLogger(__name__)
 
@@ -45,58 +52,128 @@ gene_lists_storage = FileSystemStorage(settings.GENE_LISTS)
 networks_storage = FileSystemStorage(settings.TARGET_NETWORKS)
 
 
-class QueryView(View):
+def format_stored_result(request_id, *_sources) -> Tuple[FormattedResult, dict]:
     """
-    Endpoint for new query or get cached queries
+    Format the stored query result again
+    :param request_id:
+    :return: formatted result, metadata
     """
+    result, metadata, stats, _uid, ids = get_query_result(size_limit=QUERY_JOBS['MAX_CELLS'],
+                                                          uid=request_id)
 
-    def get(self, request, request_id):
-        try:
-            cached_data = cache.get_many([f'{request_id}/formatted_tabular_output', f'{request_id}/analysis_ids'])
+    return format_result(result, stats, metadata, ids), metadata_to_dict(metadata)
 
-            columns, merged_cells, result_list, metadata = cached_data[f'{request_id}/formatted_tabular_output']
-            ids = cached_data[f'{request_id}/analysis_ids']
 
-            res = {
-                'result': {
-                    'data': result_list,
-                    'mergeCells': merged_cells,
-                    'columns': columns,
-                },
-                'metadata': metadata,
-                'request_id': request_id,
-                'analysis_ids': list(ids.items())
-            }
+result_store.derive('formatted_tabular_output', format_stored_result, ('tabular_output_unfiltered', 'analysis_ids'),
+                    optional=('target_genes',))
 
-            return JsonResponse(res, encoder=PandasJSONEncoder)
-        except KeyError:
-            try:
-                result, metadata, stats, _uid, ids = get_query_result(size_limit=50_000_000,
-                                                                      uid=request_id)
 
-                columns, merged_cells, result_list = format_data(result, stats, metadata, ids)
-                metadata = metadata_to_dict(metadata)
+def get_formatted_result(request_id) -> Tuple[FormattedResult, dict, Ids]:
+    """
+    Get formatted query result, it is formatted again if it is not in memory
+    :param request_id:
+    :return: formatted result, metadata, analysis ids
+    """
+    cached_data = result_store.get_many([f'{request_id}/formatted_tabular_output', f'{request_id}/analysis_ids'])
 
-                cache.set(f'{request_id}/formatted_tabular_output', (columns, merged_cells, result_list, metadata))
+    formatted, metadata = cached_data[f'{request_id}/formatted_tabular_output']
+    ids = cached_data[f'{request_id}/analysis_ids']
+
+    return formatted, metadata, ids
+
+
+def get_limit(params, name: str = 'limit') -> Optional[int]:
+    limit = params.get(name)
+
+    if limit is None or limit == '':
+        return None
+
+    limit = int(limit)
+
+    if limit < 0:
+        raise ValueError(f'{name} should not be negative')
+
+    return limit
+
+
+def get_result_response(request_id, formatted: FormattedResult, metadata: dict, ids: Ids,
+                        limit: Optional[int] = None, errors: Optional[List[str]] = None,
+                        arrow: bool = False) -> HttpResponse:
+    """
+    Query result response, only the first limit rows are included if limit is set
+
+    Sent as an Arrow IPC stream instead of JSON if arrow is True
+    """
+    res = {
+        'result': {
+            'mergeCells': formatted.merged_cells,
+            'columns': formatted.columns
+        },
+        'metadata': metadata,
+        'request_id': request_id,
+        'analysis_ids': list(ids.items())
+    }
+
+    rows = None
+
+    if limit is not None:
+        total, rows = get_rows(formatted, limit=limit)
+        res['result']['total'] = total
+
+    if errors:
+        res['errors'] = errors
+
+    if arrow:
+        response = ArrowResponse(result_arrow(res, formatted, rows))
+    else:
+        response = ResultJSONResponse(result_json(res, formatted, rows))
+
+    patch_vary_headers(response, ('Accept',))
+
+    return response
 
-                res = {
-                    'result': {
-                        'data': result_list,
-                        'mergeCells': merged_cells,
-                        'columns': columns
-                    },
-                    'metadata': metadata,
-                    'request_id': request_id,
-                    'analysis_ids': list(ids.items())
-                }
 
-                return JsonResponse(res, encoder=PandasJSONEncoder)
-            except KeyError:
-                raise Http404('Query not available')
+def job_error_response(job: dict) -> HttpResponse:
+    if job['status'] == 400:
+        return HttpResponseBadRequest(job['error'])
+
+    return HttpResponse(job['error'], status=job['status'], content_type='text/plain')
+
+
+class QueryView(View):
+    """
+    Endpoint for new query or get cached queries
+
+    New queries run as jobs. The response waits for the job, unless async is "true" or it takes longer than
+    QUERY_JOBS['WAIT'] seconds, then it is 202 with the request id and job status, see JobView. Queries with a
+    result over QUERY_JOBS['MAX_CELLS'] cells fail with 400.
+
+    Pass limit to only get the first rows of the result, the rest can be fetched from RowsView.
+
+    Responds with an Arrow IPC stream if the request accepts application/vnd.apache.arrow.stream.
+    """
+    wait_for_job = QUERY_JOBS['POLL_WAIT']
+
+    def get(self, request, request_id):
+        try:
+            limit = get_limit(request.GET)
+        except ValueError as e:
+            return HttpResponseBadRequest(e)
+
+        try:
+            return get_result_response(request_id, *get_formatted_result(request_id), limit=limit,
+                                       arrow=accepts_arrow(request))
+        except KeyError:
+            raise Http404('Query not available')
 
     def post(self, request, *args, **kwargs):
         errors = []
 
+        try:
+            limit = get_limit(request.POST)
+        except ValueError as e:
+            return HttpResponseBadRequest(e)
+
         try:
             request_id = str(uuid4())
 
@@ -110,7 +187,7 @@ class QueryView(View):
             if background_genes_file:
                 background_genes = get_background_genes(background_genes_file)
                 file_opts['target_filter_list'] = background_genes
-                cache.set(f'{request_id}/background_genes', background_genes)
+                result_store.set(f'{request_id}/background_genes', background_genes)
 
             if targetgenes_file:
                 user_lists = get_gene_lists(targetgenes_file)
@@ -123,7 +200,7 @@ class QueryView(View):
                     errors.append(f'Genes in Target Genes File not in database: {", ".join(bad_genes)}')
 
                 if not target_networks:
-                    cache.set(f'{request_id}/target_genes', user_lists)  # cache the user list here
+                    result_store.set(f'{request_id}/target_genes', user_lists)  # cache the user list here
 
                 file_opts["user_lists"] = user_lists
 
@@ -159,40 +236,25 @@ class QueryView(View):
 
                 file_opts["tf_filter_list"] = tf_filter_list
 
-                cache.set_many({f'{request_id}/target_network': network,
+                result_store.set_many({f'{request_id}/target_network': network,
                                 f'{request_id}/target_genes': user_lists})
 
             edges = request.POST.getlist('edges')
             query = request.POST['query']
 
-            result, metadata, stats, _uid, ids = get_query_result(query=query,
-                                                                  edges=edges,
-                                                                  size_limit=50_000_000,
-                                                                  uid=request_id,
-                                                                  **file_opts)
-            columns, merged_cells, result_list = format_data(result, stats, metadata, ids)
-            metadata = metadata_to_dict(metadata)
-
-            cache.set_many({
-                f'{request_id}/query': query.strip() + '\n',  # save queries
-                f'{request_id}/formatted_tabular_output': (columns, merged_cells, result_list, metadata),
-            })
-
-            res = {
-                'result': {
-                    'data': result_list,
-                    'mergeCells': merged_cells,
-                    'columns': columns
-                },
-                'metadata': metadata,
-                'request_id': request_id,
-                'analysis_ids': list(ids.items())
-            }
+            cost = estimate_query(query, file_opts)
+            future = query_jobs.submit(request_id, query, edges, file_opts, errors, cost)
 
-            if errors:
-                res['errors'] = errors
+            done, _not_done = wait([future], 0 if request.POST.get('async') == 'true' else QUERY_JOBS['WAIT'])
+            if not done:
+                return JsonResponse({'request_id': request_id, 'job': get_job(request_id)}, status=202)
+
+            result = future.result()
+            if result is None:
+                return job_error_response(get_job(request_id))
 
-            return JsonResponse(res, encoder=PandasJSONEncoder)
+            return get_result_response(request_id, *result, limit=limit, errors=errors,
+                                       arrow=accepts_arrow(request))
         except (QueryError, BadFile) as e:
             return HttpResponseBadRequest(e)
         except ValueError as e:
@@ -201,6 +263,87 @@ class QueryView(View):
             return HttpResponseBadRequest(f"Problem with query: {e}")
 
 
+def get_row_options(params) -> dict:
+    sort = params.get('sort')
+
+    return {
+        'offset': get_limit(params, 'offset') or 0,
+        'limit': get_limit(params),
+        'sort': int(sort) if sort not in (None, '') else None,
+        'ascending': params.get('order', 'asc') != 'desc',
+        'search': params.get('search')
+    }
+
+
+class RowsView(View):
+    """
+    Window of result rows
+
+    Query parameters: offset, limit, sort (column index), order (asc or desc) and search (Gene ID substring)
+    """
+    wait_for_job = QUERY_JOBS['POLL_WAIT']
+
+    def get(self, request, request_id):
+        try:
+            options = get_row_options(request.GET)
+        except ValueError as e:
+            return HttpResponseBadRequest(e)
+
+        try:
+            formatted, metadata, ids = get_formatted_result(request_id)
+        except KeyError:
+            raise Http404('Query not available')
+
+        try:
+            total, rows = get_rows(formatted, **options)
+        except (IndexError, TypeError):
+            return HttpResponseBadRequest('Invalid sort column')
+
+        return ResultJSONResponse(dumps_with({
+            'total': total,
+            'offset': options['offset']
+        }, data=dumps_rows(formatted, rows, header=False)))
+
+
+class RowsStreamView(View):
+    """
+    Result rows as newline delimited JSON
+
+    The first line has the column formats, merged cells, header rows and the number of rows, followed by one
+    row per line. Takes the same query parameters as RowsView.
+    """
+    wait_for_job = QUERY_JOBS['POLL_WAIT']
+
+    def get(self, request, request_id):
+        try:
+            options = get_row_options(request.GET)
+        except ValueError as e:
+            return HttpResponseBadRequest(e)
+
+        try:
+            formatted, metadata, ids = get_formatted_result(request_id)
+        except KeyError:
+            raise Http404('Query not available')
+
+        try:
+            total, rows = get_rows(formatted, **options)
+        except (IndexError, TypeError):
+            return HttpResponseBadRequest('Invalid sort column')
+
+        def lines():
+            yield json.dumps({
+                'columns': formatted.columns,
+                'mergeCells': formatted.merged_cells,
+                'header': formatted.header,
+                'total': total
+            }, cls=PandasJSONEncoder) + '\n'
+
+            for row in iter_rows(rows):
+                yield row + '\n'
+
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+
 ANALYSIS_ID_SCHEMA = {
     "type": "array",
     "items": {
@@ -241,7 +384,7 @@ class EditQueryView(View):
     """
 
     def get(self, request, request_id):
-        ids = cache.get(f'{request_id}/analysis_ids')
+        ids = result_store.get(f'{request_id}/analysis_ids')
 
         if ids is None:
             return HttpResponseNotFound('Query Analysis Ids not available')
@@ -253,7 +396,7 @@ class EditQueryView(View):
             data = json.loads(request.body)
             validate(data, ANALYSIS_ID_SCHEMA)
 
-            ids: Optional[Ids] = cache.get(f'{request_id}/analysis_ids')
+            ids: Optional[Ids] = result_store.get(f'{request_id}/analysis_ids')
 
             if ids is None:
                 return HttpResponseNotFound('Query Analysis Ids not available')
@@ -263,6 +406,8 @@ class EditQueryView(View):
             if not any(v['show'] for v in data.values()):
                 return HttpResponseBadRequest("cannot hide all analyses")
 
+            shown = {key for key, opt in ids.items() if opt['show']}
+
             for key in ids:
                 try:
                     if ids[key]['name'] != data[key]['name']:
@@ -272,49 +417,40 @@ class EditQueryView(View):
                 except KeyError:
                     pass
 
-            cache.set(f'{request_id}/analysis_ids', ids)
+            result_store.set(f'{request_id}/analysis_ids', ids)
 
-            cached_result = cache.get_many([f'{request_id}/target_genes', f'{request_id}/tabular_output_unfiltered'])
+            # filtered tabular output is derived from the analysis ids, check if it still works
+            if result_store.get(f'{request_id}/tabular_output') is None:
+                raise KeyError(request_id)
 
-            result = cached_result[f'{request_id}/tabular_output_unfiltered']
-            result = filter_df_by_ids(result, ids)
-
-            try:
-                user_lists = cached_result[f'{request_id}/target_genes']
-                result = result[result.index.str.upper().isin(user_lists[0].index.str.upper())].dropna(axis=1,
-                                                                                                       how='all')
-
-                if result.empty:
-                    raise QueryError("Empty result (user list too restrictive).")
-
-                result = reorder_data(result)
-            except KeyError:
-                pass
-
-            cache.set(f'{request_id}/tabular_output', result)  # refresh filtered tabular output
-
-            # delete cache keys and refresh cache here.
-            cache.delete_many([
+            # results with analysis labels in them
+            stale = [
                 # formatted output
                 f'{request_id}/formatted_tabular_output',
-                # network
-                f'{request_id}/network',
-                # AUPR curve
-                f'{request_id}/figure',
-                f'{request_id}/figure_data',
-                # network stats
-                f'{request_id}/stats',
-                # Gene list enrichment
-                f'{request_id}/list_enrichment',
-                f'{request_id}/list_enrichment_legend',
-                f'{request_id}/list_enrichment_data',
-                # motif enrichment
-                *(f'{request_id}/{r}_enrich' for r in MOTIFS.regions),
                 # analysis enrichment
                 f'{request_id}/analysis_enrichment',
                 # summary
                 f'{request_id}/summary'
-            ])
+            ]
+
+            # renaming doesn't change any numbers, hiding or showing analyses changes results that use all of them.
+            # motif, gene list and analysis enrichment are kept per analysis (or pair), and reused.
+            if shown != {key for key, opt in ids.items() if opt['show']}:
+                stale.extend([
+                    # network
+                    f'{request_id}/network',
+                    # AUPR curve
+                    f'{request_id}/figure',
+                    f'{request_id}/figure_data',
+                    # network stats
+                    f'{request_id}/stats',
+                    # Gene list enrichment
+                    f'{request_id}/list_enrichment',
+                    f'{request_id}/list_enrichment_legend',
+                    f'{request_id}/list_enrichment_data'
+                ])
+
+            result_store.delete_many(stale)
 
             return JsonResponse(list(ids.items()), status=201, safe=False, encoder=PandasJSONEncoder)
         except (json.JSONDecodeError, ValidationError, QueryError) as e:
@@ -332,7 +468,7 @@ class NetworkAuprView(View):
                 warnings.filterwarnings("ignore", category=matplotlib.MatplotlibDeprecationWarning,
                                         module="matplotlib.figure")
 
-                cached_data = cache.get_many([
+                cached_data = result_store.get_many([
                     f'{request_id}/target_network',
                     f'{request_id}/tabular_output_unfiltered',
                     f'{request_id}/analysis_ids'
@@ -354,7 +490,7 @@ class NetworkAuprView(View):
             raise Http404
 
     def head(self, request, request_id):
-        if cache.get(f'{request_id}/target_network') is not None:
+        if result_store.get(f'{request_id}/target_network') is not None:
             return HttpResponse()
         return HttpResponseNotFound()
 
@@ -385,15 +521,15 @@ class StatsView(View):
             data_cache = f'{request_id}/tabular_output'
             stats_cache = f'{request_id}/stats'
 
-            stats = cache.get(stats_cache)
+            stats = result_store.get(stats_cache)
 
             if stats is None:
                 try:
-                    stats = get_network_stats(cache.get(data_cache))
+                    stats = get_network_stats(result_store.get(data_cache))
                 except AttributeError:
                     raise Http404('Stats not available')
 
-                cache.set(stats_cache, stats)
+                result_store.set(stats_cache, stats)
 
             return JsonResponse(stats, encoder=PandasJSONEncoder)
         except FileNotFoundError:
@@ -550,7 +686,7 @@ class MotifEnrichmentJSONView(View):
                 regions = request.GET.getlist('regions')
                 label = convert_float(request.GET.get('label'))
 
-                background_genes = cache.get(f'{request_id}/background_genes')
+                background_genes = result_store.get(f'{request_id}/background_genes')
 
                 if background_genes is not None:
                     motif_data = MotifData(background=background_genes)
@@ -581,7 +717,7 @@ class AdditionalMotifEnrichmentJSONView(View):
             if 'motifs' in data:
                 opts['motifs'] = data['motifs']
 
-            background_genes = cache.get(f'{request_id}/background_genes')
+            background_genes = result_store.get(f'{request_id}/background_genes')
 
             if background_genes is not None:
                 motif_data = AdditionalMotifData(background=background_genes)
@@ -619,7 +755,7 @@ class MotifEnrichmentHeatmapView(View):
                 fields = request.GET.getlist('fields')
                 label = convert_float(request.GET.get('label'))
 
-                background_genes = cache.get(f'{request_id}/background_genes')
+                background_genes = result_store.get(f'{request_id}/background_genes')
 
                 if background_genes is not None:
                     motif_data = MotifData(background=background_genes)
@@ -705,11 +841,11 @@ class MotifEnrichmentAdditionalMotifsView(View):
 class AnalysisEnrichmentView(View):
     def get(self, request, request_id):
         try:
-            result = cache.get(f'{request_id}/analysis_enrichment')
+            result = result_store.get(f'{request_id}/analysis_enrichment')
 
             if result is None:
                 result = analysis_enrichment(request_id)
-                cache.set(f'{request_id}/analysis_enrichment', result)
+                result_store.set(f'{request_id}/analysis_enrichment', result)
 
             return JsonResponse(result, encoder=PandasJSONEncoder)
         except AnalysisEnrichmentError as e:
@@ -733,12 +869,12 @@ class AnalysisEnrichmentCsvView(View):
 
 class SummaryView(View):
     def get(self, request, request_id):
-        result = cache.get(f'{request_id}/summary')
+        result = result_store.get(f'{request_id}/summary')
 
         if result is None:
             try:
                 result = get_summary(request_id)
-                cache.set(f'{request_id}/summary', result)
+                result_store.set(f'{request_id}/summary', result)
             except ValueError as e:
                 return HttpResponseNotFound(e)
 
@@ -771,3 +907,29 @@ class ListDownloadView(View):
             return FileResponse(storage.open(file, 'rb'), as_attachment=True)
         except (StopIteration, FileNotFoundError) as e:
             raise Http404('gene list not found') from e
+
+
+class JobView(View):
+    """
+    Status of the query job of a request: state, phase, percent done, and the error of a failed job
+    """
+    wait_for_job = None
+
+    def get(self, request, request_id):
+        job = get_job(request_id)
+
+        if job is None:
+            raise Http404('Job not found')
+
+        return JsonResponse({'request_id': str(request_id), **job})
+
+
+class ReadyView(View):
+    """
+    Warm-up progress and result store statistics, responds with 503 until the first warm-up is done
+    """
+
+    def get(self, request):
+        status = warmup.status()
+
+        return JsonResponse({**status, 'result_store': result_store.stats()}, status=200 if status['ready'] else 503)
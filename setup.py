@@ -27,6 +27,7 @@ setup(
         'django',
         'matplotlib',
         'pyparsing',
+        'pyarrow',
         'seaborn',
         'lxml',
         'networkx',
@@ -40,5 +41,8 @@ setup(
         'sungear',
         'jsonschema'
     ],
+    extras_require={
+        'redis': ['redis']
+    },
     python_requires='>=3.5'
 )
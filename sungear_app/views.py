@@ -6,13 +6,13 @@ from operator import itemgetter, or_
 from typing import Dict, List, Tuple
 
 import pandas as pd
-from django.core.cache import cache
 from django.http import Http404, HttpResponseBadRequest, JsonResponse
 from django.views import View
 from sungear import SungearException, sungear
 
 from querytgdb.models import Analysis
-from querytgdb.utils import PandasJSONEncoder, async_loader, clear_data, get_metadata
+from querytgdb.utils import EDGE_COLUMNS, PandasJSONEncoder, async_loader, clear_data, get_metadata
+from querytgdb.utils.result_store import result_store
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +38,8 @@ def make_meta_dict(col, metadata, ids):
 
 def get_sungear(uid, filter_genes: List[str] = None) -> Tuple[Dict, bool]:
     try:
-        cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/analysis_ids'])
+        cached_data = result_store.get_many([f'{uid}/tabular_output', f'{uid}/analysis_ids'],
+                                            columns={f'{uid}/tabular_output': EDGE_COLUMNS})
         df, ids = itemgetter(
             f'{uid}/tabular_output',
             f'{uid}/analysis_ids'
@@ -85,11 +86,11 @@ def get_sungear(uid, filter_genes: List[str] = None) -> Tuple[Dict, bool]:
 class SungearView(View):
     def get(self, request, request_id):
         try:
-            res = cache.get(f'{request_id}/sungear')
+            res = result_store.get(f'{request_id}/sungear')
             if res is None:
                 res, can_cache = get_sungear(request_id)
                 if can_cache:
-                    cache.set(f'{request_id}/sungear', res)
+                    result_store.set(f'{request_id}/sungear', res)
             return JsonResponse(res, encoder=PandasJSONEncoder)
         except SungearNotFound:
             raise Http404
@@ -106,11 +107,11 @@ class SungearView(View):
 
                 res, can_cache = get_sungear(request_id, genes)
             except (json.JSONDecodeError, KeyError, FilterListNotFound):
-                res = cache.get(f'{request_id}/sungear')
+                res = result_store.get(f'{request_id}/sungear')
                 if res is None:
                     res, can_cache = get_sungear(request_id)
                     if can_cache:
-                        cache.set(f'{request_id}/sungear', res)
+                        result_store.set(f'{request_id}/sungear', res)
             return JsonResponse(res, encoder=PandasJSONEncoder)
         except SungearNotFound:
             raise Http404